@@ -0,0 +1,413 @@
+"""Making the bulk data files, a shard at a time.
+
+Each type of object is split into shards by ranges of its primary key, and
+the shards are exported at once by a pool of processes. A shard's items are
+streamed from the DB with a server-side cursor, in order of their court, and
+written straight into a gzipped tar part for each court, so there's never
+more than one item in memory, and nothing is written to disk twice.
+
+Once every shard is done, the parts of each court are joined into its
+archive. A gzip file can hold many gzip streams one after the other, so the
+parts are joined by copying their bytes, without compressing them again.
+
+Every item is exported on every run. Runs used to keep a JSON file for each
+item and only write the ones modified since the last run again, but items
+that were deleted or moved to another court stayed in the archives, and the
+files took more disk than the archives did.
+
+When there's been a good run before, a delta is made too, in the deltas
+directory of the type of object. It has the items modified since the start
+of that run, in the same archives, and a deleted.json file listing the IDs
+of the items that have been deleted since. Items that are deleted leave
+nothing in the DB, so each run saves the IDs it saw for the next run to
+compare against.
+"""
+import glob
+import gzip
+import json
+import os
+import shutil
+import tarfile
+import time
+from datetime import timedelta
+from multiprocessing import Pool
+from os.path import join
+
+from django.db import connections
+from django.db.models import Max, Min
+from rest_framework.renderers import JSONRenderer
+
+from cl.api.tasks import (
+    get_bulk_serializer_context,
+    swap_archives,
+    tar_court_archives,
+)
+from cl.api.utils import BulkJsonHistory
+from cl.lib.command_utils import logger
+from cl.lib.utils import deepgetattr, mkdir_p
+
+# The name of the archive for types of objects that aren't split by court.
+ALL_COURTS = "all"
+
+# How often a shard logs its progress.
+PROGRESS_INTERVAL = 10000
+
+
+def get_shard_ranges(qs, num_shards):
+    """Split a queryset into ranges of its primary key.
+
+    :param qs: The queryset to split.
+    :param num_shards: How many ranges to split it into, at most.
+    :return: A list of (first pk, last pk) tuples. If the primary key isn't
+    an int, like for courts, a list with one None, meaning everything.
+    """
+    bounds = qs.aggregate(Min("pk"), Max("pk"))
+    low, high = bounds["pk__min"], bounds["pk__max"]
+    if low is None:
+        return []
+    if not isinstance(low, (int, long)):
+        return [None]
+    width = (high - low) // num_shards + 1
+    return [
+        (first, min(first + width - 1, high))
+        for first in range(low, high + 1, width)
+    ]
+
+
+def get_queryset(obj_class, since=None):
+    qs = obj_class.objects.all()
+    if since is not None:
+        qs = qs.filter(date_modified__gte=since)
+    return qs
+
+
+def get_part_path(root_path, court_id, shard):
+    return join(root_path, "parts", "%s-%05d.tar.gz" % (court_id, shard))
+
+
+def write_tar_member(f, name, data):
+    """Write a file to a tar stream, without ending the archive."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    f.write(info.tobuf())
+    f.write(data)
+    remainder = len(data) % tarfile.BLOCKSIZE
+    if remainder:
+        f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def log_shard_progress(obj_type_str, shard, done, total, started):
+    elapsed = time.time() - started
+    rate = done / elapsed if elapsed else 0
+    eta = (total - done) / rate if rate else 0
+    logger.info(
+        "   - %s shard %s: %s of %s items (%.0f/s, ETA %s)",
+        obj_type_str,
+        shard,
+        done,
+        total,
+        rate,
+        timedelta(seconds=int(eta)),
+    )
+
+
+def export_shard(args):
+    """Export a shard of a type of object into a part for each of its courts.
+
+    :param args: A tuple of the bulk data kwargs of the type of object, the
+    directory its files go in, the number of the shard, the range of pks in
+    the shard, or None for all of them, and the date items must be modified
+    since, or None for all of them.
+    :return: The number of items exported.
+    """
+    kwargs, root_path, shard, pk_range, since = args
+    obj_type_str = kwargs["obj_type_str"]
+    court_attr = kwargs["court_attr"]
+
+    qs = get_queryset(kwargs["obj_class"], since)
+    if pk_range is not None:
+        qs = qs.filter(pk__gte=pk_range[0], pk__lte=pk_range[1])
+    if court_attr is None:
+        qs = qs.order_by("pk")
+    else:
+        # Keep the items of a court together, so only one part is open at a
+        # time, and get the court without a query for each item.
+        court_path = court_attr.split(".")
+        qs = qs.order_by("__".join(court_path), "pk")
+        if len(court_path) > 1:
+            qs = qs.select_related("__".join(court_path[:-1]))
+    total = qs.count()
+
+    renderer = JSONRenderer()
+    context = get_bulk_serializer_context()
+    started = time.time()
+    court_id = None
+    f = None
+    i = 0
+    try:
+        for i, item in enumerate(qs.iterator(), 1):
+            if court_attr is None:
+                item_court_id = ALL_COURTS
+            else:
+                item_court_id = deepgetattr(item, court_attr)
+            if item_court_id != court_id:
+                if f is not None:
+                    f.close()
+                court_id = item_court_id
+                f = gzip.open(
+                    get_part_path(root_path, court_id, shard), "wb", 3
+                )
+
+            json_str = renderer.render(
+                kwargs["serializer"](item, context=context).data,
+                accepted_media_type="application/json; indent=2",
+            )
+            write_tar_member(f, "%s.json" % item.pk, json_str)
+            if i % PROGRESS_INTERVAL == 0:
+                log_shard_progress(obj_type_str, shard, i, total, started)
+    finally:
+        if f is not None:
+            f.close()
+    return i
+
+
+def export_in_shards(kwargs, root_path, processes, num_shards, since=None):
+    """Export a type of object into a part for each court in each shard.
+
+    :param kwargs: The bulk data kwargs of the type of object.
+    :param root_path: The directory the files go in.
+    :param processes: How many shards to export at once. With fewer than
+    two, they're exported in this process.
+    :param num_shards: How many shards to split the objects into.
+    :param since: If given, only items modified since then are exported.
+    :return: The number of shards.
+    """
+    obj_type_str = kwargs["obj_type_str"]
+    if os.path.isdir(join(root_path, "parts")):
+        # Left over from a run that failed.
+        shutil.rmtree(join(root_path, "parts"))
+    mkdir_p(join(root_path, "parts"))
+
+    shard_ranges = get_shard_ranges(
+        get_queryset(kwargs["obj_class"], since), num_shards
+    )
+    logger.info(
+        "   - Exporting %s in %s shards...", obj_type_str, len(shard_ranges)
+    )
+    jobs = [
+        (kwargs, root_path, shard, pk_range, since)
+        for shard, pk_range in enumerate(shard_ranges)
+    ]
+    if processes > 1 and len(jobs) > 1:
+        # Don't share DB connections with the forked processes.
+        connections.close_all()
+        pool = Pool(processes=min(processes, len(jobs)))
+        try:
+            counts = pool.map(export_shard, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [export_shard(job) for job in jobs]
+    logger.info("   - %s %s items exported.", sum(counts), obj_type_str)
+    return len(jobs)
+
+
+def merge_parts(root_path, court_ids, num_shards, skip_empty=False):
+    """Join the parts of each court into its archive, and end the archive.
+
+    :param skip_empty: Whether to skip the courts that have no parts,
+    instead of making empty archives for them.
+    :return: The IDs of the courts that got archives.
+    """
+    merged = []
+    for court_id in court_ids:
+        part_paths = [
+            get_part_path(root_path, court_id, shard)
+            for shard in range(num_shards)
+        ]
+        part_paths = [p for p in part_paths if os.path.exists(p)]
+        if skip_empty and not part_paths:
+            continue
+        with open(join(root_path, "%s.tar.gz" % court_id), "wb") as out:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part:
+                    shutil.copyfileobj(part, out)
+            end = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=3)
+            end.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+            end.close()
+        merged.append(court_id)
+    shutil.rmtree(join(root_path, "parts"))
+    return merged
+
+
+def remove_old_json_files(courts, root_path):
+    """Remove the JSON files that bulk data used to be made from.
+
+    Each item used to be kept in a JSON file, in a directory for its court,
+    so that only the items modified since the last run had to be written
+    again. The archives are made straight from the DB now, so those files
+    are never used.
+    """
+    for court in courts:
+        court_path = join(root_path, court.pk)
+        if os.path.isdir(court_path):
+            shutil.rmtree(court_path)
+    for path in glob.glob(join(root_path, "*.json")):
+        if os.path.basename(path) != "info.json":
+            os.remove(path)
+
+
+def iter_missing(old_pks, new_pks):
+    """Find the pks in one sorted iterable that aren't in another."""
+    new_pks = iter(new_pks)
+    new_pk = next(new_pks, None)
+    for old_pk in old_pks:
+        while new_pk is not None and new_pk < old_pk:
+            new_pk = next(new_pks, None)
+        if new_pk != old_pk:
+            yield old_pk
+
+
+def get_pks_path(root_path):
+    return join(root_path, "pks.txt.gz")
+
+
+def find_deleted_pks(obj_class, root_path):
+    """Find the items deleted since the last run, from the pks it saw.
+
+    This is run after the items are exported, so that the pks saved include
+    every item the run's files could have.
+
+    The pks that exist now are saved for the next run, in order, while
+    they're compared to the ones saved by the last run, so neither is held in
+    memory. They're saved next to the old ones, and take their place once the
+    run is good.
+
+    :return: A list of the pks that were deleted, or None if the last run
+    didn't save its pks.
+    """
+    old_path = get_pks_path(root_path)
+    int_pks = obj_class._meta.pk.get_internal_type() == "AutoField"
+    pks = obj_class.objects.order_by("pk").values_list("pk", flat=True)
+    # Only ints are sure to sort the same in the DB and in Python.
+    pks = pks.iterator() if int_pks else iter(sorted(pks))
+
+    with gzip.open("%s.new" % old_path, "wb") as new_file:
+
+        def save(pks):
+            for pk in pks:
+                new_file.write("%s\n" % pk)
+                yield pk
+
+        new_pks = save(pks)
+        deleted = None
+        if os.path.exists(old_path):
+            with gzip.open(old_path, "rb") as old_file:
+                old_pks = (line.rstrip("\n") for line in old_file)
+                if int_pks:
+                    old_pks = (int(pk) for pk in old_pks)
+                deleted = list(iter_missing(old_pks, new_pks))
+        # Save the rest of them.
+        for _ in new_pks:
+            pass
+    return deleted
+
+
+def make_delta(courts, root_path, kwargs, processes, num_shards, since):
+    """Make the archives of the items modified since a date.
+
+    :return: The directory they're in.
+    """
+    delta_path = join(root_path, "delta")
+    if os.path.isdir(delta_path):
+        # Left over from a run that failed.
+        shutil.rmtree(delta_path)
+    num_shards = export_in_shards(
+        kwargs, delta_path, processes, num_shards, since=since
+    )
+    if kwargs["court_attr"] is None:
+        merge_parts(delta_path, [ALL_COURTS], num_shards, skip_empty=True)
+    else:
+        court_ids = merge_parts(
+            delta_path,
+            [court.pk for court in courts],
+            num_shards,
+            skip_empty=True,
+        )
+        tar_court_archives(
+            [court for court in courts if court.pk in court_ids], delta_path
+        )
+    return delta_path
+
+
+def make_bulk_data_in_shards(courts, bulk_dir, kwargs, processes, num_shards):
+    """Make the bulk files of a type of object, and swap them in.
+
+    :param courts: Court objects that you expect to make data for.
+    :param bulk_dir: The directory the bulk files go in.
+    :param kwargs: The bulk data kwargs of the type of object, as taken by
+    write_json_to_disk.
+    :param processes: How many shards to export at once. With fewer than
+    two, they're exported in this process.
+    :param num_shards: How many shards to split the objects into.
+    """
+    obj_type_str = kwargs["obj_type_str"]
+    tmp_bulk_dir = join(bulk_dir, "tmp")
+    root_path = join(tmp_bulk_dir, obj_type_str)
+    mkdir_p(root_path)
+    history = BulkJsonHistory(obj_type_str, tmp_bulk_dir)
+    since = history.get_last_good_start()
+    history.add_current_attempt_and_save()
+    until = history.get_last_attempt()
+
+    logger.info(" - Creating bulk %s files...", obj_type_str)
+    remove_old_json_files(courts, root_path)
+    shards = export_in_shards(kwargs, root_path, processes, num_shards)
+    logger.info("   - Merging the shards of the %s files...", obj_type_str)
+    if kwargs["court_attr"] is None:
+        merge_parts(root_path, [ALL_COURTS], shards)
+    else:
+        merge_parts(root_path, [court.pk for court in courts], shards)
+        tar_court_archives(courts, root_path)
+
+    delta_path = None
+    if since is not None:
+        logger.info(
+            "   - Creating the delta of %s since %s...", obj_type_str, since
+        )
+        delta_path = make_delta(
+            courts, root_path, kwargs, processes, num_shards, since
+        )
+    # Look at the pks once everything is exported, so any item in this run's
+    # files is among them, and gets a tombstone if it's deleted before the
+    # next run.
+    deleted = find_deleted_pks(kwargs["obj_class"], root_path)
+    if delta_path is not None:
+        if deleted is not None:
+            logger.info(
+                "   - %s %s items deleted.", len(deleted), obj_type_str
+            )
+            with open(join(delta_path, "deleted.json"), "w") as f:
+                json.dump(deleted, f)
+    history.mark_success_and_save()
+    pks_path = get_pks_path(root_path)
+    os.rename("%s.new" % pks_path, pks_path)
+
+    logger.info("   - Swapping in the new %s archives...", obj_type_str)
+    swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir)
+    if delta_path is not None:
+        deltas_dir = join(bulk_dir, obj_type_str, "deltas")
+        mkdir_p(deltas_dir)
+        shutil.move(
+            delta_path,
+            join(
+                deltas_dir,
+                "%s--%s"
+                % (
+                    since.strftime("%Y-%m-%dT%H%M%S"),
+                    until.strftime("%Y-%m-%dT%H%M%S"),
+                ),
+            ),
+        )
@@ -1,13 +1,13 @@
-import os
 import shutil
 from os.path import join
 
 from django.conf import settings
 
-from cl.api.tasks import make_bulk_data_and_swap_it_in
+from cl.api.bulk_data import make_bulk_data_in_shards
 from cl.audio.api_serializers import AudioSerializer
 from cl.audio.models import Audio
 from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.db_tools import copy_to_gzipped_csv
 from cl.lib.utils import mkdir_p
 from cl.people_db.api_serializers import (
     PersonSerializer,
@@ -31,12 +31,33 @@ from cl.search.api_serializers import (
     DocketSerializer,
     CourtSerializer,
 )
-from cl.search.models import Court, Docket, OpinionCluster, Opinion
+from cl.search.models import (
+    Court,
+    Docket,
+    OpinionCluster,
+    Opinion,
+    OpinionsCited,
+)
 
 
 class Command(VerboseCommand):
     help = 'Create the bulk files for all jurisdictions and for "all".'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="How many shards of each type of object to export at once. "
+            "With fewer than two, they're exported in this process.",
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            help="How many shards to split each type of object into, by "
+            "ranges of their IDs. Defaults to four per process.",
+        )
+
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
         courts = Court.objects.all()
@@ -110,13 +131,15 @@ class Command(VerboseCommand):
             },
         ]
 
+        processes = options["processes"]
+        num_shards = options["shards"] or processes * 4
         logger.info(
-            "Starting bulk file creation with %s celery tasks..."
-            % len(kwargs_list)
+            "Starting bulk file creation of %s types of objects with %s "
+            "processes..." % (len(kwargs_list), processes)
         )
         for kwargs in kwargs_list:
-            make_bulk_data_and_swap_it_in(
-                courts, settings.BULK_DATA_DIR, kwargs
+            make_bulk_data_in_shards(
+                courts, settings.BULK_DATA_DIR, kwargs, processes, num_shards
             )
 
         # Make the citation bulk data
@@ -141,23 +164,16 @@ class Command(VerboseCommand):
         are 11M citations in the database, we cannot provide users with a bulk
         data file containing the complete objects for every citation.
 
-        Instead of doing that, we dump our citation table with a shell command,
+        Instead of doing that, we dump our citation table as a compressed CSV,
         which provides people with compact and reasonable data they can import.
         """
         mkdir_p(tmp_destination)
 
         logger.info("   - Copying the citations table to disk...")
-
-        # This command calls the psql COPY command and requests that it dump
-        # the citation table to disk as a compressed CSV.
-        default_db = settings.DATABASES["default"]
-        os.system(
-            """PGPASSWORD="{password}" psql -c "COPY \\"search_opinionscited\\" (citing_opinion_id, cited_opinion_id, depth) to stdout DELIMITER ',' CSV HEADER" --host {host} --dbname {database} --username {username} | gzip > {destination}""".format(
-                password=default_db["PASSWORD"],
-                host=default_db["HOST"],
-                database=default_db["NAME"],
-                username=default_db["USER"],
-                destination=join(tmp_destination, "all.csv.gz"),
-            )
+        copy_to_gzipped_csv(
+            OpinionsCited.objects.order_by().values_list(
+                "citing_opinion_id", "cited_opinion_id", "depth"
+            ),
+            join(tmp_destination, "all.csv.gz"),
         )
         logger.info("   - Table created successfully.")
@@ -9,37 +9,10 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.versioning import URLPathVersioning
 
 from cl.api.utils import BulkJsonHistory
-from cl.celery import app
 from cl.lib.db_tools import queryset_generator
-from cl.lib.timer import print_timing
 from cl.lib.utils import deepgetattr, mkdir_p
 
 
-@app.task
-@print_timing
-def make_bulk_data_and_swap_it_in(courts, bulk_dir, kwargs):
-    """We can't wrap the handle() function, but we can wrap this one."""
-    # Create a directory where we'll put temporary files
-    tmp_bulk_dir = join(bulk_dir, "tmp")
-
-    print(" - Creating bulk %s files..." % kwargs["obj_type_str"])
-    num_written = write_json_to_disk(courts, bulk_dir=tmp_bulk_dir, **kwargs)
-
-    if num_written > 0:
-        print(
-            "   - Tarring and compressing all %s files..."
-            % kwargs["obj_type_str"]
-        )
-        targz_json_files(
-            courts, tmp_bulk_dir, kwargs["obj_type_str"], kwargs["court_attr"]
-        )
-
-        print(
-            "   - Swapping in the new %s archives..." % kwargs["obj_type_str"]
-        )
-        swap_archives(kwargs["obj_type_str"], bulk_dir, tmp_bulk_dir)
-
-
 def swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir):
     """Swap out new archives, clobbering the old, if present"""
     tmp_gz_dir = join(tmp_bulk_dir, obj_type_str)
@@ -61,33 +34,26 @@ def swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir):
             raise
 
 
-def targz_json_files(courts, bulk_dir, obj_type_str, court_attr):
-    """Create gz-compressed archives using the JSON on disk."""
+def tar_court_archives(courts, root_path):
+    """Make the all.tar file by tarring up the archive of each court."""
+    tar = tarfile.open(join(root_path, "all.tar"), "w")
+    for court in courts:
+        targz = join(root_path, "%s.tar.gz" % court.pk)
+        tar.add(targz, arcname=os.path.basename(targz))
+    tar.close()
 
-    root_path = join(bulk_dir, obj_type_str)
-    if court_attr is not None:
-        for court in courts:
-            tar_path = join(root_path, "%s.tar.gz" % court.pk)
-            tar = tarfile.open(tar_path, "w:gz", compresslevel=3)
-            for name in glob.glob(join(root_path, court.pk, "*.json")):
-                tar.add(name, arcname=os.path.basename(name))
-            tar.close()
-    else:
-        # Non-jurisdictional-centric object type (like an ABA Rating)
-        tar_path = join(root_path, "all.tar.gz")
-        tar = tarfile.open(tar_path, "w:gz", compresslevel=3)
-        for name in glob.glob(join(root_path, "*.json")):
-            tar.add(name, arcname=os.path.basename(name))
-        tar.close()
 
-    if court_attr is not None:
-        # Make the all.tar file by tarring up the other files. Non-court-centric
-        # objects already did this.
-        tar = tarfile.open(join(root_path, "all.tar"), "w")
-        for court in courts:
-            targz = join(root_path, "%s.tar.gz" % court.pk)
-            tar.add(targz, arcname=os.path.basename(targz))
-        tar.close()
+def get_bulk_serializer_context():
+    """Make the context for serializing items into bulk files, so that their
+    URLs point at the v3 API of the live site.
+    """
+    r = RequestFactory().request()
+    r.META["SERVER_NAME"] = "www.courtlistener.com"  # Else, it's testserver
+    r.META["SERVER_PORT"] = "443"  # Else, it's 80
+    r.META["wsgi.url_scheme"] = "https"  # Else, it's http.
+    r.version = "v3"
+    r.versioning_scheme = URLPathVersioning()
+    return dict(request=r)
 
 
 def write_json_to_disk(
@@ -156,15 +122,7 @@ def write_json_to_disk(
 
         i = 0
         renderer = JSONRenderer()
-        r = RequestFactory().request()
-        r.META[
-            "SERVER_NAME"
-        ] = "www.courtlistener.com"  # Else, it's testserver
-        r.META["SERVER_PORT"] = "443"  # Else, it's 80
-        r.META["wsgi.url_scheme"] = "https"  # Else, it's http.
-        r.version = "v3"
-        r.versioning_scheme = URLPathVersioning()
-        context = dict(request=r)
+        context = get_bulk_serializer_context()
         for item in item_list:
             if i % 1000 == 0:
                 print("Completed %s items so far." % i)
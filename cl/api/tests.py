@@ -1,9 +1,12 @@
 # coding=utf-8
 from __future__ import print_function
 import json
+import os
 import shutil
+import tarfile
 from datetime import timedelta, date
 
+import mock
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
 from django.core import mail
@@ -21,6 +24,7 @@ from django.test import (
 from django.utils.timezone import now
 from rest_framework.status import HTTP_200_OK, HTTP_403_FORBIDDEN
 
+from cl.api import bulk_data
 from cl.api.utils import BulkJsonHistory, SEND_API_WELCOME_EMAIL_COUNT
 from cl.api.views import coverage_data
 from cl.audio.api_views import AudioViewSet
@@ -907,6 +911,13 @@ class BulkJsonHistoryTest(TestCase):
         d = self.history.get_last_attempt()
         self.assertAlmostEqual(d, now(), delta=timedelta(seconds=10))
 
+    def test_last_good_start(self):
+        self.assertIsNone(self.history.get_last_good_start())
+        self.history.add_current_attempt_and_save()
+        attempt = self.history.get_last_attempt()
+        self.history.mark_success_and_save()
+        self.assertEqual(self.history.get_last_good_start(), attempt)
+
 
 class BulkDataTest(TestCase):
     tmp_data_dir = "/tmp/bulk-dir/"
@@ -952,6 +963,94 @@ class BulkDataTest(TestCase):
         """Can we successfully generate all bulk files?"""
         call_command("cl_make_bulk_data")
 
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_merge_shards(self):
+        """Do the items of every shard end up in their court's archive?"""
+        call_command("cl_make_bulk_data", shards=3)
+        path = os.path.join(self.tmp_data_dir, "opinions", "test.tar.gz")
+        with tarfile.open(path) as tar:
+            names = tar.getnames()
+        expected = Opinion.objects.filter(
+            cluster__docket__court_id="test"
+        ).values_list("pk", flat=True)
+        self.assertEqual(
+            sorted(names), sorted("%s.json" % pk for pk in expected)
+        )
+
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_old_json_files_are_removed(self):
+        """Are the JSON files that bulk data used to be made from cleaned
+        up?
+        """
+        tmp_dir = os.path.join(self.tmp_data_dir, "tmp")
+        court_dir = os.path.join(tmp_dir, "opinions", "test")
+        os.makedirs(court_dir)
+        open(os.path.join(court_dir, "1.json"), "w").close()
+        people_dir = os.path.join(tmp_dir, "people")
+        os.makedirs(people_dir)
+        open(os.path.join(people_dir, "1.json"), "w").close()
+
+        call_command("cl_make_bulk_data")
+        self.assertFalse(os.path.exists(court_dir))
+        self.assertEqual(
+            [f for f in os.listdir(people_dir) if f.endswith(".json")],
+            ["info.json"],
+        )
+
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_make_delta(self):
+        """Does the second run make a delta of what changed since the first?"""
+        call_command("cl_make_bulk_data")
+        deltas_dir = os.path.join(self.tmp_data_dir, "opinions", "deltas")
+        self.assertFalse(os.path.exists(deltas_dir))
+
+        changed, deleted = Opinion.objects.filter(
+            cluster=self.doc_cluster
+        ).order_by("pk")
+        changed.plain_text = u"Changed"
+        changed.save(index=False)
+        deleted_pk = deleted.pk
+        deleted.delete()
+        call_command("cl_make_bulk_data")
+
+        deltas = os.listdir(deltas_dir)
+        self.assertEqual(len(deltas), 1)
+        delta_dir = os.path.join(deltas_dir, deltas[0])
+        with tarfile.open(os.path.join(delta_dir, "test.tar.gz")) as tar:
+            self.assertEqual(tar.getnames(), ["%s.json" % changed.pk])
+        with open(os.path.join(delta_dir, "deleted.json")) as f:
+            self.assertEqual(json.load(f), [deleted_pk])
+
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_delta_has_items_made_during_export(self):
+        """Is an item made while the files are exported, then deleted before
+        the next run, in the next delta's deleted items?
+        """
+        export_in_shards = bulk_data.export_in_shards
+        made = []
+
+        def export_and_make_opinion(*args, **kwargs):
+            shards = export_in_shards(*args, **kwargs)
+            if args[0]["obj_class"] == Opinion and not made:
+                opinion = Opinion(cluster=self.doc_cluster, type="Dissent")
+                opinion.save(index=False)
+                made.append(opinion)
+            return shards
+
+        with mock.patch(
+            "cl.api.bulk_data.export_in_shards",
+            side_effect=export_and_make_opinion,
+        ):
+            call_command("cl_make_bulk_data")
+        made_pk = made[0].pk
+        made[0].delete()
+        call_command("cl_make_bulk_data")
+
+        deltas_dir = os.path.join(self.tmp_data_dir, "opinions", "deltas")
+        delta_dir = os.path.join(deltas_dir, os.listdir(deltas_dir)[0])
+        with open(os.path.join(delta_dir, "deleted.json")) as f:
+            self.assertEqual(json.load(f), [made_pk])
+
     def test_database_has_objects_for_bulk_export(self):
         self.assertTrue(Opinion.objects.count() > 0, "Opinions exist")
         self.assertTrue(OpinionsCited.objects.count() > 0, "Citations exist")
@@ -369,10 +369,14 @@ class BulkJsonHistory(object):
 
     {
       "last_good_date": ISO-Date,
+      "last_good_start": ISO-Date,
       "last_attempt: ISO-Date,
       "duration": seconds,
     }
 
+    The last_good_start is when the last good run began, so anything
+    modified after it might not be in the data it made.
+
     """
 
     def __init__(self, obj_type_str, bulk_dir):
@@ -415,6 +419,14 @@ class BulkJsonHistory(object):
         else:
             return parser.parse(d)
 
+    def get_last_good_start(self):
+        """Get the start of the last good run from the file, or return None."""
+        d = self.json.get("last_good_start", None)
+        if d is None:
+            return d
+        else:
+            return parser.parse(d)
+
     def get_last_attempt(self):
         """Get the last attempt from the file, or return None."""
         d = self.json.get("last_attempt", None)
@@ -432,6 +444,7 @@ class BulkJsonHistory(object):
         """Note a successful run."""
         n = now()
         self.json["last_good_date"] = n.isoformat()
+        self.json["last_good_start"] = self.json.get("last_attempt")
         try:
             duration = n - parser.parse(self.json["last_attempt"])
             self.json["duration"] = int(duration.total_seconds())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""A lookup index from citation strings to the clusters that have them.
+
+Most citations we look up are exact volume-reporter-page hits against the
+Citation table, so rather than asking Solr (or Postgres) every time, we keep
+a Redis hash mapping each citation string (e.g., "410 U.S. 113") to the few
+things we need to know about its clusters: their opinion IDs, court, date
+filed, precedential status and slug. The index is built in bulk with the
+cl_build_citation_index command and then kept up to date by signals as
+citations, clusters and opinions are saved and deleted.
+
+Lookups that miss the index or that are ambiguous fall back to the usual
+Solr heuristics or DB queries.
+"""
+import json
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+from django.db.models import Q
+
+from cl.lib.date_time import midnight_pst
+from cl.lib.redis_utils import make_redis_interface
+from cl.search.models import Citation, Opinion, OpinionCluster
+
+
+def get_index_key():
+    """Get the name of the Redis hash that holds the index.
+
+    The DB name is part of the key so that the test DB and the real one don't
+    share an index.
+    """
+    return "citation_index:%s" % settings.DATABASES["default"]["NAME"]
+
+
+def make_citation_key(volume, reporter, page):
+    """Make the key for a citation, in the same format as
+    search.models.Citation.__unicode__.
+    """
+    return u"%s %s %s" % (volume, reporter, page)
+
+
+def make_entries(citations):
+    """Make the index entries for citations from the database.
+
+    :param citations: An iterable of dicts with the volume, reporter, page and
+    cluster_id of search.models.Citation objects.
+    :return: A dict mapping citation keys to lists of entries, one per cluster
+    """
+    citations = list(citations)
+    cluster_ids = set(c["cluster_id"] for c in citations)
+    clusters = {
+        c["pk"]: c
+        for c in OpinionCluster.objects.filter(pk__in=cluster_ids).values(
+            "pk",
+            "date_filed",
+            "precedential_status",
+            "slug",
+            "docket__court_id",
+        )
+    }
+    opinion_ids = defaultdict(list)
+    for cluster_id, opinion_id in (
+        Opinion.objects.filter(cluster_id__in=cluster_ids)
+        .order_by("pk")
+        .values_list("cluster_id", "pk")
+    ):
+        opinion_ids[cluster_id].append(opinion_id)
+
+    entries = defaultdict(list)
+    for c in citations:
+        cluster = clusters.get(c["cluster_id"])
+        if cluster is None:
+            continue
+        date_filed = cluster["date_filed"]
+        entries[
+            make_citation_key(c["volume"], c["reporter"], c["page"])
+        ].append(
+            {
+                "cluster_id": cluster["pk"],
+                "opinion_ids": opinion_ids[cluster["pk"]],
+                "court_id": cluster["docket__court_id"],
+                "date_filed": date_filed.isoformat() if date_filed else None,
+                "precedential_status": cluster["precedential_status"],
+                "slug": cluster["slug"],
+            }
+        )
+    return entries
+
+
+def save_entries(entries, deleted_keys=(), r=None):
+    """Write entries to the index, removing any keys that no longer have
+    any.
+    """
+    if r is None:
+        r = make_redis_interface("CACHE")
+    index_key = get_index_key()
+    pipe = r.pipeline()
+    for key, key_entries in entries.items():
+        pipe.hset(index_key, key.encode("utf-8"), json.dumps(key_entries))
+    for key in deleted_keys:
+        if key not in entries:
+            pipe.hdel(index_key, key.encode("utf-8"))
+    pipe.execute()
+
+
+def update_citation_index(keys):
+    """Recompute the index entries for citation keys from the database.
+
+    :param keys: An iterable of (volume, reporter, page) tuples
+    """
+    keys = set(keys)
+    if not keys:
+        return
+    q = Q()
+    for volume, reporter, page in keys:
+        q |= Q(volume=volume, reporter=reporter, page=page)
+    citations = Citation.objects.filter(q).values(
+        "volume", "reporter", "page", "cluster_id"
+    )
+    save_entries(
+        make_entries(citations),
+        deleted_keys=[make_citation_key(*key) for key in keys],
+    )
+
+
+def update_citation_index_for_clusters(cluster_ids):
+    """Recompute the index entries for every citation of some clusters."""
+    update_citation_index(
+        Citation.objects.filter(cluster_id__in=cluster_ids).values_list(
+            "volume", "reporter", "page"
+        )
+    )
+
+
+def clear_citation_index():
+    """Remove everything from the index."""
+    r = make_redis_interface("CACHE")
+    r.delete(get_index_key())
+
+
+def lookup_citations(keys):
+    """Look up many citation keys in the index at once.
+
+    :param keys: A list of citation keys, as made by make_citation_key
+    :return: A dict mapping each key found in the index to its list of
+    entries. Keys that aren't in the index are omitted.
+    """
+    if not keys:
+        return {}
+    r = make_redis_interface("CACHE")
+    values = r.hmget(get_index_key(), [key.encode("utf-8") for key in keys])
+    return {
+        key: json.loads(value)
+        for key, value in zip(keys, values)
+        if value is not None
+    }
+
+
+def entries_to_results(entries):
+    """Convert index entries into results shaped like the ones we get from
+    the Solr opinion index, with one result per opinion.
+
+    Only precedential opinions are returned, as they're the only ones we
+    search for when matching citations.
+    """
+    results = []
+    for entry in entries:
+        if entry["precedential_status"] != "Published":
+            continue
+        date_filed = entry["date_filed"]
+        if date_filed:
+            # Do the same conversion that's done when indexing into Solr.
+            date_filed = solr_date_filed(date_filed)
+        for opinion_id in entry["opinion_ids"]:
+            results.append(
+                {
+                    "id": opinion_id,
+                    "cluster_id": entry["cluster_id"],
+                    "court_id": entry["court_id"],
+                    "dateFiled": date_filed,
+                }
+            )
+    return results
+
+
+def solr_date_filed(date_str):
+    """Convert an ISO date to the naive UTC datetime we get back from Solr
+    for the dateFiled field.
+    """
+    d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    return midnight_pst(d).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def lookup_citation_str(citation_str):
+    """Look up a citation string like "22 U.S. 44" in the index.
+
+    The string is parsed the same way as in the citation filter of
+    ClusterCitationQuerySet.
+
+    :return: The list of index entries for the citation, or an empty list if
+    it's not in the index or can't be parsed.
+    """
+    from cl.citations.find_citations import get_citations
+
+    citations = get_citations(
+        citation_str,
+        html=False,
+        do_post_citation=False,
+        do_defendant=False,
+        disambiguate=False,
+    )
+    if not citations:
+        return []
+    c = citations[0]
+    key = make_citation_key(c.volume, c.reporter, c.page)
+    return lookup_citations([key]).get(key, [])
@@ -0,0 +1,107 @@
+import re
+import time
+
+from juriscraper.lib.html_utils import get_visible_text
+from reporters_db import EDITIONS, VARIATIONS_ONLY
+
+from cl.citations.reporter_tokenizer import tokenize
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.search.models import Opinion
+
+# The reporter regex as it was built before it came from a trie: a flat
+# alternation of every reporter, longest first.
+OLD_REGEX_LIST = EDITIONS.keys() + VARIATIONS_ONLY.keys()
+OLD_REGEX_LIST.sort(key=len, reverse=True)
+OLD_REPORTER_RE = re.compile(
+    r"(^|\s)(%s)(\s|,)" % "|".join(map(re.escape, OLD_REGEX_LIST))
+)
+
+
+def old_tokenize(text):
+    """tokenize as it was before the trie regex and the set lookups."""
+    if re.match(r"\d+\-[A-Za-z]+\-\d+", text):
+        return text.split("-")
+    strings = OLD_REPORTER_RE.split(text)
+    words = []
+    for string in strings:
+        if string in EDITIONS.keys() + VARIATIONS_ONLY.keys():
+            words.append(string)
+        else:
+            text = " " + string + " "
+            text = re.sub(r"__+", "", text)
+            text = re.sub(" +", " ", text)
+            words.extend(text.strip().split())
+    return words
+
+
+def get_opinion_text(opinion):
+    """Get the text of an opinion the way get_document_citations does."""
+    for field in ("html_columbia", "html_lawbox", "html"):
+        if getattr(opinion, field):
+            return get_visible_text(getattr(opinion, field))
+    return opinion.plain_text
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time tokenizing the text of opinions from the DB for citation "
+        "finding, the way it used to be done and the way it's done now, and "
+        "check that they give the same tokens."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=200,
+            help="How many opinions to take from the DB.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        opinions = Opinion.objects.only(
+            "html_columbia", "html_lawbox", "html", "plain_text"
+        ).order_by("-pk")[: options["count"]]
+        texts = [get_opinion_text(opinion) for opinion in opinions]
+        texts = [text for text in texts if text]
+        if not texts:
+            logger.error("No opinions with text in the DB to benchmark.")
+            return
+
+        t1 = time.time()
+        expected = [old_tokenize(text) for text in texts]
+        old = time.time() - t1
+
+        t1 = time.time()
+        results = [tokenize(text) for text in texts]
+        new = time.time() - t1
+
+        tokens = sum(len(words) for words in expected)
+        logger.info(
+            "Tokenized %s opinions, %s tokens.",
+            len(texts),
+            tokens,
+        )
+        logger.info("method  seconds  tokens/sec  speedup")
+        for method, elapsed in (("old", old), ("new", new)):
+            logger.info(
+                "%-6s  %7.2f  %10.0f  %6.2fx",
+                method,
+                elapsed,
+                tokens / elapsed,
+                old / elapsed,
+            )
+
+        mismatches = sum(
+            1
+            for words, old_words in zip(results, expected)
+            if words != old_words
+        )
+        if mismatches:
+            logger.error(
+                "%s of %s opinions got different tokens than before.",
+                mismatches,
+                len(texts),
+            )
+        else:
+            logger.info("All %s opinions got the same tokens.", len(texts))
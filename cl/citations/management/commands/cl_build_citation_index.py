@@ -0,0 +1,55 @@
+from cl.citations.citation_index import (
+    clear_citation_index,
+    update_citation_index,
+)
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.db_tools import queryset_generator
+from cl.search.models import Citation
+
+
+class Command(VerboseCommand):
+    help = (
+        "Build the citation index that's used to look up exact citations "
+        "without hitting Solr or the DB. Once built, it's kept up to date "
+        "as items are saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            default=False,
+            help="Empty the index before building it.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="How many citations to index at a time.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        if options["clear"]:
+            logger.info("Clearing the citation index.")
+            clear_citation_index()
+
+        chunk_size = options["chunk_size"]
+        citations = queryset_generator(
+            Citation.objects.values("id", "volume", "reporter", "page"),
+            chunksize=chunk_size,
+        )
+        keys = set()
+        count = 0
+        for count, citation in enumerate(citations, start=1):
+            keys.add(
+                (citation["volume"], citation["reporter"], citation["page"])
+            )
+            if count % chunk_size == 0:
+                # Each key is recomputed in full from the DB, so it doesn't
+                # matter if its citations span several chunks.
+                update_citation_index(keys)
+                keys = set()
+                logger.info("Indexed %s citations.", count)
+        update_citation_index(keys)
+        logger.info("Done. Indexed %s citations.", count)
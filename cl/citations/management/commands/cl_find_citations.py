@@ -1,16 +1,51 @@
 # coding=utf-8
+import json
 import time
 import sys
+from multiprocessing import Pool, cpu_count
 
-from cl.citations.tasks import find_citations_for_opinion_by_pks
+from cl.citations.tasks import (
+    find_citations_for_opinion_by_pks,
+    get_document_citations,
+    match_opinion_citations,
+    store_citations_in_bulk,
+)
 from cl.lib import sunburnt
 from cl.lib.argparse_types import valid_date_time
 from cl.lib.celery_utils import CeleryThrottle
-from cl.lib.command_utils import VerboseCommand
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.crypto import sha1
+from cl.lib.redis_utils import make_redis_interface
+from cl.lib.timer import StageTimer
 from cl.search.models import Opinion
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management import CommandError
+from django.db import connections, transaction
+
+# The options that choose which opinions are processed.
+QUERY_OPTIONS = ("doc_id", "start_id", "end_id", "filed_after", "all")
+
+
+def get_checkpoint_key(options):
+    """Get the Redis key where the pipeline records the last opinion it
+    finished, so it can resume.
+
+    The key is particular to the DB and to the opinions being processed, so a
+    run can only be resumed by one that processes the same opinions.
+    """
+    query = json.dumps(
+        [options.get(option) for option in QUERY_OPTIONS], default=str
+    )
+    return "citation-finder-last-pk:%s:%s" % (
+        settings.DATABASES["default"]["NAME"],
+        sha1(query),
+    )
+
+
+def extract_citations(opinion):
+    """Find the citations in an opinion. Runs in the process pool."""
+    return get_document_citations(opinion)
 
 
 class Command(VerboseCommand):
@@ -79,6 +114,38 @@ class Command(VerboseCommand):
             default="batch1",
             help="The celery queue where the tasks should be processed.",
         )
+        parser.add_argument(
+            "--pipeline",
+            action="store_true",
+            default=False,
+            help="Instead of sending tasks to celery, process the opinions "
+            "here in stages: citations are extracted in a process pool, "
+            "matched in batches and written to the DB one chunk at a "
+            "time. Progress is checkpointed so that the run can be "
+            "resumed with --resume, and the throughput of each stage is "
+            "logged.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="With --pipeline, skip the opinions that were completed by "
+            "the last run.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=cpu_count(),
+            help="With --pipeline, the number of processes to use for "
+            "citation extraction. With fewer than two, citations are "
+            "extracted in this process.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=100,
+            help="The number of opinions to process at a time.",
+        )
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
@@ -120,14 +187,31 @@ class Command(VerboseCommand):
             )
         if options.get("all"):
             query = Opinion.objects.all()
+        self.checkpoint_key = get_checkpoint_key(options)
+        if options["pipeline"]:
+            query = query.order_by("pk")
+            if options["resume"]:
+                last_pk = make_redis_interface("CACHE").get(
+                    self.checkpoint_key
+                )
+                if last_pk is not None:
+                    logger.info("Resuming after opinion %s", last_pk)
+                    query = query.filter(pk__gt=int(last_pk))
         self.count = query.count()
         self.average_per_s = 0
         self.timings = []
         opinion_pks = query.values_list("pk", flat=True).iterator()
-        self.update_documents(opinion_pks, options["queue"])
+        if options["pipeline"]:
+            self.run_pipeline(
+                opinion_pks, options["processes"], options["chunk_size"]
+            )
+        else:
+            self.update_documents(
+                opinion_pks, options["queue"], options["chunk_size"]
+            )
         self.add_to_solr(options["queue"])
 
-    def log_progress(self, processed_count, last_pk):
+    def log_progress(self, processed_count, last_pk, label):
         if processed_count % 1000 == 1:
             self.t1 = time.time()
         if processed_count % 1000 == 0:
@@ -136,12 +220,10 @@ class Command(VerboseCommand):
             self.average_per_s = 1000 / (
                 sum(self.timings) / float(len(self.timings))
             )
-        template = (
-            "\rProcessing items in Celery queue: {:.0%} ({}/{}, "
-            "{:.1f}/s, Last id: {})"
-        )
+        template = "\r{}: {:.0%} ({}/{}, {:.1f}/s, Last id: {})"
         sys.stdout.write(
             template.format(
+                label,
                 float(processed_count) / self.count,  # Percent
                 processed_count,
                 self.count,
@@ -151,7 +233,7 @@ class Command(VerboseCommand):
         )
         sys.stdout.flush()
 
-    def update_documents(self, opinion_pks, queue_name):
+    def update_documents(self, opinion_pks, queue_name, chunk_size):
         sys.stdout.write("Graph size is {0:d} nodes.\n".format(self.count))
         sys.stdout.flush()
 
@@ -160,7 +242,6 @@ class Command(VerboseCommand):
             index_during_subtask = True
 
         chunk = []
-        chunk_size = 100
         processed_count = 0
         throttle = CeleryThrottle(queue_name=queue_name)
         for opinion_pk in opinion_pks:
@@ -175,7 +256,105 @@ class Command(VerboseCommand):
                 )
                 chunk = []
 
-            self.log_progress(processed_count, opinion_pk)
+            self.log_progress(
+                processed_count, opinion_pk, "Processing items in Celery queue"
+            )
+
+    def run_pipeline(self, opinion_pks, processes, chunk_size):
+        """Find citations in stages, in this process.
+
+        Citations for the next chunk are extracted by the process pool while
+        the current chunk is matched and saved. A chunk's writes are done in
+        a single transaction, after which the checkpoint is moved past it.
+        """
+        sys.stdout.write("Graph size is {0:d} nodes.\n".format(self.count))
+        sys.stdout.flush()
+        index = self.index == "concurrently"
+        r = make_redis_interface("CACHE")
+        timer = StageTimer()
+
+        def chunks():
+            chunk = []
+            for opinion_pk in opinion_pks:
+                chunk.append(opinion_pk)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def start_extraction(chunk):
+            with timer.time("fetch", count=len(chunk)):
+                opinions = list(
+                    Opinion.objects.filter(pk__in=chunk)
+                    .select_related("cluster")
+                    .order_by("pk")
+                )
+            if pool is None:
+                citations = [extract_citations(o) for o in opinions]
+                return opinions, lambda: citations
+            return opinions, pool.map_async(extract_citations, opinions).get
+
+        pool = None
+        if processes > 1:
+            # Don't share DB connections with the forked processes.
+            connections.close_all()
+            pool = Pool(processes=processes)
+        processed_count = 0
+        try:
+            pending = None
+            for chunk in chunks():
+                next_pending = start_extraction(chunk)
+                if pending is not None:
+                    processed_count = self.finish_chunk(
+                        pending, index, timer, r, processed_count
+                    )
+                pending = next_pending
+            if pending is not None:
+                processed_count = self.finish_chunk(
+                    pending, index, timer, r, processed_count
+                )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        # Done, so there's nothing to resume.
+        r.delete(self.checkpoint_key)
+        logger.info(
+            "Finished %s opinions. %s", processed_count, timer.summary()
+        )
+
+    def finish_chunk(self, pending, index, timer, r, processed_count):
+        """Wait for a chunk's citations to be extracted, then match them and
+        save them.
+
+        :return: The number of opinions processed so far
+        """
+        opinions, get_citations = pending
+        if not opinions:
+            return processed_count
+        with timer.time("extract", count=len(opinions)):
+            all_citations = get_citations()
+        opinions_with_citations = [
+            (opinion, citations)
+            for opinion, citations in zip(opinions, all_citations)
+            if citations
+        ]
+        with timer.time("match", count=len(opinions_with_citations)):
+            matched_opinions = match_opinion_citations(opinions_with_citations)
+        with timer.time("save", count=len(matched_opinions)):
+            with transaction.atomic():
+                store_citations_in_bulk(matched_opinions, index)
+        r.set(self.checkpoint_key, opinions[-1].pk)
+
+        for opinion in opinions:
+            processed_count += 1
+            self.log_progress(
+                processed_count, opinion.pk, "Processing items in pipeline"
+            )
+            if processed_count % 1000 == 0:
+                logger.info("\n%s", timer.summary())
+        return processed_count
 
     def add_to_solr(self, queue_name):
         if self.index == "all-at-end":
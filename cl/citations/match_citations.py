@@ -1,17 +1,20 @@
 #!/usr/bin/env python
 # encoding utf-8
-
+import re
+import threading
 from datetime import date, datetime
 
 from django.conf import settings
 from reporters_db import REPORTERS
 
+from cl.citations.citation_index import entries_to_results, lookup_citations
 from cl.citations.find_citations import strip_punct
 from cl.citations.models import (
     SupraCitation,
     ShortformCitation,
     IdCitation,
     NonopinionCitation,
+    FullCitation,
 )
 from cl.lib import sunburnt
 from cl.search.models import Opinion
@@ -21,6 +24,33 @@ DEBUG = True
 
 QUERY_LENGTH = 10
 
+# How many distinct citations to OR together in a single Solr query when
+# matching citations in bulk, and how many rows to request per page of
+# results for such a query.
+BULK_QUERY_SIZE = 50
+BULK_QUERY_ROWS = 500
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_local = threading.local()
+
+
+def get_solr_connection():
+    """Get a read-only Solr connection to the opinion index.
+
+    Creating a SolrInterface fetches the schema from Solr and sets up a new
+    HTTP connection, so we do that once per thread and then reuse it (and its
+    keep-alive connection) for every query.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    # Key by URL so that changes to the setting (e.g., in tests) are honored.
+    url = settings.SOLR_OPINION_URL
+    if url not in conns:
+        conns[url] = sunburnt.SolrInterface(url, mode="r")
+    return conns[url]
+
 
 def build_date_range(start_year, end_year):
     """Build a date range to be handed off to a solr query."""
@@ -100,15 +130,18 @@ def get_years_from_reporter(citation):
     return start_year, end_year
 
 
-def match_citation(citation, citing_doc=None):
-    """For a citation object, try to match it to an item in the database using
-    a variety of heuristics.
+def get_years_for_filter(citation, citing_doc=None):
+    """Get the range of years in which a citation's match must be filed."""
+    if citation.year:
+        return citation.year, citation.year
+    start_year, end_year = get_years_from_reporter(citation)
+    if citing_doc is not None and citing_doc.cluster.date_filed:
+        end_year = min(end_year, citing_doc.cluster.date_filed.year)
+    return start_year, end_year
 
-    Returns:
-      - a Solr Result object with the results, or an empty list if no hits
-    """
-    # TODO: Create shared solr connection for all queries
-    conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode="r")
+
+def make_match_params(citation, citing_doc=None):
+    """Make the Solr parameters used to match a single citation."""
     main_params = {
         "q": "*",
         "fq": [
@@ -120,12 +153,7 @@ def match_citation(citation, citing_doc=None):
         # Eliminate self-cites.
         main_params["fq"].append("-id:%s" % citing_doc.pk)
     # Set up filter parameters
-    if citation.year:
-        start_year = end_year = citation.year
-    else:
-        start_year, end_year = get_years_from_reporter(citation)
-        if citing_doc is not None and citing_doc.cluster.date_filed:
-            end_year = min(end_year, citing_doc.cluster.date_filed.year)
+    start_year, end_year = get_years_for_filter(citation, citing_doc)
     main_params["fq"].append(
         "dateFiled:%s" % build_date_range(start_year, end_year)
     )
@@ -135,12 +163,23 @@ def match_citation(citation, citing_doc=None):
 
     # Take 1: Use a phrase query to search the citation field.
     main_params["fq"].append('citation:("%s")' % citation.base_citation())
-    results = conn.raw_query(**main_params).execute()
+    return main_params
+
+
+def refine_results(conn, results, citation, citing_doc=None):
+    """Narrow down a set of citation lookup results, as needed.
+
+    Returns:
+      - the results if there is exactly one, refined results if there are
+        several and we have a defendant to go on, or an empty list if there
+        are none.
+    """
     if len(results) == 1:
         return results
     if len(results) > 1:
         if citing_doc is not None and citation.defendant:
             # Refine using defendant, if there is one
+            main_params = make_match_params(citation, citing_doc)
             results = case_name_query(conn, main_params, citation, citing_doc)
         return results
 
@@ -148,14 +187,227 @@ def match_citation(citation, citing_doc=None):
     return []
 
 
-def get_citation_matches(citing_opinion, citations):
+def match_citation(citation, citing_doc=None, conn=None):
+    """For a citation object, try to match it to an item in the database using
+    a variety of heuristics.
+
+    Returns:
+      - a Solr Result object with the results, or an empty list if no hits
+    """
+    index_match = match_with_index([(citation, citing_doc)])[0]
+    if index_match is not None:
+        return index_match
+
+    if conn is None:
+        conn = get_solr_connection()
+    main_params = make_match_params(citation, citing_doc)
+    results = conn.raw_query(**main_params).execute()
+    return refine_results(conn, results, citation, citing_doc)
+
+
+def match_with_index(citation_pairs):
+    """Try to match citations with the citation index, without using Solr.
+
+    :param citation_pairs: A list of (citation, citing_doc) tuples, where
+    citing_doc may be None.
+    :return: A list with one item per pair. The item is a list holding the
+    single matching result if the index had an exact, unambiguous match,
+    or None if the citation needs to be looked up in Solr instead.
+    """
+    entries_by_cite = lookup_citations(
+        list(set(citation.base_citation() for citation, _ in citation_pairs))
+    )
+    matches = []
+    for citation, citing_doc in citation_pairs:
+        entries = entries_by_cite.get(citation.base_citation())
+        if entries is None:
+            matches.append(None)
+            continue
+        results = [
+            result
+            for result in entries_to_results(entries)
+            if is_result_in_filters(result, citation, citing_doc)
+        ]
+        matches.append(results if len(results) == 1 else None)
+    return matches
+
+
+def tokenize_citation(citation_str):
+    """Split a citation string into lowercase word tokens, roughly the way
+    Solr analyzes the citation field.
+    """
+    return tuple(WORD_RE.findall(citation_str.lower()))
+
+
+def has_citation(result, tokens):
+    """Does a Solr result have a citation containing the phrase in tokens?"""
+    n = len(tokens)
+    for citation_str in result.get("citation", ()):
+        result_tokens = tokenize_citation(citation_str)
+        for i in xrange(len(result_tokens) - n + 1):
+            if result_tokens[i : i + n] == tokens:
+                return True
+    return False
+
+
+def is_result_in_filters(result, citation, citing_doc=None):
+    """Apply the filters of make_match_params to a Solr result in memory.
+
+    This lets one broad query serve many citations from many citing
+    documents.
+    """
+    if citing_doc is not None and result["id"] == citing_doc.pk:
+        # Self-cite.
+        return False
+    start_year, end_year = get_years_for_filter(citation, citing_doc)
+    date_filed = result.get("dateFiled")
+    if date_filed is None:
+        return False
+    # Same bounds as build_date_range
+    if not (
+        datetime(start_year, 1, 1) <= date_filed <= datetime(end_year, 12, 31)
+    ):
+        return False
+    if citation.court and result.get("court_id") != citation.court:
+        return False
+    return True
+
+
+def query_base_citations(conn, base_citations):
+    """Look up many citation strings in Solr with a few OR'd queries.
+
+    :param conn: A read-only Solr connection to the opinion index
+    :param base_citations: An iterable of citation strings, as made by
+    Citation.base_citation()
+    :return: A dict mapping each citation string to a list of the Solr
+    results for precedential opinions that have that citation.
+    """
+    base_citations = sorted(set(base_citations))
+    results_by_cite = {cite: [] for cite in base_citations}
+    for i in xrange(0, len(base_citations), BULK_QUERY_SIZE):
+        chunk = base_citations[i : i + BULK_QUERY_SIZE]
+        params = {
+            "q": "*",
+            "fq": [
+                "status:Precedential",
+                " OR ".join('citation:("%s")' % cite for cite in chunk),
+            ],
+            "fl": "id,citation,court_id,dateFiled,caseName",
+            "rows": BULK_QUERY_ROWS,
+            "caller": "citation.match_citations.query_base_citations",
+        }
+        tokens_by_cite = {cite: tokenize_citation(cite) for cite in chunk}
+        start = 0
+        while True:
+            params["start"] = start
+            response = conn.raw_query(**params).execute()
+            for result in response:
+                for cite, tokens in tokens_by_cite.items():
+                    if has_citation(result, tokens):
+                        results_by_cite[cite].append(result)
+            start += len(response)
+            if len(response) == 0 or start >= response.result.numFound:
+                break
+    return results_by_cite
+
+
+def match_citations_in_bulk(citation_pairs, conn=None):
+    """Match many full citations, possibly from many citing documents, at
+    once.
+
+    Rather than doing one or two Solr queries per citation, as in
+    match_citation, this deduplicates the citations and looks them all up
+    with a handful of OR'd queries. The per-citation filters (dates, court,
+    self-cites) are then applied in memory. Only citations that have several
+    hits and need their case name checked go back to Solr individually.
+
+    Citations that have an exact, unambiguous match in the citation index
+    don't go to Solr at all.
+
+    :param citation_pairs: A list of (citation, citing_doc) tuples, where
+    citing_doc may be None.
+    :param conn: A read-only Solr connection. If None, the shared one is used.
+    :return: A list with one item per pair, which is the same thing that
+    match_citation would return for that pair.
+    """
+    index_matches = match_with_index(citation_pairs)
+    solr_cites = [
+        citation.base_citation()
+        for (citation, _), index_match in zip(citation_pairs, index_matches)
+        if index_match is None
+    ]
+    if not solr_cites:
+        return index_matches
+
+    if conn is None:
+        conn = get_solr_connection()
+    results_by_cite = query_base_citations(conn, solr_cites)
+    matches = []
+    for (citation, citing_doc), index_match in zip(
+        citation_pairs, index_matches
+    ):
+        if index_match is not None:
+            matches.append(index_match)
+            continue
+        results = [
+            result
+            for result in results_by_cite[citation.base_citation()]
+            if is_result_in_filters(result, citation, citing_doc)
+        ]
+        matches.append(refine_results(conn, results, citation, citing_doc))
+    return matches
+
+
+def get_full_citation_matches(citation_pairs, conn=None):
+    """Resolve the full citations in a list of (citation, citing_doc) tuples
+    to Opinion objects in bulk.
+
+    :return: A dict mapping the id() of each full citation that has a single
+    match to the matched Opinion object.
+    """
+    citation_pairs = [
+        (citation, citing_doc)
+        for citation, citing_doc in citation_pairs
+        if isinstance(citation, FullCitation)
+    ]
+    if not citation_pairs:
+        return {}
+    all_matches = match_citations_in_bulk(citation_pairs, conn=conn)
+    match_ids = {}
+    for (citation, _), matches in zip(citation_pairs, all_matches):
+        if len(matches) == 1:
+            match_ids[id(citation)] = matches[0]["id"]
+    opinions = Opinion.objects.select_related("cluster").in_bulk(
+        set(match_ids.values())
+    )
+    return {
+        citation_id: opinions[opinion_id]
+        for citation_id, opinion_id in match_ids.items()
+        if opinion_id in opinions
+    }
+
+
+def get_citation_matches(
+    citing_opinion, citations, full_citation_matches=None
+):
     """For a list of Citation objects (e.g., FullCitations, SupraCitations,
     IdCitations, etc.), try to match them to Opinion objects in the database
     using a variety of heuristics.
 
+    :param citing_opinion: The Opinion the citations were found in.
+    :param citations: The Citation objects to match.
+    :param full_citation_matches: The output of get_full_citation_matches, if
+    the full citations were already matched in bulk (for example, together
+    with those of other opinions). If None, they're matched here.
+
     Returns:
       - a list of Opinion objects, as matched to citations
     """
+    if full_citation_matches is None:
+        full_citation_matches = get_full_citation_matches(
+            [(citation, citing_opinion) for citation in citations]
+        )
+
     citation_matches = []  # List of matches to return
     was_matched = False  # Whether the previous citation match was successful
 
@@ -235,21 +487,7 @@ def get_citation_matches(citing_opinion, citations):
         # Otherwise, the citation is just a regular citation, so try to match
         # it directly to an opinion
         else:
-            matches = match_citation(citation, citing_doc=citing_opinion)
-
-            if len(matches) == 1:
-                match_id = matches[0]["id"]
-                try:
-                    matched_opinion = Opinion.objects.get(pk=match_id)
-                except Opinion.DoesNotExist:
-                    # No Opinions returned. Press on.
-                    pass
-                except Opinion.MultipleObjectsReturned:
-                    # Multiple Opinions returned. Press on.
-                    pass
-            else:
-                # No match found for citation
-                pass
+            matched_opinion = full_citation_matches.get(id(citation))
 
         # If an opinion was successfully matched, add it to the list and
         # set the match fields on the original citation object so that they
@@ -2,15 +2,26 @@
 # encoding: utf-8
 import re
 
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
 from reporters_db import REPORTERS
+
+from cl.citations.citation_index import (
+    update_citation_index,
+    update_citation_index_for_clusters,
+)
 from cl.citations.utils import map_reporter_db_cite_type
-from cl.search.models import Citation as ModelCitation
+from cl.search.models import Citation as ModelCitation, Opinion, OpinionCluster
 
 """
 The classes in this module are not proper Django models; rather, they are just
 convenience classes to help with citation extraction. None of these objects are
 actually backed in the database; they just help with structuring and parsing
 citation information and are discarded after use.
+
+The signal receivers at the bottom keep the citation index (see
+citation_index.py) in sync with the database.
 """
 
 
@@ -458,3 +469,108 @@ class NonopinionCitation(object):
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+# The fields that go into the citation index. When they change, the index
+# needs updating.
+INDEXED_CITATION_FIELDS = ("volume", "reporter", "page")
+INDEXED_CLUSTER_FIELDS = (
+    "date_filed",
+    "precedential_status",
+    "slug",
+    "docket_id",
+)
+NOT_LOADED = object()
+
+
+def get_loaded_values(instance, fields):
+    # Read the fields from __dict__, so deferred ones aren't fetched.
+    return tuple(instance.__dict__.get(field, NOT_LOADED) for field in fields)
+
+
+@receiver(post_init, sender=ModelCitation)
+def note_old_citation_key(sender, instance=None, **kwargs):
+    """Remember what a citation was loaded as, so we can tell whether saving
+    it changes the index, and update its old entry if so.
+    """
+    instance._old_index_key = get_loaded_values(
+        instance, INDEXED_CITATION_FIELDS
+    )
+
+
+@receiver(post_init, sender=OpinionCluster)
+def note_old_cluster_values(sender, instance=None, **kwargs):
+    instance._old_index_values = get_loaded_values(
+        instance, INDEXED_CLUSTER_FIELDS
+    )
+
+
+@receiver(post_save, sender=ModelCitation)
+def update_index_for_saved_citation(
+    sender, instance=None, created=False, raw=False, **kwargs
+):
+    if raw:
+        return
+    key = get_loaded_values(instance, INDEXED_CITATION_FIELDS)
+    old_key = instance._old_index_key
+    instance._old_index_key = key
+    if not created and key == old_key:
+        return
+    update_index_for_citation_keys(instance, [key, old_key])
+
+
+@receiver(post_delete, sender=ModelCitation)
+def update_index_for_deleted_citation(sender, instance=None, **kwargs):
+    key = get_loaded_values(instance, INDEXED_CITATION_FIELDS)
+    update_index_for_citation_keys(instance, [key])
+
+
+def update_index_for_citation_keys(citation, keys):
+    """Update the index for some keys of a citation once the transaction
+    commits, or for its whole cluster if some of them weren't loaded.
+    """
+    if any(NOT_LOADED in key for key in keys):
+        cluster_id = citation.cluster_id
+        transaction.on_commit(
+            lambda: update_citation_index_for_clusters([cluster_id])
+        )
+    else:
+        transaction.on_commit(lambda: update_citation_index(keys))
+
+
+@receiver(post_save, sender=OpinionCluster)
+def update_index_for_cluster(
+    sender, instance=None, created=False, raw=False, **kwargs
+):
+    values = get_loaded_values(instance, INDEXED_CLUSTER_FIELDS)
+    old_values = instance._old_index_values
+    instance._old_index_values = values
+    if raw or created or values == old_values:
+        # New clusters don't have citations yet.
+        return
+    cluster_id = instance.pk
+    transaction.on_commit(
+        lambda: update_citation_index_for_clusters([cluster_id])
+    )
+
+
+@receiver(post_save, sender=Opinion)
+def update_index_for_saved_opinion(
+    sender, instance=None, created=False, raw=False, **kwargs
+):
+    if raw or not created:
+        # Only new opinions change the opinions of a cluster, and opinions
+        # are saved often (e.g., by the citation finder).
+        return
+    cluster_id = instance.cluster_id
+    transaction.on_commit(
+        lambda: update_citation_index_for_clusters([cluster_id])
+    )
+
+
+@receiver(post_delete, sender=Opinion)
+def update_index_for_deleted_opinion(sender, instance=None, **kwargs):
+    cluster_id = instance.cluster_id
+    transaction.on_commit(
+        lambda: update_citation_index_for_clusters([cluster_id])
+    )
@@ -8,13 +8,79 @@ import re
 
 from reporters_db import EDITIONS, VARIATIONS_ONLY
 
-# We need to build a REGEX that has all the variations and the reporters in
-# order from longest to shortest.
-REGEX_LIST = EDITIONS.keys() + VARIATIONS_ONLY.keys()
-REGEX_LIST.sort(key=len, reverse=True)
-REGEX_STR = "|".join(map(re.escape, REGEX_LIST))
+# All of the reporter strings we know about, as a set so that membership
+# tests are O(1) instead of scanning a list of several thousand strings.
+REPORTER_STRINGS = frozenset(EDITIONS.keys()) | frozenset(
+    VARIATIONS_ONLY.keys()
+)
+
+
+def make_trie(strings):
+    """Build a character trie from a collection of strings.
+
+    Each node is a dict mapping a character to its child node. The empty
+    string key marks that a complete string ends at that node.
+    """
+    trie = {}
+    for s in strings:
+        node = trie
+        for char in s:
+            node = node.setdefault(char, {})
+        node[""] = True
+    return trie
+
+
+def trie_to_regex(node):
+    """Convert a trie made by make_trie into an equivalent regex pattern.
+
+    A regex made of a flat alternation of thousands of reporters makes the
+    regex engine try every alternative at every position in the text. A
+    pattern built from a trie shares common prefixes, so the engine only
+    walks down branches that can still match.
+
+    Children are tried before the end of a string, so that (like the old
+    longest-first alternation) the longest reporter that can match wins,
+    falling back to shorter ones only if the rest of the pattern fails.
+    """
+    ends_here = "" in node
+    branches = []
+    singles = []
+    for char in sorted(k for k in node.keys() if k):
+        child = node[char]
+        if len(child) == 1 and "" in child:
+            # Leaf. Collect these into a character class below.
+            singles.append(char)
+        else:
+            branches.append(re.escape(char) + trie_to_regex(child))
+
+    if singles:
+        if len(singles) == 1:
+            branches.append(re.escape(singles[0]))
+        else:
+            branches.append(
+                "[%s]" % "".join(re.escape(char) for char in singles)
+            )
+
+    if not branches:
+        return ""
+
+    if len(branches) == 1 and not ends_here:
+        return branches[0]
+
+    pattern = "(?:%s)" % "|".join(branches)
+    if ends_here:
+        pattern += "?"
+    return pattern
+
+
+# A single regex, compiled once at import, that matches any of the reporters
+# and their variations, preferring the longest possible reporter.
+REGEX_STR = trie_to_regex(make_trie(REPORTER_STRINGS))
 REPORTER_RE = re.compile(r"(^|\s)(%s)(\s|,)" % REGEX_STR)
 
+CORNER_CASE_RE = re.compile(r"\d+\-[A-Za-z]+\-\d+")
+UNDERSCORES_RE = re.compile(r"__+")
+
 
 def normalize_variation(string):
     """Gets the best possible canonicalization of a variant spelling of a
@@ -24,7 +90,7 @@ def normalize_variation(string):
     which is best. Usually, this can be accomplished using the year of the
     item.
     """
-    if string in VARIATIONS_ONLY.keys():
+    if string in VARIATIONS_ONLY:
         if len(VARIATIONS_ONLY[string]) == 1:
             # Simple case
             return VARIATIONS_ONLY[string][0]
@@ -53,13 +119,13 @@ def tokenize(text):
     """
     # if the text looks likes the corner-case 'digit-REPORTER-digit', splitting
     # by spaces doesn't work
-    if re.match("\d+\-[A-Za-z]+\-\d+", text):
+    if CORNER_CASE_RE.match(text):
         return text.split("-")
     # otherwise, we just split on spaces to find words
     strings = REPORTER_RE.split(text)
     words = []
     for string in strings:
-        if string in EDITIONS.keys() + VARIATIONS_ONLY.keys():
+        if string in REPORTER_STRINGS:
             words.append(string)
         else:
             # Normalize spaces
@@ -68,17 +134,9 @@ def tokenize(text):
 
 
 def _tokenize(text):
-    # add extra space to make things easier
-    text = " " + text + " "
-
-    # get rid of all the annoying underscores in text from pdfs
-    text = re.sub(r"__+", "", text)
-
-    # reduce excess whitespace
-    text = re.sub(" +", " ", text)
-    text = text.strip()
-
-    return text.split()
+    # get rid of all the annoying underscores in text from pdfs, then split
+    # on (and thus normalize) whitespace
+    return UNDERSCORES_RE.sub("", text).split()
 
 
 if __name__ == "__main__":
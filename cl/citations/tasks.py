@@ -1,7 +1,8 @@
 import re
 from httplib import ResponseNotReady
-from collections import Counter
+from collections import Counter, defaultdict
 
+from django.db import transaction
 from django.db.models import F
 
 from cl.celery import app
@@ -101,6 +102,157 @@ def create_cited_html(opinion, citations):
     return new_html.encode("utf-8")
 
 
+def match_opinion_citations(opinions_with_citations):
+    """Match the citations of many opinions to Opinion objects at once.
+
+    Full citations are matched in bulk across all of the opinions, which
+    needs far fewer Solr queries than matching them opinion by opinion.
+
+    :param opinions_with_citations: A list of (opinion, citations) tuples, as
+    made by get_document_citations.
+    :return: A list of (opinion, citations, citation_matches) tuples.
+    """
+    full_citation_matches = match_citations.get_full_citation_matches(
+        [
+            (citation, opinion)
+            for opinion, citations in opinions_with_citations
+            for citation in citations
+        ]
+    )
+    return [
+        (
+            opinion,
+            citations,
+            match_citations.get_citation_matches(
+                opinion, citations, full_citation_matches
+            ),
+        )
+        for opinion, citations in opinions_with_citations
+    ]
+
+
+def store_citations_in_bulk(matched_opinions, index):
+    """Save the citations of many opinions and their matches to the DB.
+
+    Rather than deleting every OpinionsCited row for the citing opinions and
+    creating them anew, this compares the existing rows to the new matches,
+    and only inserts, deletes or updates the depth of the rows that changed.
+    The resulting changes to citation counts are added up for the whole batch
+    and applied with one update per distinct adjustment. Opinions whose
+    citations and HTML haven't changed aren't saved at all, so re-running
+    the citation finder on unchanged opinions is nearly free.
+
+    :param matched_opinions: A list of (opinion, citations, citation_matches)
+    tuples, as made by match_opinion_citations.
+    :param index: Whether to update the Solr index with the changes
+    :return: None
+    """
+    citing_pks = [opinion.pk for opinion, _, _ in matched_opinions]
+    # Map each citing opinion to its existing rows, as
+    # {cited opinion pk: (row pk, depth, cited cluster pk)}
+    existing_edges = defaultdict(dict)
+    for (
+        pk,
+        citing_pk,
+        cited_pk,
+        depth,
+        cited_cluster_pk,
+    ) in OpinionsCited.objects.filter(
+        citing_opinion_id__in=citing_pks
+    ).values_list(
+        "pk",
+        "citing_opinion_id",
+        "cited_opinion_id",
+        "depth",
+        "cited_opinion__cluster_id",
+    ):
+        existing_edges[citing_pk][cited_pk] = (pk, depth, cited_cluster_pk)
+
+    edges_to_create = []
+    edge_pks_to_delete = []
+    edge_pks_by_new_depth = defaultdict(list)
+    cluster_adjustments = Counter()
+    changed_opinion_pks = []
+    for opinion, citations, citation_matches in matched_opinions:
+        # Consolidate duplicate matches, keeping a counter of how often each
+        # match appears (so we know how many times an opinion cites another).
+        # keys = cited opinion pk
+        # values = number of times that opinion is cited
+        new_depths = Counter(m.pk for m in citation_matches)
+        new_clusters = set(m.cluster_id for m in citation_matches)
+        old_edges = existing_edges[opinion.pk]
+        old_clusters = set(c for _, _, c in old_edges.values())
+
+        for cited_pk, depth in new_depths.items():
+            if cited_pk not in old_edges:
+                edges_to_create.append(
+                    OpinionsCited(
+                        citing_opinion_id=opinion.pk,
+                        cited_opinion_id=cited_pk,
+                        depth=depth,
+                    )
+                )
+            elif old_edges[cited_pk][1] != depth:
+                edge_pks_by_new_depth[depth].append(old_edges[cited_pk][0])
+        for cited_pk, (pk, _, _) in old_edges.items():
+            if cited_pk not in new_depths:
+                edge_pks_to_delete.append(pk)
+
+        # A cluster's citation count goes up by one for each opinion that
+        # newly cites it, and down by one for each that no longer does.
+        for cluster_pk in new_clusters - old_clusters:
+            cluster_adjustments[cluster_pk] += 1
+        for cluster_pk in old_clusters - new_clusters:
+            cluster_adjustments[cluster_pk] -= 1
+
+        # Generate the citing opinion's new HTML (with inline citation links)
+        new_html = create_cited_html(opinion, citations)
+        edges_changed = new_depths != Counter(
+            {cited_pk: depth for cited_pk, (_, depth, _) in old_edges.items()}
+        )
+        if (
+            edges_changed
+            or new_html.decode("utf-8") != opinion.html_with_citations
+        ):
+            opinion.html_with_citations = new_html
+            opinion.save(index=False)
+            changed_opinion_pks.append(opinion.pk)
+
+    OpinionsCited.objects.filter(pk__in=edge_pks_to_delete).delete()
+    for depth, pks in edge_pks_by_new_depth.items():
+        OpinionsCited.objects.filter(pk__in=pks).update(depth=depth)
+    OpinionsCited.objects.bulk_create(edges_to_create)
+
+    # Apply the citation count changes, with one query per distinct change.
+    clusters_by_adjustment = defaultdict(list)
+    for cluster_pk, adjustment in cluster_adjustments.items():
+        if adjustment:
+            clusters_by_adjustment[adjustment].append(cluster_pk)
+    for adjustment, cluster_pks in clusters_by_adjustment.items():
+        OpinionCluster.objects.filter(pk__in=cluster_pks).update(
+            citation_count=F("citation_count") + adjustment
+        )
+
+    if index:
+        updated_cluster_pks = [
+            pk for pks in clusters_by_adjustment.values() for pk in pks
+        ]
+        # Don't let Solr see the changes before they're committed, or at all
+        # if they're rolled back.
+        if updated_cluster_pks:
+            transaction.on_commit(
+                lambda: add_items_to_solr.delay(
+                    updated_cluster_pks, "search.OpinionCluster"
+                )
+            )
+        if changed_opinion_pks:
+            transaction.on_commit(
+                lambda: add_items_to_solr.delay(
+                    changed_opinion_pks, "search.Opinion"
+                )
+            )
+
+
 @app.task(bind=True, max_retries=5, ignore_result=True)
 def find_citations_for_opinion_by_pks(self, opinion_pks, index=True):
     """Find citations for search.Opinion objects.
@@ -110,6 +262,7 @@ def find_citations_for_opinion_by_pks(self, opinion_pks, index=True):
     :return: None
     """
     opinions = Opinion.objects.filter(pk__in=opinion_pks)
+    opinions_with_citations = []
     for opinion in opinions:
         # Returns a list of Citation objects, i.e., something like
         # [FullCitation, FullCitation, ShortformCitation, FullCitation,
@@ -119,71 +272,14 @@ def find_citations_for_opinion_by_pks(self, opinion_pks, index=True):
         # If no citations are found, continue
         if not citations:
             continue
+        opinions_with_citations.append((opinion, citations))
 
-        # Match all those different Citation objects to Opinion objects, using
-        # a variety of hueristics.
-        try:
-            citation_matches = match_citations.get_citation_matches(
-                opinion, citations
-            )
-        except ResponseNotReady as e:
-            # Threading problem in httplib, which is used in the Solr query.
-            raise self.retry(exc=e, countdown=2)
+    # Match all those different Citation objects to Opinion objects, using
+    # a variety of hueristics.
+    try:
+        matched_opinions = match_opinion_citations(opinions_with_citations)
+    except ResponseNotReady as e:
+        # Threading problem in httplib, which is used in the Solr query.
+        raise self.retry(exc=e, countdown=2)
 
-        # Consolidate duplicate matches, keeping a counter of how often each
-        # match appears (so we know how many times an opinion cites another).
-        # keys = cited opinion
-        # values = number of times that opinion is cited
-        grouped_matches = Counter(citation_matches)
-
-        # Increase the citation count for the cluster of each matched opinion
-        # if that cluster has not already been cited by this opinion. First,
-        # calculate a list of the IDs of every opinion whose cluster will need
-        # updating.
-        all_cited_opinions = opinion.opinions_cited.all().values_list(
-            "pk", flat=True
-        )
-        opinion_ids_to_update = set()
-        for matched_opinion in grouped_matches:
-            if matched_opinion.pk not in all_cited_opinions:
-                opinion_ids_to_update.add(matched_opinion.pk)
-
-        # Then, increment the citation_count fields for those matched clusters
-        # all at once. Trigger a single Solr update as well, if required.
-        opinion_clusters_to_update = OpinionCluster.objects.filter(
-            sub_opinions__pk__in=opinion_ids_to_update
-        )
-        opinion_clusters_to_update.update(
-            citation_count=F("citation_count") + 1
-        )
-        if index:
-            add_items_to_solr.delay(
-                opinion_clusters_to_update.values_list("pk", flat=True),
-                "search.OpinionCluster",
-            )
-
-        # Generate the citing opinion's new HTML (with inline citation links)
-        opinion.html_with_citations = create_cited_html(opinion, citations)
-
-        # Nuke existing citations
-        OpinionsCited.objects.filter(citing_opinion_id=opinion.pk).delete()
-
-        # Create the new ones.
-        OpinionsCited.objects.bulk_create(
-            [
-                OpinionsCited(
-                    citing_opinion_id=opinion.pk,
-                    cited_opinion_id=matched_opinion.pk,
-                    depth=grouped_matches[matched_opinion],
-                )
-                for matched_opinion in grouped_matches
-            ]
-        )
-
-        # Save all the changes to the citing opinion
-        opinion.save()
-
-    # If a Solr update was requested, do a single one at the end with all the
-    # pks of the passed opinions
-    if index:
-        add_items_to_solr.delay(opinion_pks, "search.Opinion")
+    store_citations_in_bulk(matched_opinions, index)
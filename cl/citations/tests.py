@@ -17,16 +17,28 @@ from cl.citations.models import (
     SupraCitation,
     NonopinionCitation,
 )
+from cl.citations.management.commands.cl_find_citations import (
+    get_checkpoint_key,
+)
 from cl.citations.management.commands.cl_add_parallel_citations import (
     identify_parallel_citations,
     make_edge_list,
 )
-from cl.citations.match_citations import match_citation, get_citation_matches
-from cl.citations.reporter_tokenizer import tokenize
+from cl.citations.match_citations import (
+    match_citation,
+    get_citation_matches,
+    match_citations_in_bulk,
+)
+from cl.citations.reporter_tokenizer import (
+    REPORTER_RE,
+    REPORTER_STRINGS,
+    tokenize,
+)
 from cl.citations.tasks import (
     find_citations_for_opinion_by_pks,
     create_cited_html,
 )
+from cl.lib.redis_utils import make_redis_interface
 from cl.lib.test_helpers import IndexedSolrTestCase
 from cl.search.models import Opinion, OpinionsCited, OpinionCluster
 
@@ -64,6 +76,13 @@ class CiteTest(TestCase):
             ["See", "Roe", "v.", "Wade,", "410", "U. S.", ",", "at", "113"],
         )
 
+    def test_reporter_regex_matches_every_reporter(self):
+        """Does the trie-built reporter regex find each reporter in full?"""
+        for reporter in REPORTER_STRINGS:
+            m = REPORTER_RE.search(u"1 %s 1" % reporter)
+            self.assertIsNotNone(m, msg=u"Didn't match %s" % reporter)
+            self.assertEqual(m.group(2), reporter)
+
     def test_find_citations(self):
         """Can we find and make citation objects from strings?"""
         # fmt: off
@@ -1005,6 +1024,28 @@ class MatchingTest(IndexedSolrTestCase):
         results = match_citation(citation)
         self.assertEqual([], results)
 
+    def test_bulk_matching_agrees_with_single_matching(self):
+        """Do we get the same matches in bulk as one citation at a time?"""
+        citing_opinion = Opinion.objects.get(pk=1)
+        citation_pairs = [
+            (citation, citing_opinion)
+            for citation in get_citations(
+                "1 U.S. 1, 1 U.S. 50, 2 F.3d 2, 1 F. 9 (1795), 99 U.S. 99",
+                html=False,
+            )
+        ]
+        bulk_results = match_citations_in_bulk(citation_pairs)
+        self.assertEqual(len(citation_pairs), len(bulk_results))
+        for (citation, citing_doc), bulk_result in zip(
+            citation_pairs, bulk_results
+        ):
+            single_result = match_citation(citation, citing_doc=citing_doc)
+            self.assertEqual(
+                [r["id"] for r in single_result],
+                [r["id"] for r in bulk_result],
+                msg="Mismatch for %s" % citation,
+            )
+
 
 class UpdateTest(IndexedSolrTestCase):
     """Tests whether the update task performs correctly, i.e., whether it
@@ -1069,6 +1110,44 @@ class UpdateTest(IndexedSolrTestCase):
             )
             print "✓"
 
+    def test_rerun_only_changes_what_changed(self):
+        """Does re-running the citation finder leave unchanged citations
+        alone, remove stale ones, and fix the citation counts?
+        """
+        remove_citations_from_imported_fixtures()
+        find_citations_for_opinion_by_pks.delay([10])
+        edges = dict(
+            OpinionsCited.objects.filter(citing_opinion_id=10).values_list(
+                "cited_opinion_id", "pk"
+            )
+        )
+
+        # Add a stale citation, and mess up the depth of another.
+        stale_cited = Opinion.objects.get(pk=2)
+        OpinionsCited.objects.create(
+            citing_opinion_id=10, cited_opinion=stale_cited
+        )
+        OpinionCluster.objects.filter(pk=stale_cited.cluster_id).update(
+            citation_count=1
+        )
+        OpinionsCited.objects.filter(pk=edges[7]).update(depth=1)
+
+        find_citations_for_opinion_by_pks.delay([10])
+        self.assertEqual(
+            edges,
+            dict(
+                OpinionsCited.objects.filter(citing_opinion_id=10).values_list(
+                    "cited_opinion_id", "pk"
+                )
+            ),
+        )
+        self.assertEqual(OpinionsCited.objects.get(pk=edges[7]).depth, 3)
+        stale_cited.cluster.refresh_from_db()
+        self.assertEqual(stale_cited.cluster.citation_count, 0)
+        for cited_pk in edges:
+            cluster = Opinion.objects.get(pk=cited_pk).cluster
+            self.assertEqual(cluster.citation_count, 1)
+
 
 class CitationFeedTest(IndexedSolrTestCase):
     def _tree_has_content(self, content, expected_count):
@@ -1172,6 +1251,51 @@ class CitationCommandTest(IndexedSolrTestCase):
         ]
         self.call_command_and_test_it(args)
 
+    def test_pipeline(self):
+        args = [
+            "--start-id",
+            "0",
+            "--index",
+            "concurrently",
+            "--pipeline",
+            "--processes",
+            "1",
+            "--chunk-size",
+            "2",
+        ]
+        self.call_command_and_test_it(args)
+        # The run finished, so there's nothing to resume.
+        checkpoint_key = get_checkpoint_key({"start_id": 0, "all": False})
+        self.assertIsNone(make_redis_interface("CACHE").get(checkpoint_key))
+
+    def test_pipeline_resume(self):
+        """Does resuming skip the opinions that were already done?"""
+        r = make_redis_interface("CACHE")
+        checkpoint_key = get_checkpoint_key({"all": True})
+        other_checkpoint_key = get_checkpoint_key(
+            {"start_id": 0, "all": False}
+        )
+        r.set(checkpoint_key, 2)
+        r.set(other_checkpoint_key, 1000)
+        remove_citations_from_imported_fixtures()
+        call_command(
+            "cl_find_citations",
+            "--all",
+            "--pipeline",
+            "--resume",
+            "--processes",
+            "1",
+            "--index",
+            "False",
+        )
+        self.assertFalse(
+            OpinionsCited.objects.filter(citing_opinion_id__lte=2).exists()
+        )
+        # Only this run's checkpoint was used, and it's gone now it's done.
+        self.assertIsNone(r.get(checkpoint_key))
+        self.assertEqual(int(r.get(other_checkpoint_key)), 1000)
+        r.delete(other_checkpoint_key)
+
 
 class ParallelCitationTest(SimpleTestCase):
     allow_database_queries = True
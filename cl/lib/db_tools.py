@@ -1,5 +1,11 @@
+import gzip
+import tempfile
 from datetime import timedelta
 
+from django.db import connections
+from django.db.models import Case, Value, When
+from django.utils.encoding import force_text
+
 
 def queryset_generator(queryset, chunksize=1000):
     """
@@ -60,3 +66,117 @@ def fetchall_as_dict(cursor):
     """
     columns = [col[0] for col in cursor.description]
     return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def bulk_update(objs, fields, batch_size=500):
+    """Save the values of some fields of many objects of the same model.
+
+    Django 2.2 adds QuerySet.bulk_update for this. Until we have it, this does
+    the same thing: one UPDATE query per batch of objects, using CASE
+    statements to give every row its own values.
+
+    Like QuerySet.update, this doesn't call save() or send signals, and
+    auto_now fields aren't updated unless they're in fields.
+
+    :param objs: A list of saved objects of one model.
+    :param fields: The names of the fields to save.
+    :param batch_size: How many objects to update per query.
+    """
+    if not objs:
+        return
+    model = type(objs[0])
+    fields = [model._meta.get_field(name) for name in fields]
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i : i + batch_size]
+        updates = {}
+        for field in fields:
+            whens = [
+                When(
+                    pk=obj.pk,
+                    then=Value(
+                        getattr(obj, field.attname), output_field=field
+                    ),
+                )
+                for obj in batch
+            ]
+            updates[field.name] = Case(*whens, output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            **updates
+        )
+
+
+def copy_to_csv(queryset, f):
+    """Stream the results of a queryset out of Postgres as CSV, with COPY.
+
+    Postgres writes the CSV itself, and it's copied to the file a chunk at a
+    time, so no rows are made into Python objects, and memory use stays flat
+    however big the table is. It's a good fit for flat tables, like
+    OpinionsCited, that are too big to serialize.
+
+    :param queryset: The queryset to copy. Use values() or values_list() to
+    choose the columns. The header row has their column names.
+    :param f: A file-like object to write the CSV to.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        query = cursor.mogrify(sql, params)
+        cursor.copy_expert(
+            "COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)" % query, f
+        )
+
+
+def copy_to_gzipped_csv(queryset, path):
+    """Stream the results of a queryset into a gzipped CSV file, with COPY.
+
+    :param queryset: The queryset to copy, as taken by copy_to_csv.
+    :param path: Where to write the file.
+    """
+    with gzip.open(path, "wb") as f:
+        copy_to_csv(queryset, f)
+
+
+def to_copy_text(value):
+    """Write a value in the text format of COPY."""
+    if value is None:
+        return u"\\N"
+    if isinstance(value, bool):
+        return u"t" if value else u"f"
+    return (
+        force_text(value)
+        .replace(u"\\", u"\\\\")
+        .replace(u"\t", u"\\t")
+        .replace(u"\n", u"\\n")
+        .replace(u"\r", u"\\r")
+    )
+
+
+def copy_rows_to_table(rows, table, columns, using="default"):
+    """Load rows into a table with COPY.
+
+    The rows are written to a temporary file as they come, so they never all
+    need to be in memory, then Postgres reads the file in one go, which is
+    much faster than INSERTs.
+
+    :param rows: An iterable of lists of values that are ready for the DB,
+    as made by Field.get_db_prep_save. None is loaded as NULL.
+    :param table: The name of the table to load the rows into.
+    :param columns: The names of the columns of the values in each row.
+    :param using: The DB to use.
+    :return: The number of rows loaded.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    count = 0
+    with tempfile.TemporaryFile() as f:
+        for row in rows:
+            line = u"\t".join(to_copy_text(value) for value in row)
+            f.write(line.encode("utf-8") + b"\n")
+            count += 1
+        f.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY %s (%s) FROM STDIN"
+                % (qn(table), ", ".join(qn(column) for column in columns)),
+                f,
+            )
+    return count
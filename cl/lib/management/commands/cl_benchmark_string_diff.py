@@ -0,0 +1,144 @@
+import difflib
+import random
+import time
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.string_diff import (
+    find_best_match,
+    get_diff_ratios,
+    normalize,
+    remove_words,
+)
+from cl.search.models import Docket
+
+ABBREVIATIONS = (
+    ("Corporation", "Corp."),
+    ("Company", "Co."),
+    ("Incorporated", "Inc."),
+    ("Department", "Dept."),
+    ("Education", "Ed."),
+    ("United States", "USA"),
+)
+
+
+def make_variant(case_name):
+    """Make a case name that refers to the same case the way another source
+    might: in other case, abbreviated, or with its parties truncated, like
+    do_heuristic_match does.
+    """
+    variant = case_name
+    for long_form, short_form in ABBREVIATIONS:
+        variant = variant.replace(long_form, short_form)
+    parts = variant.split(" v. ")
+    if len(parts) == 2:
+        variant = "%s v. %s" % (parts[0][0:30], parts[1][0:30])
+    return random.choice([variant, variant.lower(), variant.upper()])
+
+
+def pairwise_ratio(left, right):
+    """The ratio as it was computed before the similarity engine: normalize
+    both strings every time and diff them from scratch.
+    """
+    return difflib.SequenceMatcher(
+        None, remove_words(left).strip(), remove_words(right).strip()
+    ).ratio()
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time matching case names from the DB against variants of "
+        "themselves, pairwise and with the one-to-many similarity "
+        "functions, and check that they give the same ratios."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=2000,
+            help="How many case names to take from the DB.",
+        )
+        parser.add_argument(
+            "--candidates",
+            type=int,
+            default=25,
+            help="How many candidates to match each case name against.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        random.seed(0)
+        case_names = list(
+            Docket.objects.exclude(case_name="")
+            .order_by("-pk")
+            .values_list("case_name", flat=True)[: options["count"]]
+        )
+        if len(case_names) < options["candidates"]:
+            logger.error("Not enough case names in the DB to benchmark.")
+            return
+        # Each query is a variant of a case name, to be found among others.
+        trials = []
+        for case_name in case_names:
+            candidates = random.sample(case_names, options["candidates"] - 1)
+            candidates.append(case_name)
+            random.shuffle(candidates)
+            trials.append((make_variant(case_name), candidates))
+        comparisons = len(trials) * options["candidates"]
+
+        t1 = time.time()
+        expected = []
+        for query, candidates in trials:
+            expected.append(
+                [pairwise_ratio(c.lower(), query.lower()) for c in candidates]
+            )
+        baseline = time.time() - t1
+
+        normalize.cache_clear()
+        results = []
+        t1 = time.time()
+        for query, candidates in trials:
+            results.append(
+                get_diff_ratios(query, candidates, case_sensitive=False)
+            )
+        one_to_many = time.time() - t1
+
+        normalize.cache_clear()
+        matches = []
+        t1 = time.time()
+        for query, candidates in trials:
+            matches.append(
+                find_best_match(candidates, query, case_sensitive=False)
+            )
+        best_match = time.time() - t1
+
+        logger.info("method            seconds  comparisons/sec  speedup")
+        for method, elapsed in (
+            ("pairwise", baseline),
+            ("get_diff_ratios", one_to_many),
+            ("find_best_match", best_match),
+        ):
+            logger.info(
+                "%-16s  %7.2f  %15.0f  %6.2fx",
+                method,
+                elapsed,
+                comparisons / elapsed,
+                baseline / elapsed,
+            )
+
+        mismatches = 0
+        for ratios, expected_ratios, match in zip(results, expected, matches):
+            best = max(expected_ratios)
+            if ratios != expected_ratios or (
+                match["ratio"] != best
+                or match["match_index"] != expected_ratios.index(best)
+            ):
+                mismatches += 1
+        if mismatches:
+            logger.error(
+                "%s of %s queries got different ratios than pairwise "
+                "matching.",
+                mismatches,
+                len(trials),
+            )
+        else:
+            logger.info("All %s queries got the same ratios.", len(trials))
@@ -1,6 +1,7 @@
 import uuid
 
 import os
+from django.core.files.base import File
 from django.core.files.storage import FileSystemStorage
 import itertools
 from django.conf import settings
@@ -56,6 +57,41 @@ class UUIDFileSystemStorage(FileSystemStorage):
         return os.path.join(dir_name, uuid.uuid4().hex + file_ext)
 
 
+def save_file_by_path(field_file, name, path):
+    """Save a file on disk to a FileField without reading it into memory.
+
+    When the field's storage is on the same filesystem as the file, the file
+    is hard-linked into place, so nothing is copied at all. Otherwise, it's
+    copied a chunk at a time. Either way, the original is left in place.
+
+    :param field_file: The FieldFile to save to, like rd.filepath_local. Its
+    instance isn't saved.
+    :param name: The name to give the file, before upload_to is applied.
+    :param path: The path of the file on disk.
+    """
+    storage = field_file.storage
+    field = field_file.field
+    new_name = field.generate_filename(field_file.instance, name)
+    try:
+        new_name = storage.get_available_name(
+            new_name, max_length=field.max_length
+        )
+        new_path = storage.path(new_name)
+        directory = os.path.dirname(new_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        os.link(path, new_path)
+    except (NotImplementedError, OSError):
+        # Not a local storage, a different filesystem, or a name that was
+        # taken in the meantime.
+        with open(path, "rb") as f:
+            field_file.save(name, File(f), save=False)
+        return
+    field_file.name = new_name
+    setattr(field_file.instance, field.name, new_name)
+    field_file._committed = True
+
+
 class AWSMediaStorage(S3Boto3Storage):
     """Implements AWS file system storage.
 
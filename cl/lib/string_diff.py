@@ -2,30 +2,58 @@ import difflib
 import math
 import string
 import re
-
 from collections import Counter
+from functools import wraps
+
+# Words and punctuation that don't help the diff comparison.
+STOP_WORDS = (
+    r"a|an|and|as|at|but|by|en|etc|for|if|in|is|of|on|or|the|to|v\.?|via"
+    r"|vs\.?|united|states?|et|al|appellants?|defendants?|administrator"
+    r"|plaintiffs?|error|others|against|ex|parte|complainants?|original"
+    r"|claimants?|devisee|executrix|executor"
+)
+STOP_WORDS_REGEX = re.compile(r"^(%s)$" % STOP_WORDS, re.IGNORECASE)
+PUNCTUATION_REGEX = re.compile(r"[%s]" % re.escape(string.punctuation))
+WHITESPACE_REGEX = re.compile(r"[\t ]")
+WORD_REGEX = re.compile(r"\w+")
+
+# How many strings to keep the normalized forms and vectors of. Matching
+# compares the same candidates over and over, so this saves redoing them.
+CACHE_SIZE = 10000
+
+
+def memoize_string(func):
+    """Cache the results of a function of one string, forgetting them all
+    when there are more than CACHE_SIZE.
+    """
+    cache = {}
+
+    @wraps(func)
+    def wrapper(s):
+        try:
+            return cache[s]
+        except KeyError:
+            pass
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        result = cache[s] = func(s)
+        return result
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
 
 
 def remove_words(phrase):
     # Removes words and punctuation that don't help the diff comparison.
-    stop_words = (
-        "a|an|and|as|at|but|by|en|etc|for|if|in|is|of|on|or|the|to|v\.?|via"
-        + "|vs\.?|united|states?|et|al|appellants?|defendants?|administrator|plaintiffs?|error"
-        + "|others|against|ex|parte|complainants?|original|claimants?|devisee"
-        + "|executrix|executor"
-    )
-    stop_words_reg = re.compile(r"^(%s)$" % stop_words, re.IGNORECASE)
-
-    # strips punctuation
-    exclude = set(string.punctuation)
-    phrase = "".join(ch for ch in phrase if ch not in exclude)
-
-    words = re.split("[\t ]", phrase)
-    result = []
-    for word in words:
-        word = stop_words_reg.sub("", word)
-        result.append(word)
-    return "".join(result)
+    phrase = PUNCTUATION_REGEX.sub("", phrase)
+    words = WHITESPACE_REGEX.split(phrase)
+    return "".join(STOP_WORDS_REGEX.sub("", word) for word in words)
+
+
+@memoize_string
+def normalize(s):
+    """Get a string ready to be diffed, remembering the ones we've done."""
+    return remove_words(s).strip()
 
 
 def gen_diff_ratio(left, right):
@@ -39,38 +67,72 @@ def gen_diff_ratio(left, right):
     """
     # Remove common strings from all case names /before/ comparison.
     # Doing so lowers the opportunity for false positives.
-    left = remove_words(left)
-    right = remove_words(right)
+    return difflib.SequenceMatcher(
+        None, normalize(left), normalize(right)
+    ).ratio()
 
-    # compute the difference value
-    diff = difflib.SequenceMatcher(None, left.strip(), right.strip()).ratio()
 
-    return diff
+def make_matcher(s, case_sensitive=True):
+    """Make a SequenceMatcher to compare many strings against s.
+
+    SequenceMatcher indexes its second sequence, so s goes there and is only
+    indexed once. The ratios are the same as gen_diff_ratio(item, s).
+    """
+    if not case_sensitive:
+        s = s.lower()
+    matcher = difflib.SequenceMatcher(None)
+    matcher.set_seq2(normalize(s))
+    return matcher
+
+
+def get_diff_ratios(s, items, case_sensitive=True):
+    """Compare a string against many others.
+
+    :param s: The string to compare against
+    :param items: The strings to compare to it
+    :param case_sensitive: Whether comparisons should honor case
+    :return: A list of the diff ratios of the items, in the same order.
+    """
+    matcher = make_matcher(s, case_sensitive)
+    ratios = []
+    for item in items:
+        if not case_sensitive:
+            item = item.lower()
+        matcher.set_seq1(normalize(item))
+        ratios.append(matcher.ratio())
+    return ratios
 
 
 def find_best_match(items, s, case_sensitive=True):
     """Find the string in the list that is the closest match to the string
 
+    Items that can't beat the best match so far, judging by difflib's cheap
+    upper bounds, are skipped without being fully diffed.
+
     :param items: The list to search within
     :param s: The string to attempt to match
     :param case_sensitive: Whether comparisons should honor case
     :return dict with the index of the best matching value, its value, and its
     match ratio.
     """
-    diff_ratios = []
-    if not case_sensitive:
-        s = s.lower()
-
-    for item in items:
-        # Calculate its diff_ratio, and add it to an array
+    if not items:
+        raise ValueError("Can't find the best match in an empty list.")
+    matcher = make_matcher(s, case_sensitive)
+    max_ratio = -1
+    i = None
+    for j, item in enumerate(items):
         if not case_sensitive:
             item = item.lower()
-        diff = gen_diff_ratio(item, s)
-        diff_ratios.append(diff)
-
-    # Find the max ratio, and grab the corresponding result
-    max_ratio = max(diff_ratios)
-    i = diff_ratios.index(max_ratio)
+        matcher.set_seq1(normalize(item))
+        if (
+            matcher.real_quick_ratio() < max_ratio
+            or matcher.quick_ratio() < max_ratio
+        ):
+            continue
+        ratio = matcher.ratio()
+        if ratio > max_ratio:
+            # Ties go to the first item, as they always have.
+            max_ratio, i = ratio, j
     return {
         "match_index": i,
         "match_str": items[i],
@@ -84,20 +146,48 @@ def find_confidences(results, case_name):
     This is nearly identical to find_best_match, but returns any good matches
     in an array, and returns their confidence thresholds in a second array.
     """
-    diff_ratios = []
-    for result in results:
-        # Calculate its diff_ratio, and add it to an array
-        candidate_case_name = result["caseName"]
-        diff = gen_diff_ratio(candidate_case_name, case_name)
-        diff_ratios.append(diff)
-
-    return diff_ratios
+    return get_diff_ratios(case_name, [r["caseName"] for r in results])
 
 
 def string_to_vector(text):
-    WORD = re.compile(r"\w+")
-    words = WORD.findall(text)
-    return Counter(words)
+    return Counter(WORD_REGEX.findall(text))
+
+
+@memoize_string
+def get_vector(text):
+    """Get the word vector of a string and its magnitude, remembering the
+    ones we've done. Don't change the vector; it's shared.
+    """
+    vector = string_to_vector(text)
+    return vector, math.sqrt(sum(count ** 2 for count in vector.values()))
+
+
+def get_cosine_similarities(s, items):
+    """Calculate the cosine similarity of a string to many others.
+
+    :param s: The string to compare against
+    :param items: The strings to compare to it
+    :return: A list of the similarities of the items, in the same order.
+    """
+    left, left_norm = get_vector(s)
+    similarities = []
+    for item in items:
+        right, right_norm = get_vector(item)
+        denominator = left_norm * right_norm
+        if not denominator:
+            similarities.append(0.0)
+            continue
+        if len(right) < len(left):
+            smaller, larger = right, left
+        else:
+            smaller, larger = left, right
+        numerator = sum(
+            count * larger[word]
+            for word, count in smaller.items()
+            if word in larger
+        )
+        similarities.append(float(numerator) / denominator)
+    return similarities
 
 
 def get_cosine_similarity(left, right):
@@ -110,15 +200,4 @@ def get_cosine_similarity(left, right):
     Better for long strings with sentence-length differences, where diff_lib's
     ratio() can fall down.
     """
-    left, right = string_to_vector(left), string_to_vector(right)
-    intersection = set(left.keys()) & set(right.keys())
-    numerator = sum([left[x] * right[x] for x in intersection])
-
-    sum1 = sum([left[x] ** 2 for x in left.keys()])
-    sum2 = sum([right[x] ** 2 for x in right.keys()])
-    denominator = math.sqrt(sum1) * math.sqrt(sum2)
-
-    if not denominator:
-        return 0.0
-    else:
-        return float(numerator) / denominator
+    return get_cosine_similarities(left, [right])[0]
@@ -7,6 +7,7 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from lxml import etree
 
+from cl.citations.citation_index import clear_citation_index
 from cl.lib import sunburnt
 from cl.search.models import Court
 
@@ -26,6 +27,9 @@ class EmptySolrTestCase(TestCase):
     """
 
     def setUp(self):
+        # Don't let citations indexed by earlier tests bypass Solr
+        clear_citation_index()
+
         # Set up testing cores in Solr and swap them in
         self.core_name_opinion = settings.SOLR_OPINION_TEST_CORE_NAME
         self.core_name_audio = settings.SOLR_AUDIO_TEST_CORE_NAME
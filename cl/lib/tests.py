@@ -4,15 +4,18 @@ from __future__ import print_function
 import datetime
 import os
 import re
+import shutil
 import tempfile
+from io import BytesIO
 
+import mock
 from django.core.files.base import ContentFile
 from django.urls import reverse
 from django.test import TestCase, SimpleTestCase
 from django.test import override_settings
 from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE, HTTP_200_OK
 
-from cl.lib.db_tools import queryset_generator
+from cl.lib.db_tools import copy_to_csv, queryset_generator
 from cl.lib.filesizes import convert_size_to_bytes
 from cl.lib.mime_types import lookup_mime_type
 from cl.lib.model_helpers import make_upload_path, make_docket_number_core
@@ -24,11 +27,25 @@ from cl.lib.pacer import (
     get_blocked_status,
 )
 from cl.lib.search_utils import make_fq
-from cl.lib.storage import UUIDFileSystemStorage
+from cl.lib.storage import UUIDFileSystemStorage, save_file_by_path
+from cl.lib.string_diff import (
+    find_best_match,
+    find_confidences,
+    gen_diff_ratio,
+    get_cosine_similarity,
+    get_diff_ratios,
+)
 from cl.lib.string_utils import trunc, anonymize
 from cl.people_db.models import Role
 from cl.scrapers.models import UrlHash
-from cl.search.models import Opinion, OpinionCluster, Docket, Court
+from cl.search.models import (
+    Court,
+    Docket,
+    DocketEntry,
+    Opinion,
+    OpinionCluster,
+    RECAPDocument,
+)
 
 
 class TestPacerUtils(TestCase):
@@ -115,6 +132,14 @@ class TestDBTools(TestCase):
         self.assertEqual(expected_count, sum(1 for _ in results))
         print("✓")
 
+    def test_copy_to_csv(self):
+        """Can we stream a queryset out as CSV?"""
+        f = BytesIO()
+        copy_to_csv(
+            UrlHash.objects.filter(pk="1").values_list("id", "sha1"), f
+        )
+        self.assertEqual(f.getvalue(), "id,sha1\n1,1\n")
+
 
 class TestStringUtils(TestCase):
     def test_trunc(self):
@@ -188,6 +213,76 @@ class TestStringUtils(TestCase):
         )
 
 
+class TestStringDiff(SimpleTestCase):
+    # Ratios made by the original, pairwise string_diff. Matching decisions
+    # hang on these, so they shouldn't drift.
+    ratios = (
+        ("Roe v. Wade", "Roe v. Wade", 1.0),
+        ("Roe v. Wade", "Doe v. Bolton", 0.25),
+        (
+            "United States v. Nixon",
+            "Nixon v. Administrator of General Services",
+            0.4,
+        ),
+        (
+            "Brown v. Board of Education of Topeka",
+            "Brown v. Board of Ed.",
+            0.6486486486486487,
+        ),
+        (
+            "Smith, et al. v. Jones Trucking, Inc.",
+            "SMITH v. JONES TRUCKING INC",
+            0.19047619047619047,
+        ),
+        ("In re: Acme Corp.", "In re Acme Corporation", 0.7407407407407407),
+        ("Ex parte Milligan", "Milligan", 1.0),
+        (
+            u"Soci\xe9t\xe9 G\xe9n\xe9rale v. Dupont",
+            u"Societe Generale v. Du Pont",
+            0.7619047619047619,
+        ),
+        ("Johnson v. State\tof Texas", "johnson v. texas", 0.8333333333333334),
+        ("", "Marbury v. Madison", 0.0),
+    )
+
+    def test_ratios_have_not_changed(self):
+        """Are the ratios the same as they always were?"""
+        for left, right, ratio in self.ratios:
+            self.assertEqual(gen_diff_ratio(left, right), ratio)
+            self.assertEqual(get_diff_ratios(right, [left]), [ratio])
+
+    def test_one_to_many(self):
+        """Do the one-to-many functions agree with the pairwise ones?"""
+        items = ["smith v. jones", "jones v. smith", "smith v. jonas"]
+        self.assertEqual(
+            get_diff_ratios("Smith v. Jones", items, case_sensitive=False),
+            [1.0, 0.5, 0.9],
+        )
+        self.assertEqual(
+            find_confidences(
+                [{"caseName": i} for i in items], "smith v. jones"
+            ),
+            [1.0, 0.5, 0.9],
+        )
+        self.assertEqual(
+            find_best_match(items[::-1], "smith v. jones"),
+            {"match_index": 2, "match_str": "smith v. jones", "ratio": 1.0},
+        )
+        # Ties go to the first item.
+        self.assertEqual(
+            find_best_match(["roe v. wade", "roe v. wade"], "roe")[
+                "match_index"
+            ],
+            0,
+        )
+        self.assertEqual(
+            get_cosine_similarity(
+                "the cat sat on the mat", "the cat ate the rat"
+            ),
+            0.6681531047810609,
+        )
+
+
 class TestMakeFQ(TestCase):
     def test_make_fq(self):
         test_pairs = (
@@ -277,6 +372,42 @@ class UUIDFileSystemStorageTest(SimpleTestCase):
         self.assertTrue(re.match("[a-f0-9]{32}", file_root_created))
 
 
+class SaveFileByPathTest(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "upload.pdf")
+        with open(self.path, "wb") as f:
+            f.write(b"file content")
+        self.rd = RECAPDocument(
+            docket_entry=DocketEntry(
+                docket=Docket(court_id="test", pacer_case_id="1")
+            ),
+            document_number="1",
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_hard_link(self):
+        """Is a file on the same filesystem linked instead of copied?"""
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            save_file_by_path(self.rd.filepath_local, "file.pdf", self.path)
+            new_path = self.rd.filepath_local.path
+        self.assertTrue(self.rd.filepath_local.name.startswith("recap/"))
+        self.assertTrue(os.path.samefile(self.path, new_path))
+        self.assertTrue(os.path.isfile(self.path))
+
+    @mock.patch("cl.lib.storage.os.link", side_effect=OSError)
+    def test_copy_across_filesystems(self, link_mock):
+        """If the file can't be linked, is it copied?"""
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            save_file_by_path(self.rd.filepath_local, "file.pdf", self.path)
+            new_path = self.rd.filepath_local.path
+        self.assertFalse(os.path.samefile(self.path, new_path))
+        with open(new_path, "rb") as f:
+            self.assertEqual(f.read(), b"file content")
+
+
 class TestMimeLookup(TestCase):
     """ Test the Mime type lookup function(s)"""
 
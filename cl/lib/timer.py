@@ -1,5 +1,6 @@
 from __future__ import print_function
 import time
+from contextlib import contextmanager
 
 
 def print_timing(func):
@@ -15,3 +16,47 @@ def print_timing(func):
         return res
 
     return wrapper
+
+
+class StageTimer(object):
+    """Track the time spent in, and the items processed by, each stage of a
+    pipeline, so we can see which stage is the bottleneck.
+
+    Use it like:
+
+        timer = StageTimer()
+        with timer.time("extract", count=len(items)):
+            do_extraction(items)
+        logger.info(timer.summary())
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def time(self, stage, count=0):
+        if stage not in self.seconds:
+            self.stages.append(stage)
+            self.seconds[stage] = 0.0
+            self.counts[stage] = 0
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.time() - t1
+            self.counts[stage] += count
+
+    def summary(self):
+        """Make a string describing the throughput of each stage."""
+        parts = []
+        for stage in self.stages:
+            seconds = self.seconds[stage]
+            count = self.counts[stage]
+            rate = count / seconds if seconds else 0
+            parts.append(
+                "%s: %s items in %0.1fs (%0.1f/s)"
+                % (stage, count, seconds, rate)
+            )
+        return "; ".join(parts)
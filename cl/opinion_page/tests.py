@@ -1,11 +1,15 @@
 import datetime
+import gzip
 import os
 import shutil
+import tempfile
 
+import mock
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test.client import Client
 from django.urls import reverse
 
@@ -17,13 +21,21 @@ from rest_framework.status import (
     HTTP_400_BAD_REQUEST,
 )
 
+from cl.citations.citation_index import (
+    clear_citation_index,
+    lookup_citation_str,
+)
 from cl.lib.scorched_utils import ExtraSolrInterface
 from cl.lib.test_helpers import SitemapTest
 from cl.opinion_page.forms import TennWorkersForm
 from cl.opinion_page.views import make_docket_title
 from cl.people_db.models import Person
 from cl.search.models import Citation, Docket, Opinion, OpinionCluster
-from cl.sitemap import make_sitemap_solr_params, items_per_sitemap
+from cl.sitemap import (
+    get_sitemap_path,
+    items_per_sitemap,
+    make_sitemap_solr_params,
+)
 
 
 class TitleTest(TestCase):
@@ -50,6 +62,9 @@ class CitationRedirectorTest(TestCase):
     fixtures = ["test_objects_search.json", "judge_judy.json"]
     citation = {"reporter": "F.2d", "volume": "56", "page": "9"}
 
+    def setUp(self):
+        clear_citation_index()
+
     def assertStatus(self, r, status):
         self.assertEqual(
             r.status_code,
@@ -87,6 +102,21 @@ class CitationRedirectorTest(TestCase):
         self.assertStatus(r, HTTP_300_MULTIPLE_CHOICES)
         f2_cite.delete()
 
+    def test_redirect_from_citation_index(self):
+        """Can we redirect using the citation index?"""
+        citation_str = "56 F.2d 9"
+        self.assertEqual(lookup_citation_str(citation_str), [])
+        call_command("cl_build_citation_index")
+        entries = lookup_citation_str(citation_str)
+        self.assertEqual(len(entries), 1)
+        cluster = OpinionCluster.objects.get(pk=entries[0]["cluster_id"])
+
+        r = self.client.get(
+            reverse("citation_redirector", kwargs=self.citation)
+        )
+        self.assertStatus(r, HTTP_302_FOUND)
+        self.assertTrue(r["Location"].endswith(cluster.get_absolute_url()))
+
     def test_unknown_citation(self):
         """Do we get a 404 message if we don't know the citation?"""
         r = self.client.get(
@@ -127,6 +157,45 @@ class CitationRedirectorTest(TestCase):
         self.assertStatus(r, HTTP_200_OK)
 
 
+class CitationIndexUpdateTest(TransactionTestCase):
+    """The index is updated once changes are committed, so these tests need
+    real transactions.
+    """
+
+    fixtures = ["test_objects_search.json", "judge_judy.json"]
+
+    def setUp(self):
+        clear_citation_index()
+        call_command("cl_build_citation_index")
+
+    def tearDown(self):
+        clear_citation_index()
+
+    def test_citation_change_updates_index(self):
+        """Is the index kept up to date as citations change?"""
+        f2_cite = Citation.objects.get(volume=56, reporter="F.2d", page="9")
+        f2_cite.page = "10"
+        f2_cite.save()
+        self.assertEqual(lookup_citation_str("56 F.2d 9"), [])
+        self.assertEqual(len(lookup_citation_str("56 F.2d 10")), 1)
+
+    @mock.patch("cl.citations.models.update_citation_index_for_clusters")
+    def test_only_indexed_cluster_changes_update_index(self, update_mock):
+        """Do we leave the index alone when a cluster is saved without
+        changing anything in it?
+        """
+        cluster = Citation.objects.get(
+            volume=56, reporter="F.2d", page="9"
+        ).cluster
+        cluster.judges = "Judy"
+        cluster.save()
+        update_mock.assert_not_called()
+
+        cluster.date_filed = datetime.date(1901, 1, 1)
+        cluster.save()
+        update_mock.assert_called_once_with([cluster.pk])
+
+
 class ViewRecapDocketTest(TestCase):
     fixtures = ["test_objects_search.json", "judge_judy.json"]
 
@@ -221,6 +290,25 @@ class OpinionSitemapTest(SitemapTest):
         self.expected_item_count = self.get_expected_item_count()
         super(OpinionSitemapTest, self).does_the_sitemap_have_content()
 
+    def test_made_ahead_of_time(self):
+        """Are the sitemaps made by cl_make_sitemaps served?"""
+        sitemaps_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sitemaps_dir)
+        with self.settings(SITEMAPS_DIR=sitemaps_dir):
+            call_command("cl_make_sitemaps", sections=["opinions"])
+            path = get_sitemap_path("opinions", self.court_id, 1)
+            self.assertTrue(os.path.exists(path))
+            with gzip.open(path) as f:
+                made = f.read()
+
+            self.expected_item_count = self.get_expected_item_count()
+            super(OpinionSitemapTest, self).does_the_sitemap_have_content()
+            r = self.client.get(self.sitemap_url)
+            self.assertEqual(r.content, made)
+
+            r = self.client.get(self.sitemap_url, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(r["Content-Encoding"], "gzip")
+
 
 @override_settings(
     MEDIA_ROOT=os.path.join(settings.INSTALL_ROOT, "cl/assets/media/test/")
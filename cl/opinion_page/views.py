@@ -25,6 +25,7 @@ from reporters_db import (
 from rest_framework.status import HTTP_404_NOT_FOUND, HTTP_300_MULTIPLE_CHOICES
 
 from cl.alerts.models import DocketAlert
+from cl.citations.citation_index import lookup_citation_str
 from cl.custom_filters.templatetags.text_filters import best_case_name
 from cl.favorites.forms import FavoriteForm
 from cl.favorites.models import Favorite
@@ -609,6 +610,18 @@ def citation_handler(request, reporter, volume, page):
     """Load the page when somebody looks up a complete citation"""
 
     citation_str = " ".join([volume, reporter, page])
+
+    # Unambiguous citations can be served from the citation index without
+    # hitting the DB. Everything else goes the slow way.
+    entries = lookup_citation_str(citation_str)
+    if len(entries) == 1:
+        return HttpResponseRedirect(
+            reverse(
+                "view_case",
+                args=[entries[0]["cluster_id"], entries[0]["slug"]],
+            )
+        )
+
     try:
         clusters = OpinionCluster.objects.filter(citation=citation_str)
     except ValueError:
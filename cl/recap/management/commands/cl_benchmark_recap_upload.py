@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from django.core.files.base import ContentFile, File
+from django.test import override_settings
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.crypto import sha1, sha1_of_file
+from cl.lib.storage import save_file_by_path
+from cl.search.models import Docket, DocketEntry, RECAPDocument
+
+FILE_NAME = "gov.uscourts.test.1.1.0.pdf"
+
+
+def make_large_pdf(path, size_mb):
+    """Make a file that looks like a PDF of about size_mb megabytes. Only its
+    size matters here, so the body is filler.
+    """
+    chunk = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        for _ in range(size_mb):
+            f.write(chunk)
+        f.write(b"\n%%EOF\n")
+
+
+def read_whole_file(rd, path):
+    """The way uploads were handled before: read, hash and write it all."""
+    with open(path, "rb") as f:
+        content = f.read()
+    sha1(content)
+    rd.filepath_local.save(FILE_NAME, ContentFile(content), save=False)
+
+
+def copy_in_chunks(rd, path):
+    sha1_of_file(path)
+    with open(path, "rb") as f:
+        rd.filepath_local.save(FILE_NAME, File(f), save=False)
+
+
+def hard_link(rd, path):
+    sha1_of_file(path)
+    save_file_by_path(rd.filepath_local, FILE_NAME, path)
+
+
+def do_nothing(rd, path):
+    pass
+
+
+def measure(method, path, results):
+    """Run a method in this process, and report its time and peak memory."""
+    rd = RECAPDocument(
+        docket_entry=DocketEntry(
+            docket=Docket(court_id="test", pacer_case_id="1")
+        ),
+        document_number="1",
+    )
+    t1 = time.time()
+    method(rd, path)
+    elapsed = time.time() - t1
+    # ru_maxrss is in kilobytes on Linux.
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run_in_child(method, path):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=measure, args=(method, path, results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time saving a large synthetic PDF upload to RECAP storage, and "
+        "measure the peak memory it takes, reading the whole file, copying "
+        "it in chunks, and hard-linking it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size",
+            type=int,
+            default=500,
+            help="The size of the synthetic PDF, in megabytes.",
+        )
+        parser.add_argument(
+            "--directory",
+            default=tempfile.gettempdir(),
+            help="Where to put the files. Hard links only work if this is "
+            "one filesystem.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        media_root = tempfile.mkdtemp(
+            prefix="upload_benchmark_", dir=options["directory"]
+        )
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                path = os.path.join(media_root, "upload.pdf")
+                make_large_pdf(path, options["size"])
+                # Forked processes start with the memory of this one, so
+                # measure what a process that does nothing peaks at.
+                _, baseline = run_in_child(do_nothing, path)
+                logger.info("method            seconds  peak MB")
+                for name, method in (
+                    ("read whole file", read_whole_file),
+                    ("copy in chunks", copy_in_chunks),
+                    ("hard link", hard_link),
+                ):
+                    elapsed, max_rss = run_in_child(method, path)
+                    logger.info(
+                        "%-16s  %7.2f  %7.1f",
+                        name,
+                        elapsed,
+                        (max_rss - baseline) / 1024.0,
+                    )
+        finally:
+            shutil.rmtree(media_root)
@@ -5,9 +5,11 @@ from datetime import date
 
 from dateutil import parser
 from django.core.management import CommandError
+from django.db import connection, transaction
 from django.utils.timezone import now
 
 from cl.lib.command_utils import VerboseCommand, CommandUtils, logger
+from cl.lib.db_tools import copy_rows_to_table
 from cl.recap.constants import (
     DATASET_SOURCES,
     CV_2017,
@@ -58,6 +60,197 @@ def create_or_update_row(values):
     return fjc_row
 
 
+# The fields that rows are first matched on, in create_or_update_row.
+IDB_KEY_FIELDS = ["district", "docket_number", "origin", "date_filed"]
+
+
+def make_match_sql(a, b, fields):
+    """Make SQL that matches the fields of two tables the way the ORM
+    would, with NULLs matching NULLs.
+    """
+    qn = connection.ops.quote_name
+    clauses = []
+    for field in fields:
+        # Use = where we can, so the planner can use it for the join.
+        op = "IS NOT DISTINCT FROM" if field.null else "="
+        clauses.append(
+            "%s.%s %s %s.%s" % (a, qn(field.column), op, b, qn(field.column))
+        )
+    return " AND ".join(clauses)
+
+
+def bulk_create_or_update_rows(rows, update_fields):
+    """Create or update many IDB rows at once.
+
+    The rows are loaded into a staging table with COPY, then matched against
+    the IDB with a few set-based queries. The result is the same as calling
+    create_or_update_row on each row in order:
+
+     - If a row's district, docket number, origin, and date filed match no
+       more than one row in the IDB, the last row in the file with those
+       values creates the match or updates it.
+     - If they match more than one, rows are matched on their defendant too,
+       the same way. If that still matches more than one, they're skipped.
+
+    :param rows: An iterable of dicts of values, as made by
+    convert_to_cl_data_model.
+    :param update_fields: The names of the fields in the dicts of values. An
+    update only changes these.
+    :return: A dict with the number of rows created, updated and skipped.
+    """
+    model = FjcIntegratedDatabase
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    fields = [
+        f
+        for f in model._meta.concrete_fields
+        if not f.primary_key
+        and f.name not in ["date_created", "date_modified"]
+    ]
+    columns = ", ".join(qn(f.column) for f in fields)
+    key_fields = [model._meta.get_field(name) for name in IDB_KEY_FIELDS]
+    key = ", ".join("s.%s" % qn(f.column) for f in key_fields)
+    defendant = model._meta.get_field("defendant")
+
+    def prepare(line, values):
+        # Make the object, so fields that aren't in the values get their
+        # defaults, like they do with create().
+        item = model(**values)
+        values = [
+            f.get_db_prep_save(getattr(item, f.attname), connection)
+            for f in fields
+        ]
+        return values + [line]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE idb_staging AS "
+            "SELECT %s FROM %s WITH NO DATA" % (columns, table)
+        )
+        cursor.execute("ALTER TABLE idb_staging ADD COLUMN line integer")
+        count = copy_rows_to_table(
+            (prepare(line, values) for line, values in enumerate(rows)),
+            "idb_staging",
+            [f.column for f in fields] + ["line"],
+        )
+        logger.info("\nLoaded %s rows into the staging table.", count)
+        cursor.execute("ANALYZE idb_staging")
+
+        # How many rows of the IDB match each key in the file?
+        cursor.execute(
+            "CREATE TEMP TABLE idb_key_counts AS "
+            "SELECT s.*, count(t.id) AS n "
+            "FROM (SELECT DISTINCT %s FROM idb_staging s) s "
+            "LEFT JOIN %s t ON %s "
+            "GROUP BY %s"
+            % (key, table, make_match_sql("t", "s", key_fields), key)
+        )
+
+        # Where there's no more than one, the last row of the file with the
+        # key creates or updates it.
+        cursor.execute(
+            "CREATE TEMP TABLE idb_actions AS "
+            "SELECT DISTINCT ON (%s) s.line, t.id AS target_id "
+            "FROM idb_staging s "
+            "JOIN idb_key_counts k ON %s "
+            "LEFT JOIN %s t ON %s "
+            "WHERE k.n <= 1 "
+            "ORDER BY %s, s.line DESC"
+            % (
+                key,
+                make_match_sql("k", "s", key_fields),
+                table,
+                make_match_sql("t", "s", key_fields),
+                key,
+            )
+        )
+
+        # Where there's more, do the same with the defendant as part of the
+        # key, and skip the ones that still match more than one row.
+        cursor.execute(
+            "CREATE TEMP TABLE idb_defendant_matches AS "
+            "SELECT s.line, s.%s, s.%s, "
+            "min(t.id) AS target_id, count(t.id) AS n "
+            "FROM (SELECT DISTINCT ON (%s, s.%s) s.* "
+            "      FROM idb_staging s "
+            "      JOIN idb_key_counts k ON %s "
+            "      WHERE k.n > 1 "
+            "      ORDER BY %s, s.%s, s.line DESC) s "
+            "LEFT JOIN %s t ON %s "
+            "GROUP BY s.line, s.%s, s.%s"
+            % (
+                qn("docket_number"),
+                qn(defendant.column),
+                key,
+                qn(defendant.column),
+                make_match_sql("k", "s", key_fields),
+                key,
+                qn(defendant.column),
+                table,
+                make_match_sql("t", "s", key_fields + [defendant]),
+                qn("docket_number"),
+                qn(defendant.column),
+            )
+        )
+        cursor.execute(
+            "INSERT INTO idb_actions "
+            "SELECT line, target_id FROM idb_defendant_matches WHERE n <= 1"
+        )
+        cursor.execute(
+            "SELECT s.line, s.%s, s.%s, s.n "
+            "FROM idb_defendant_matches s WHERE s.n > 1 ORDER BY s.line"
+            % (qn("docket_number"), qn(defendant.column))
+        )
+        skipped = cursor.fetchall()
+        for line, docket_number, defendant_name, n in skipped:
+            logger.warn(
+                "Got %s results when looking up row %s of the file by docket "
+                "number %s and defendant %s. Skipping it.",
+                n,
+                line,
+                docket_number,
+                defendant_name,
+            )
+
+        update_columns = [
+            model._meta.get_field(name).column for name in update_fields
+        ]
+        cursor.execute(
+            "UPDATE %s t SET %s, %s = now() "
+            "FROM idb_actions a JOIN idb_staging s ON s.line = a.line "
+            "WHERE t.id = a.target_id"
+            % (
+                table,
+                ", ".join(
+                    "%s = s.%s" % (qn(c), qn(c)) for c in update_columns
+                ),
+                qn("date_modified"),
+            )
+        )
+        updated = cursor.rowcount
+        cursor.execute(
+            "INSERT INTO %s (%s, %s, %s) "
+            "SELECT %s, now(), now() "
+            "FROM idb_actions a JOIN idb_staging s ON s.line = a.line "
+            "WHERE a.target_id IS NULL "
+            "ORDER BY s.line"
+            % (
+                table,
+                columns,
+                qn("date_created"),
+                qn("date_modified"),
+                ", ".join("s.%s" % qn(f.column) for f in fields),
+            )
+        )
+        created = cursor.rowcount
+        cursor.execute(
+            "DROP TABLE idb_staging, idb_key_counts, idb_actions, "
+            "idb_defendant_matches"
+        )
+
+    return {"created": created, "updated": updated, "skipped": len(skipped)}
+
+
 class Command(VerboseCommand, CommandUtils):
     help = (
         "Import a tab-separated file as produced by FJC for their IDB. "
@@ -84,6 +277,14 @@ class Command(VerboseCommand, CommandUtils):
             default=-1,
             type=int,
         )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            default=False,
+            help="Load the whole file into a staging table, then create or "
+            "update its rows with a few queries, instead of a few queries "
+            "per row. Much faster for big files.",
+        )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
@@ -94,6 +295,7 @@ class Command(VerboseCommand, CommandUtils):
         self.date_fields = []
         self.court_fields = []
         self.nullable_fields = None
+        self.courts = {}
 
     @staticmethod
     def ensure_filetype_ok(filetype):
@@ -187,15 +389,39 @@ class Command(VerboseCommand, CommandUtils):
         f = io.open(
             options["input_file"], mode="r", encoding="cp1252", newline="\r\n"
         )
+        rows = self.iter_rows(f, options["start_line"])
+        if options["bulk"]:
+            update_fields = set(self.field_mappings.values())
+            update_fields.add("dataset_source")
+            result = bulk_create_or_update_rows(rows, sorted(update_fields))
+            logger.info(
+                "Created %(created)s rows, updated %(updated)s rows and "
+                "skipped %(skipped)s rows.",
+                result,
+            )
+        else:
+            for values in rows:
+                create_or_update_row(values)
+
+        f.close()
+
+    def iter_rows(self, f, start_line):
+        """Parse and normalize the lines of an IDB file.
+
+        :param f: The open IDB file.
+        :param start_line: The line to start on.
+        :return: An iterator of dicts of values for FjcIntegratedDatabase
+        objects.
+        """
         col_headers = f.next().strip().split("\t")
         for i, line in enumerate(f):
             sys.stdout.write("\rDoing line: %s" % i)
             sys.stdout.flush()
-            if i < options["start_line"]:
+            if i < start_line:
                 continue
 
             row = self.make_csv_row_dict(line, col_headers)
-            if options["filetype"] == CR_2017 and row["SOURCE"] != "CMECF":
+            if self.filetype == CR_2017 and row["SOURCE"] != "CMECF":
                 continue
 
             self.normalize_nulls(row)
@@ -203,15 +429,9 @@ class Command(VerboseCommand, CommandUtils):
             self.normalize_booleans(row)
             self.normalize_dates(row)
             self.normalize_ints(row)
-            if options["filetype"] not in [CV_2017, CV_2020, CR_2017]:
+            if self.filetype not in [CV_2017, CV_2020, CR_2017]:
                 raise NotImplementedError("This file type not implemented.")
-            else:
-                values = self.convert_to_cl_data_model(
-                    row, options["filetype"]
-                )
-            create_or_update_row(values)
-
-        f.close()
+            yield self.convert_to_cl_data_model(row, self.filetype)
 
     def normalize_nulls(self, row):
         """The IDB uses the value -8 to indicate a null value. Fix this
@@ -261,34 +481,33 @@ class Command(VerboseCommand, CommandUtils):
             row["CIRCUIT"] = row["CIRCUIT"][1]
 
         if row["CIRCUIT"]:
-            matches = Court.federal_courts.appellate_courts().filter(
-                fjc_court_id=row["CIRCUIT"],
+            row["CIRCUIT"] = self.get_court(
+                "CIRCUIT",
+                row["CIRCUIT"],
+                Court.federal_courts.appellate_courts(),
             )
-            if matches.count() == 1:
-                row["CIRCUIT"] = matches[0]
-            else:
-                raise Exception(
-                    "Unable to match CIRCUIT column value %s to "
-                    "Court object" % row["CIRCUIT"]
-                )
 
         if row["DISTRICT"]:
             if self.filetype == BANKR_2017:
-                matches = Court.federal_courts.bankruptcy_courts().filter(
-                    fjc_court_id=row["DISTRICT"],
-                )
+                courts = Court.federal_courts.bankruptcy_courts()
             else:
-                matches = Court.federal_courts.district_courts().filter(
-                    fjc_court_id=row["DISTRICT"],
-                )
+                courts = Court.federal_courts.district_courts()
+            row["DISTRICT"] = self.get_court(
+                "DISTRICT", row["DISTRICT"], courts
+            )
 
-            if matches.count() == 1:
-                row["DISTRICT"] = matches[0]
-            else:
+    def get_court(self, column, fjc_court_id, courts):
+        """Get the court with an FJC ID, looking it up only once per run."""
+        key = (column, fjc_court_id)
+        if key not in self.courts:
+            matches = list(courts.filter(fjc_court_id=fjc_court_id)[:2])
+            if len(matches) != 1:
                 raise Exception(
-                    "Unable to match DISTRICT column value %s to "
-                    "Court object" % row["DISTRICT"]
+                    "Unable to match %s column value %s to "
+                    "Court object" % (column, fjc_court_id)
                 )
+            self.courts[key] = matches[0]
+        return self.courts[key]
 
     def convert_to_cl_data_model(self, row, source):
         """Convert the CSV dict with it's headers to our data model"""
@@ -2,17 +2,20 @@
 # Code for merging PACER content into the DB
 import logging
 import re
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+from celery.exceptions import Retry
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.db import IntegrityError, OperationalError, transaction
-from django.db.models import Prefetch, Q
+from django.db.models import Count, Prefetch, Q
 from django.utils.timezone import now
 from juriscraper.lib.string_utils import CaseNameTweaker
 from juriscraper.pacer import AttachmentPage
 
 from cl.corpus_importer.utils import mark_ia_upload_needed
+from cl.lib.db_tools import bulk_update
 from cl.lib.decorators import retry
 from cl.lib.filesizes import convert_size_to_bytes
 from cl.lib.import_lib import get_candidate_judges
@@ -560,9 +563,251 @@ def get_or_make_docket_entry(d, docket_entry):
     return de, de_created
 
 
+def get_date_filed(docket_entry):
+    """Get the date filed of a docket entry dict as a date object."""
+    date_filed = docket_entry["date_filed"]
+    if isinstance(date_filed, datetime):
+        # For now we do dumb date conversion. This simply returns a date
+        # object with the same year, month, and day, ignoring time and
+        # timezones. Once the DB is upgraded to support timezones, we can
+        # do better.
+        date_filed = date_filed.date()
+    return date_filed
+
+
+def get_entry_number(docket_entry):
+    """Get the entry number of a numbered docket entry dict as an int, or
+    None if it doesn't have a usable one.
+    """
+    if not docket_entry["document_number"]:
+        return None
+    try:
+        return int(docket_entry["document_number"])
+    except (TypeError, ValueError):
+        return None
+
+
+def add_numbered_docket_entries(d, docket_entries, tags=None):
+    """Update or create numbered docket entries and their documents in bulk.
+
+    This does the same thing as the loop in add_docket_entries, but rather
+    than looking up, creating or saving each entry and document one at a time,
+    it fetches the existing ones with a query each, works out what needs to
+    change in memory, then writes the changes with a few bulk queries. Only
+    entries and documents that actually changed are saved.
+
+    :param d: The docket object to add things to and use for lookups.
+    :param docket_entries: A list of dicts containing docket entry data. Each
+    must have an integer document_number.
+    :param tags: A list of tag objects to apply to the recap documents and
+    docket entries created or updated in this function.
+    :returns tuple of a list of RECAPDocument objects created and whether the
+    any docket entry was created.
+    """
+    if not docket_entries:
+        return [], False
+
+    des_by_number = defaultdict(list)
+    for de in DocketEntry.objects.filter(
+        docket=d,
+        entry_number__in=set(get_entry_number(e) for e in docket_entries),
+    ):
+        des_by_number[de.entry_number].append(de)
+
+    # Update or make the docket entries
+    de_fields = [
+        "description",
+        "date_filed",
+        "pacer_sequence_number",
+        "recap_sequence_number",
+    ]
+    des_to_create = []
+    des_to_update = {}
+    entries = []
+    for docket_entry in docket_entries:
+        entry_number = get_entry_number(docket_entry)
+        des = des_by_number[entry_number]
+        if len(des) > 1:
+            logger.error(
+                "Multiple docket entries found for document "
+                "entry number '%s' while processing '%s'",
+                entry_number,
+                d,
+            )
+            continue
+        elif des:
+            de = des[0]
+        else:
+            de = DocketEntry(docket=d, entry_number=entry_number)
+            des.append(de)
+            des_to_create.append(de)
+
+        old_values = [getattr(de, field) for field in de_fields]
+        de.description = docket_entry["description"] or de.description
+        de.date_filed = get_date_filed(docket_entry) or de.date_filed
+        de.pacer_sequence_number = (
+            docket_entry.get("pacer_seq_no") or de.pacer_sequence_number
+        )
+        de.recap_sequence_number = docket_entry["recap_sequence_number"]
+        if de.pk is not None and old_values != [
+            getattr(de, field) for field in de_fields
+        ]:
+            des_to_update[de.pk] = de
+        entries.append((de, docket_entry))
+
+    right_now = now()
+    DocketEntry.objects.bulk_create(des_to_create)
+    for de in des_to_update.values():
+        de.date_modified = right_now
+    bulk_update(list(des_to_update.values()), de_fields + ["date_modified"])
+
+    # Then make the RECAPDocument objects. Try to find them. If we do, update
+    # the pacer_doc_id field if it's blank. If we can't find them, create
+    # them.
+    created_de_pks = set(de.pk for de in des_to_create)
+    rds_by_key = defaultdict(list)
+    for rd in RECAPDocument.objects.filter(
+        docket_entry_id__in=set(
+            de.pk for de, _ in entries if de.pk not in created_de_pks
+        )
+    ):
+        rds_by_key[
+            (
+                rd.docket_entry_id,
+                rd.document_number,
+                rd.document_type,
+                rd.attachment_number,
+            )
+        ].append(rd)
+
+    rds_to_create = []
+    rds_to_update = {}
+    tagged = []
+    for de, docket_entry in entries:
+        tagged.append(de)
+        if docket_entry.get("attachment_number"):
+            document_type = RECAPDocument.ATTACHMENT
+            attachment_number = docket_entry["attachment_number"]
+        else:
+            document_type = RECAPDocument.PACER_DOCUMENT
+            attachment_number = None
+        document_number = "%s" % docket_entry["document_number"]
+        rds = rds_by_key[
+            (de.pk, document_number, document_type, attachment_number)
+        ]
+        if len(rds) > 1:
+            logger.info(
+                "Multiple recap documents found for document entry number'%s' "
+                "while processing '%s'" % (docket_entry["document_number"], d)
+            )
+            continue
+        elif rds:
+            rd = rds[0]
+        else:
+            rd = RECAPDocument(
+                docket_entry=de,
+                document_number=document_number,
+                document_type=document_type,
+                attachment_number=attachment_number,
+                pacer_doc_id=docket_entry["pacer_doc_id"] or "",
+                is_available=False,
+            )
+            rds.append(rd)
+            rds_to_create.append(rd)
+
+        old_values = [rd.pacer_doc_id, rd.description]
+        rd.pacer_doc_id = rd.pacer_doc_id or docket_entry["pacer_doc_id"] or ""
+        rd.description = (
+            docket_entry.get("short_description") or rd.description
+        )
+        if rd.pk is not None and old_values != [
+            rd.pacer_doc_id,
+            rd.description,
+        ]:
+            rds_to_update[rd.pk] = rd
+        tagged.append(rd)
+
+    rds_created = []
+    try:
+        with transaction.atomic():
+            RECAPDocument.objects.bulk_create(rds_to_create)
+    except IntegrityError:
+        # Happens from race conditions. Save them one at a time instead,
+        # skipping the ones that were created elsewhere.
+        for rd in rds_to_create:
+            try:
+                with transaction.atomic():
+                    rd.save()
+            except (IntegrityError, ValidationError):
+                continue
+            rds_created.append(rd)
+    else:
+        rds_created = resolve_duplicate_main_documents(rds_to_create)
+    for rd in rds_to_update.values():
+        rd.date_modified = right_now
+    bulk_update(
+        list(rds_to_update.values()),
+        ["pacer_doc_id", "description", "date_modified"],
+    )
+
+    if tags:
+        tagged = [thing for thing in tagged if thing.pk is not None]
+        for tag in tags:
+            tag.tag_objects(tagged)
+
+    return rds_created, bool(des_to_create)
+
+
+def resolve_duplicate_main_documents(rds):
+    """Deal with main documents that were created in bulk alongside others
+    like them.
+
+    Main documents have no attachment number, so the DB's unique constraint
+    can't catch duplicates of them, and bulk_create skips the check that
+    RECAPDocument.save does. They only happen in race conditions, so look
+    for them all in one query, and send just those through save to be
+    resolved. The ones that can't be are deleted.
+
+    :param rds: The RECAPDocuments that were created in bulk.
+    :return: The ones that are left.
+    """
+    main_rds = [rd for rd in rds if rd.attachment_number is None]
+    if not main_rds:
+        return rds
+    duplicate_keys = set(
+        RECAPDocument.objects.filter(
+            docket_entry_id__in=set(rd.docket_entry_id for rd in main_rds),
+            attachment_number=None,
+        )
+        # Without the default ordering, which would be grouped by too.
+        .order_by()
+        .values("docket_entry_id", "document_number")
+        .annotate(count=Count("pk"))
+        .filter(count__gt=1)
+        .values_list("docket_entry_id", "document_number")
+    )
+    if not duplicate_keys:
+        return rds
+
+    for rd in main_rds:
+        if (rd.docket_entry_id, rd.document_number) not in duplicate_keys:
+            continue
+        try:
+            with transaction.atomic():
+                rd.save()
+        except ValidationError:
+            rd.delete()
+    # Deleting them cleared their pks.
+    return [rd for rd in rds if rd.pk is not None]
+
+
 def add_docket_entries(d, docket_entries, tags=None):
     """Update or create the docket entries and documents.
 
+    Numbered docket entries are merged in bulk by add_numbered_docket_entries.
+    Unnumbered ones have to be found by their date and description, so they're
+    done one at a time.
+
     :param d: The docket object to add things to and use for lookups.
     :param docket_entries: A list of dicts containing docket entry data.
     :param tags: A list of tag objects to apply to the recap documents and
@@ -573,10 +818,15 @@ def add_docket_entries(d, docket_entries, tags=None):
     # Remove items without a date filed value.
     docket_entries = [de for de in docket_entries if de.get("date_filed")]
 
-    rds_created = []
-    content_updated = False
     calculate_recap_sequence_numbers(docket_entries)
+    rds_created, content_updated = add_numbered_docket_entries(
+        d,
+        [e for e in docket_entries if get_entry_number(e) is not None],
+        tags,
+    )
     for docket_entry in docket_entries:
+        if get_entry_number(docket_entry) is not None:
+            continue
         response = get_or_make_docket_entry(d, docket_entry)
         if response is None:
             continue
@@ -584,15 +834,7 @@ def add_docket_entries(d, docket_entries, tags=None):
             de, de_created = response[0], response[1]
 
         de.description = docket_entry["description"] or de.description
-        date_filed = docket_entry["date_filed"]
-        if isinstance(date_filed, datetime):
-            # For now we do dumb date conversion. This simply returns a date
-            # object with the same year, month, and day, ignoring time and
-            # timezones. Once the DB is upgraded to support timezones, we can
-            # do better.
-            date_filed = date_filed.date()
-
-        de.date_filed = date_filed or de.date_filed
+        de.date_filed = get_date_filed(docket_entry) or de.date_filed
         de.pacer_sequence_number = (
             docket_entry.get("pacer_seq_no") or de.pacer_sequence_number
         )
@@ -1309,13 +1551,13 @@ def process_orphan_documents(rds_created, court_id, docket_date):
         debug=False,
         date_modified__gt=cutoff_date,
     ).values_list("pk", flat=True)
-    for pq in pqs:
-        try:
-            from cl.recap.tasks import process_recap_pdf
+    if pqs:
+        from cl.recap.tasks import process_recap_pdfs
 
-            process_recap_pdf(pq)
-        except:
-            # We can ignore this. If we don't, we get all of the
-            # exceptions that were previously raised for the
-            # processing queue items a second time.
+        try:
+            process_recap_pdfs(list(pqs))
+        except Retry:
+            # Items that still can't be processed are marked as such and
+            # can be ignored. Any other failure has already been recorded on
+            # the item it happened to.
             pass
@@ -1,6 +1,7 @@
 # coding=utf-8
 import logging
 import os
+from collections import defaultdict
 from zipfile import ZipFile
 
 import requests
@@ -9,6 +10,8 @@ from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.text import slugify
 from django.utils.timezone import now
 from juriscraper.lib.exceptions import PacerLoginException, ParsingException
 from juriscraper.lib.string_utils import CaseNameTweaker, harmonize
@@ -31,13 +34,19 @@ from cl.corpus_importer.tasks import (
     update_rd_metadata,
 )
 from cl.corpus_importer.utils import mark_ia_upload_needed
-from cl.custom_filters.templatetags.text_filters import oxford_join
-from cl.lib.crypto import sha1
+from cl.custom_filters.templatetags.text_filters import (
+    best_case_name,
+    oxford_join,
+)
+from cl.lib.crypto import sha1_of_file
+from cl.lib.db_tools import bulk_update
 from cl.lib.filesizes import convert_size_to_bytes
 from cl.lib.pacer import map_cl_to_pacer_id
 from cl.lib.pacer_session import get_pacer_cookie_from_cache
 from cl.lib.recap_utils import get_document_filename
+from cl.lib.storage import save_file_by_path
 from cl.lib.string_diff import find_best_match
+from cl.lib.string_utils import trunc
 from cl.recap.mergers import (
     add_bankruptcy_data_to_docket,
     add_claims_to_docket,
@@ -273,7 +282,7 @@ def process_recap_pdf(self, pk):
 
     # Do the file, finally.
     try:
-        content = pq.filepath_local.read()
+        new_sha1 = sha1_of_file(pq.filepath_local.path)
     except IOError as exc:
         msg = "Internal processing error (%s: %s)." % (exc.errno, exc.strerror)
         if (self.request.retries == self.max_retries) or pq.debug:
@@ -283,7 +292,6 @@ def process_recap_pdf(self, pk):
             mark_pq_status(pq, msg, PROCESSING_STATUS.QUEUED_FOR_RETRY)
             raise self.retry(exc=exc)
 
-    new_sha1 = sha1(content)
     existing_document = all(
         [
             rd.sha1 == new_sha1,
@@ -294,25 +302,7 @@ def process_recap_pdf(self, pk):
     if not existing_document:
         # Different sha1, it wasn't available, or it's missing from disk. Move
         # the new file over from the processing queue storage.
-        cf = ContentFile(content)
-        file_name = get_document_filename(
-            rd.docket_entry.docket.court_id,
-            rd.docket_entry.docket.pacer_case_id,
-            rd.document_number,
-            rd.attachment_number,
-        )
-        if not pq.debug:
-            rd.filepath_local.save(file_name, cf, save=False)
-
-            # Do page count and extraction
-            extension = rd.filepath_local.path.split(".")[-1]
-            rd.page_count = get_page_count(rd.filepath_local.path, extension)
-            rd.file_size = rd.filepath_local.size
-
-        rd.ocr_status = None
-        rd.is_available = True
-        rd.sha1 = new_sha1
-        rd.date_upload = now()
+        copy_pq_file_to_rd(pq, rd, new_sha1)
 
     if not pq.debug:
         try:
@@ -337,6 +327,322 @@ def process_recap_pdf(self, pk):
     return rd
 
 
+def copy_pq_file_to_rd(pq, rd, new_sha1):
+    """Give a RECAPDocument the file of a processing queue item, without
+    reading it into memory. It's hard-linked if it can be, and copied a chunk
+    at a time if not.
+
+    :param pq: The ProcessingQueue item with the uploaded file
+    :param rd: The RECAPDocument to give the file to. It isn't saved.
+    :param new_sha1: The SHA1 of the uploaded file
+    """
+    if not pq.debug:
+        file_name = get_document_filename(
+            rd.docket_entry.docket.court_id,
+            rd.docket_entry.docket.pacer_case_id,
+            rd.document_number,
+            rd.attachment_number,
+        )
+        save_file_by_path(rd.filepath_local, file_name, pq.filepath_local.path)
+
+        # Do page count and extraction
+        extension = rd.filepath_local.path.split(".")[-1]
+        rd.page_count = get_page_count(rd.filepath_local.path, extension)
+        rd.file_size = rd.filepath_local.size
+
+    rd.ocr_status = None
+    rd.is_available = True
+    rd.sha1 = new_sha1
+    rd.date_upload = now()
+
+
+def find_rds_for_pqs(pqs):
+    """Find the RECAPDocuments that uploaded PDFs belong to, with a few
+    queries for all of them instead of several for each.
+
+    This looks for them the way process_recap_pdf does: by PACER document ID,
+    then by the docket, its entry and the document number. Documents that
+    aren't found are made, but not saved.
+
+    :param pqs: ProcessingQueue items of PDFs
+    :return: A tuple of two dicts, both keyed by the PKs of the items. The
+    first has the RECAPDocuments that were found or made. The second has, for
+    items that failed, a tuple of the error message, and whether to retry
+    because their docket or docket entry might yet be uploaded.
+    """
+    rds = {}
+    errors = {}
+
+    # By PACER document ID.
+    q = Q(pacer_doc_id__in={pq.pacer_doc_id for pq in pqs if pq.pacer_doc_id})
+    case_ids = {pq.pacer_case_id for pq in pqs if not pq.pacer_doc_id}
+    case_ids.discard("")
+    if case_ids:
+        q |= Q(
+            pacer_doc_id="", docket_entry__docket__pacer_case_id__in=case_ids
+        )
+    rds_by_doc_id = defaultdict(list)
+    for rd in RECAPDocument.objects.filter(q).select_related(
+        "docket_entry__docket"
+    ):
+        rds_by_doc_id[rd.pacer_doc_id].append(rd)
+
+    unfound = []
+    for pq in pqs:
+        matches = rds_by_doc_id[pq.pacer_doc_id]
+        if pq.pacer_case_id:
+            matches = [
+                rd
+                for rd in matches
+                if rd.docket_entry.docket.pacer_case_id == pq.pacer_case_id
+            ]
+        elif not pq.pacer_doc_id:
+            # Neither ID. There could be countless documents without a PACER
+            # document ID, so don't try.
+            matches = []
+        if len(matches) == 1:
+            rds[pq.pk] = matches[0]
+        else:
+            unfound.append(pq)
+    if not unfound:
+        return rds, errors
+
+    # By docket.
+    dockets = defaultdict(list)
+    for d in Docket.objects.filter(
+        pacer_case_id__in={pq.pacer_case_id for pq in unfound},
+        court_id__in={pq.court_id for pq in unfound},
+    ):
+        dockets[(d.court_id, d.pacer_case_id)].append(d)
+    pqs_by_docket = []
+    for pq in unfound:
+        matches = dockets[(pq.court_id, pq.pacer_case_id)]
+        if not matches:
+            errors[pq.pk] = ("Unable to find docket for item.", True)
+        elif len(matches) > 1:
+            errors[pq.pk] = (
+                "Too many dockets found when trying to save '%s'" % pq,
+                False,
+            )
+        else:
+            pqs_by_docket.append((pq, matches[0]))
+    if not pqs_by_docket:
+        return rds, errors
+
+    # By docket entry.
+    entries = defaultdict(list)
+    for de in DocketEntry.objects.filter(
+        docket_id__in={d.pk for pq, d in pqs_by_docket},
+        entry_number__in={pq.document_number for pq, d in pqs_by_docket},
+    ).select_related("docket"):
+        entries[(de.docket_id, de.entry_number)].append(de)
+    pqs_by_entry = []
+    for pq, d in pqs_by_docket:
+        matches = entries[(d.pk, pq.document_number)]
+        if not matches:
+            errors[pq.pk] = ("Unable to find docket entry for item.", True)
+        elif len(matches) > 1:
+            errors[pq.pk] = (
+                "Too many docket entries found when trying to save '%s'" % pq,
+                False,
+            )
+        else:
+            pqs_by_entry.append((pq, matches[0]))
+    if not pqs_by_entry:
+        return rds, errors
+
+    # By document number, for when the PACER document ID is missing.
+    entry_rds = defaultdict(list)
+    des = {de.pk: de for pq, de in pqs_by_entry}
+    for rd in RECAPDocument.objects.filter(docket_entry_id__in=des):
+        rd.docket_entry = des[rd.docket_entry_id]
+        key = (
+            rd.docket_entry_id,
+            rd.document_number,
+            rd.attachment_number,
+            rd.document_type,
+        )
+        entry_rds[key].append(rd)
+    for pq, de in pqs_by_entry:
+        if pq.attachment_number is None:
+            document_type = RECAPDocument.PACER_DOCUMENT
+        else:
+            document_type = RECAPDocument.ATTACHMENT
+        key = (
+            de.pk,
+            str(pq.document_number),
+            pq.attachment_number,
+            document_type,
+        )
+        matches = entry_rds[key]
+        if len(matches) != 1:
+            # Unable to find it. Make a new item, and share it with any other
+            # uploads of the same document.
+            entry_rds[key] = matches = [
+                RECAPDocument(
+                    docket_entry=de,
+                    pacer_doc_id=pq.pacer_doc_id,
+                    document_type=document_type,
+                )
+            ]
+        rds[pq.pk] = matches[0]
+    return rds, errors
+
+
+def save_pq_file_to_rd(pq, rd):
+    """Save the file of an uploaded PDF to its RECAPDocument, unless the
+    document already has it.
+
+    :param pq: The ProcessingQueue object of the upload.
+    :param rd: The RECAPDocument it goes with. It's saved unless pq is a debug
+    upload.
+    :return: A tuple of an error message, which is None if all went well,
+    whether the upload should be retried, and whether the document got a new
+    file that needs extraction.
+    """
+    rd.document_number = pq.document_number
+    rd.attachment_number = pq.attachment_number
+    try:
+        new_sha1 = sha1_of_file(pq.filepath_local.path)
+    except IOError as exc:
+        msg = "Internal processing error (%s: %s)." % (
+            exc.errno,
+            exc.strerror,
+        )
+        return msg, True, False
+
+    existing_document = all(
+        [
+            rd.sha1 == new_sha1,
+            rd.is_available,
+            rd.filepath_local and os.path.isfile(rd.filepath_local.path),
+        ]
+    )
+    if not existing_document:
+        copy_pq_file_to_rd(pq, rd, new_sha1)
+
+    if pq.debug:
+        return None, False, False
+    try:
+        with transaction.atomic():
+            rd.save()
+    except (IntegrityError, ValidationError):
+        rd.filepath_local.delete(save=False)
+        return "Duplicate key on unique_together constraint", False, False
+    return None, False, not existing_document
+
+
+def extract_new_rds(new_rds):
+    """Extract the new documents of a batch of uploads and index them.
+
+    They're extracted together. If that fails, they're done one at a time, so
+    only the uploads whose documents can't be extracted are failed.
+
+    :param new_rds: A list of (ProcessingQueue, RECAPDocument) tuples.
+    :return: A set of the PKs of the ProcessingQueue objects that failed.
+    """
+    if not new_rds:
+        return set()
+    try:
+        extract_recap_pdf([rd.pk for pq, rd in new_rds])
+    except Exception:
+        logger.exception("Unable to extract a batch of RECAP PDFs.")
+    else:
+        add_items_to_solr(
+            [rd.pk for pq, rd in new_rds], "search.RECAPDocument"
+        )
+        return set()
+
+    failed_pks = set()
+    extracted = []
+    for pq, rd in new_rds:
+        try:
+            extract_recap_pdf(rd.pk)
+        except Exception:
+            logger.exception("Unable to extract %s", rd)
+            mark_pq_status(
+                pq, "Internal processing error.", PROCESSING_STATUS.FAILED
+            )
+            failed_pks.add(pq.pk)
+        else:
+            extracted.append(rd.pk)
+    if extracted:
+        add_items_to_solr(extracted, "search.RECAPDocument")
+    return failed_pks
+
+
+@app.task(
+    bind=True, max_retries=2, interval_start=5 * 60, interval_step=10 * 60
+)
+def process_recap_pdfs(self, pks):
+    """Process many uploaded PDFs at once, like process_recap_pdf does one.
+
+    The documents of all the uploads are looked up together, the files are
+    hashed and copied without reading them into memory, the new ones are
+    extracted together and sent to Solr in one go, and each docket is marked
+    for upload to the Internet Archive once.
+
+    :param pks: The PKs of the processing queue items to work on.
+    :return: A list of the RECAPDocuments that were created or updated.
+    """
+    # Group them by docket, so their documents are handled together.
+    pqs = sorted(
+        ProcessingQueue.objects.filter(pk__in=pks),
+        key=lambda pq: (pq.court_id, pq.pacer_case_id, pq.pk),
+    )
+    logger.info("Processing %s RECAP PDFs.", len(pqs))
+    rds, errors = find_rds_for_pqs(pqs)
+
+    done = []
+    new_rds = []
+    retry_pks = []
+    can_retry = self.request.retries < self.max_retries
+    for pq in pqs:
+        if pq.pk in errors:
+            msg, retry = errors[pq.pk]
+        else:
+            mark_pq_status(pq, "", PROCESSING_STATUS.IN_PROGRESS)
+            rd = rds[pq.pk]
+            # An unexpected error only fails the item it happened on, so the
+            # rest of the batch isn't left in progress.
+            try:
+                msg, retry, is_new = save_pq_file_to_rd(pq, rd)
+            except Exception:
+                logger.exception("Unable to process %s", pq)
+                msg, retry = "Internal processing error.", False
+        if msg is not None:
+            if retry and can_retry and not pq.debug:
+                mark_pq_status(pq, msg, PROCESSING_STATUS.QUEUED_FOR_RETRY)
+                retry_pks.append(pq.pk)
+            else:
+                mark_pq_status(pq, msg, PROCESSING_STATUS.FAILED)
+            continue
+        if is_new:
+            new_rds.append((pq, rd))
+        done.append((pq, rd))
+
+    failed_pks = extract_new_rds(new_rds)
+    dockets = {}
+    for pq, rd in done:
+        if pq.pk in failed_pks:
+            continue
+        mark_pq_successful(
+            pq,
+            d_id=rd.docket_entry.docket_id,
+            de_id=rd.docket_entry_id,
+            rd_id=rd.pk,
+        )
+        dockets[rd.docket_entry.docket_id] = rd.docket_entry.docket
+    for d in dockets.values():
+        mark_ia_upload_needed(d, save_docket=True)
+
+    if retry_pks:
+        # Hopefully their dockets will be in place soon (they could be in
+        # different upload tasks that haven't yet been processed).
+        raise self.retry(args=(retry_pks,))
+    return [rd for pq, rd in done if pq.pk not in failed_pks]
+
+
 @app.task(bind=True, max_retries=5, ignore_result=True)
 def process_recap_zip(self, pk):
     """Process a zip uploaded from a PACER district court
@@ -371,7 +677,6 @@ def process_recap_zip(self, pk):
 
         # For each document in the zip, create a new PQ
         new_pqs = []
-        tasks = []
         for file_name in archive.namelist():
             file_content = archive.read(file_name)
             f = SimpleUploadedFile(file_name, file_content)
@@ -406,7 +711,9 @@ def process_recap_zip(self, pk):
                 debug=pq.debug,
             )
             new_pqs.append(new_pq.pk)
-            tasks.append(process_recap_pdf.delay(new_pq.pk))
+
+        # Process the PDFs together, since they're all on the same docket.
+        tasks = [process_recap_pdfs.delay(new_pqs)]
 
         # At the end, mark the pq as successful and return the PQ
         mark_pq_status(
@@ -907,19 +1214,12 @@ def process_recap_appellate_attachment(self, pk):
     return None
 
 
-@app.task
-def create_new_docket_from_idb(idb_row):
-    """Create a new docket for the IDB item found. Populate it with all
-    applicable fields.
-
-    :param idb_row: An FjcIntegratedDatabase object with which to create a
-    Docket.
-    :return Docket: The created Docket object.
-    """
+def make_docket_from_idb(idb_row):
+    """Make a new, unsaved docket for an IDB row."""
     case_name = idb_row.plaintiff + " v. " + idb_row.defendant
-    d = Docket(
+    return Docket(
         source=Docket.IDB,
-        court=idb_row.district,
+        court_id=idb_row.district_id,
         idb_data=idb_row,
         date_filed=idb_row.date_filed,
         date_terminated=idb_row.date_terminated,
@@ -929,6 +1229,18 @@ def create_new_docket_from_idb(idb_row):
         nature_of_suit=idb_row.get_nature_of_suit_display(),
         jurisdiction_type=idb_row.get_jurisdiction_display() or "",
     )
+
+
+@app.task
+def create_new_docket_from_idb(idb_row):
+    """Create a new docket for the IDB item found. Populate it with all
+    applicable fields.
+
+    :param idb_row: An FjcIntegratedDatabase object with which to create a
+    Docket.
+    :return Docket: The created Docket object.
+    """
+    d = make_docket_from_idb(idb_row)
     try:
         d.save()
     except IntegrityError:
@@ -943,15 +1255,19 @@ def create_new_docket_from_idb(idb_row):
     return d.pk
 
 
-@app.task
-def merge_docket_with_idb(d, idb_row):
-    """Merge an existing docket with an idb_row.
+# The fields of a docket that merging an IDB row into it can change.
+IDB_MERGE_FIELDS = [
+    "source",
+    "idb_data",
+    "date_filed",
+    "date_terminated",
+    "nature_of_suit",
+    "jurisdiction_type",
+]
 
-    :param d: A Docket object pk to update.
-    :param idb_row: A FjcIntegratedDatabase object to use as a source for
-    updates.
-    :return None
-    """
+
+def apply_idb_to_docket(d, idb_row):
+    """Merge an IDB row into a docket, without saving it."""
     d.add_idb_source()
     d.idb_data = idb_row
     d.date_filed = d.date_filed or idb_row.date_filed
@@ -960,6 +1276,18 @@ def merge_docket_with_idb(d, idb_row):
     d.jurisdiction_type = (
         d.jurisdiction_type or idb_row.get_jurisdiction_display()
     )
+
+
+@app.task
+def merge_docket_with_idb(d, idb_row):
+    """Merge an existing docket with an idb_row.
+
+    :param d: A Docket object pk to update.
+    :param idb_row: A FjcIntegratedDatabase object to use as a source for
+    updates.
+    :return None
+    """
+    apply_idb_to_docket(d, idb_row)
     try:
         d.save()
     except IntegrityError:
@@ -1011,49 +1339,116 @@ def do_heuristic_match(idb_row, ds):
     return d
 
 
+# Dockets with these in their docket number or case name are never matched to
+# IDB rows.
+IDB_EXCLUDED_DOCKET_NUMBERS = ["cr"]
+IDB_EXCLUDED_CASE_NAMES = ["sealed", "suppressed", "search warrant"]
+
+
+def get_idb_candidates(idb_rows):
+    """Get the dockets that IDB rows might be merged into, in one query.
+
+    :param idb_rows: A list of FjcIntegratedDatabase objects.
+    :return: A dict mapping (court ID, docket number core) keys to lists of
+    the dockets with them, in order of their pks.
+    """
+    ds = Docket.objects.filter(
+        court_id__in={row.district_id for row in idb_rows},
+        docket_number_core__in={row.docket_number for row in idb_rows},
+    )
+    for s in IDB_EXCLUDED_DOCKET_NUMBERS:
+        ds = ds.exclude(docket_number__icontains=s)
+    for s in IDB_EXCLUDED_CASE_NAMES:
+        ds = ds.exclude(case_name__icontains=s)
+    candidates = {}
+    for d in ds.order_by("pk"):
+        key = (d.court_id, d.docket_number_core)
+        candidates.setdefault(key, []).append(d)
+    return candidates
+
+
+def is_idb_candidate(d):
+    """Would a docket be one of the candidates from get_idb_candidates?"""
+    docket_number = (d.docket_number or "").lower()
+    case_name = d.case_name.lower()
+    return not (
+        any(s in docket_number for s in IDB_EXCLUDED_DOCKET_NUMBERS)
+        or any(s in case_name for s in IDB_EXCLUDED_CASE_NAMES)
+    )
+
+
 @app.task
 def create_or_merge_from_idb_chunk(idb_chunk):
     """Take a chunk of IDB rows and either merge them into the Docket table or
     create new items for them in the docket table.
 
+    The dockets that the rows might match are looked up all at once, then
+    each row is matched in order, as if the dockets made and merged by the
+    rows before it had already been saved. At the end, the new dockets are
+    made and the merged ones are saved, a few queries for the whole chunk.
+
     :param idb_chunk: A list of FjcIntegratedDatabase PKs
     :type idb_chunk: list
     :return: None
     :rtype: None
     """
-    for idb_pk in idb_chunk:
-        idb_row = FjcIntegratedDatabase.objects.get(pk=idb_pk)
-        ds = (
-            Docket.objects.filter(
-                docket_number_core=idb_row.docket_number,
-                court=idb_row.district,
-            )
-            .exclude(docket_number__icontains="cr")
-            .exclude(case_name__icontains="sealed")
-            .exclude(case_name__icontains="suppressed")
-            .exclude(case_name__icontains="search warrant")
-        )
-        count = ds.count()
-        if count == 0:
-            msg = "Creating new docket for IDB row: %s"
-            logger.info(msg, idb_row)
-            create_new_docket_from_idb(idb_row)
-            continue
-        elif count == 1:
+    order = {pk: i for i, pk in enumerate(idb_chunk)}
+    idb_rows = sorted(
+        FjcIntegratedDatabase.objects.filter(pk__in=idb_chunk).select_related(
+            "district"
+        ),
+        key=lambda row: order[row.pk],
+    )
+    candidates = get_idb_candidates(idb_rows)
+    new_dockets = []
+    merged_dockets = {}
+    for idb_row in idb_rows:
+        key = (idb_row.district_id, idb_row.docket_number)
+        ds = candidates.get(key, [])
+        d = None
+        if len(ds) == 1:
             d = ds[0]
             msg = "Merging Docket %s with IDB row: %s"
             logger.info(msg, d, idb_row)
-            merge_docket_with_idb(d, idb_row)
-            continue
-
-        msg = "Unable to merge. Got %s dockets for row: %s"
-        logger.info(msg, count, idb_row)
+        elif len(ds) > 1:
+            msg = "Unable to merge. Got %s dockets for row: %s"
+            logger.info(msg, len(ds), idb_row)
+            d = do_heuristic_match(idb_row, ds)
+        else:
+            msg = "Creating new docket for IDB row: %s"
+            logger.info(msg, idb_row)
 
-        d = do_heuristic_match(idb_row, ds)
-        if d is not None:
-            merge_docket_with_idb(d, idb_row)
+        if d is None:
+            d = make_docket_from_idb(idb_row)
+            new_dockets.append(d)
+            if is_idb_candidate(d):
+                candidates.setdefault(key, []).append(d)
         else:
-            create_new_docket_from_idb(idb_row)
+            apply_idb_to_docket(d, idb_row)
+            if d.pk is not None:
+                merged_dockets[d.pk] = d
+
+    with transaction.atomic():
+        # An IDB row can only belong to one docket. Let go of the chunk's rows
+        # first, so that moving them between dockets doesn't break that.
+        Docket.objects.filter(idb_data__in=idb_rows).update(
+            date_modified=now(), idb_data=None
+        )
+        for d in merged_dockets.values():
+            d.date_modified = now()
+        bulk_update(
+            list(merged_dockets.values()), IDB_MERGE_FIELDS + ["date_modified"]
+        )
+        for d in new_dockets:
+            # bulk_create doesn't call save(), which sets the slug.
+            d.slug = slugify(trunc(best_case_name(d), 75))
+        Docket.objects.bulk_create(new_dockets)
+    logger.info(
+        "Created %s dockets and merged %s dockets for %s IDB rows.",
+        len(new_dockets),
+        len(merged_dockets),
+        len(idb_rows),
+    )
 
 
 @app.task
@@ -8,7 +8,9 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from juriscraper.pacer import PacerRssFeed
 from rest_framework.status import (
@@ -28,17 +30,23 @@ from cl.people_db.models import (
     PartyType,
     Role,
 )
-from cl.recap.management.commands.import_idb import Command
+from cl.recap.constants import CV_2017
+from cl.recap.management.commands.import_idb import (
+    Command,
+    bulk_create_or_update_rows,
+)
 from cl.recap.mergers import (
     add_attorney,
     add_docket_entries,
     add_parties_and_attorneys,
     normalize_long_description,
+    resolve_duplicate_main_documents,
     update_case_names,
     update_docket_metadata,
 )
 from cl.recap.mergers import find_docket_object
 from cl.recap.models import (
+    FjcIntegratedDatabase,
     PacerFetchQueue,
     PROCESSING_STATUS,
     ProcessingQueue,
@@ -46,10 +54,13 @@ from cl.recap.models import (
     REQUEST_TYPE,
 )
 from cl.recap.tasks import (
+    copy_pq_file_to_rd,
+    create_or_merge_from_idb_chunk,
     process_recap_appellate_docket,
     process_recap_attachment,
     process_recap_docket,
     process_recap_pdf,
+    process_recap_pdfs,
     process_recap_zip,
     process_recap_claims_register,
     do_pacer_fetch,
@@ -59,6 +70,7 @@ from cl.search.models import (
     DocketEntry,
     OriginatingCourtInformation,
     RECAPDocument,
+    Tag,
 )
 from cl.tests import fakes
 
@@ -663,6 +675,71 @@ class RecapPdfTaskTest(TestCase):
         self.assertEqual(self.pq.status, PROCESSING_STATUS.QUEUED_FOR_RETRY)
         self.assertIn("Unable to find docket", self.pq.error_message)
 
+    @mock.patch("cl.recap.tasks.extract_recap_pdf")
+    def test_process_many_pdfs(self, mock):
+        """Can we process several PDFs on a docket at once?"""
+        att_pq = ProcessingQueue.objects.create(
+            court_id="scotus",
+            uploader=self.pq.uploader,
+            pacer_case_id="asdf",
+            document_number="1",
+            attachment_number=2,
+            filepath_local=SimpleUploadedFile("att.pdf", b"attachment"),
+            upload_type=UPLOAD_TYPE.PDF,
+        )
+        rds = process_recap_pdfs([self.pq.pk, att_pq.pk])
+
+        # The main document was found by its ID, and the attachment was made.
+        self.assertEqual(len(rds), 2)
+        self.assertEqual(rds[0], self.rd)
+        att_rd = rds[1]
+        self.assertEqual(att_rd.docket_entry, self.de)
+        self.assertEqual(att_rd.attachment_number, 2)
+        self.assertEqual(att_rd.document_type, RECAPDocument.ATTACHMENT)
+        for rd in rds:
+            rd.refresh_from_db()
+            self.assertTrue(rd.is_available)
+            self.assertTrue(rd.filepath_local)
+
+        # They were extracted together.
+        mock.assert_called_once_with([self.rd.pk, att_rd.pk])
+        for pq in [self.pq, att_pq]:
+            pq.refresh_from_db()
+            self.assertEqual(pq.status, PROCESSING_STATUS.SUCCESSFUL)
+            self.assertFalse(pq.filepath_local)
+
+    @mock.patch("cl.recap.tasks.extract_recap_pdf")
+    def test_error_only_fails_its_pdf(self, mock_extract):
+        """If one PDF of a batch hits an unexpected error, is only that one
+        failed, and not left in progress with the rest?
+        """
+        att_pq = ProcessingQueue.objects.create(
+            court_id="scotus",
+            uploader=self.pq.uploader,
+            pacer_case_id="asdf",
+            document_number="1",
+            attachment_number=2,
+            filepath_local=SimpleUploadedFile("att.pdf", b"attachment"),
+            upload_type=UPLOAD_TYPE.PDF,
+        )
+
+        def fail_on_attachment(pq, rd, new_sha1):
+            if pq.pk == att_pq.pk:
+                raise ValueError("Unexpected")
+            return copy_pq_file_to_rd(pq, rd, new_sha1)
+
+        with mock.patch(
+            "cl.recap.tasks.copy_pq_file_to_rd", side_effect=fail_on_attachment
+        ):
+            rds = process_recap_pdfs([self.pq.pk, att_pq.pk])
+
+        self.assertEqual(rds, [self.rd])
+        self.pq.refresh_from_db()
+        self.assertEqual(self.pq.status, PROCESSING_STATUS.SUCCESSFUL)
+        att_pq.refresh_from_db()
+        self.assertEqual(att_pq.status, PROCESSING_STATUS.FAILED)
+        self.assertEqual(att_pq.error_message, "Internal processing error.")
+
 
 class RecapZipTaskTest(TestCase):
     """Do we do good things when people send us zips?"""
@@ -756,9 +833,11 @@ class RecapZipTaskTest(TestCase):
                 "it was not processed properly by the PDF processor.",
             )
 
-        # Was the mock called once per PDF in the zip?
-        expected_call_count = len(results["new_pqs"])
-        self.assertEqual(mock.call_count, expected_call_count)
+        # Were the PDFs in the zip extracted together?
+        mock.assert_called_once()
+        self.assertEqual(
+            sorted(mock.call_args[0][0]), sorted(d.pk for d in self.docs)
+        )
 
 
 class RecapAddAttorneyTest(TestCase):
@@ -1212,6 +1291,108 @@ class RecapMinuteEntriesTest(TestCase):
         self.assertEqual(d.docket_entries.count(), expected_item_count)
 
 
+class AddDocketEntriesTest(TestCase):
+    """Do numbered docket entries get merged properly in bulk?"""
+
+    def setUp(self):
+        self.d = Docket.objects.create(source=0, court_id="scotus")
+        self.tag = Tag.objects.create(name="test-tag")
+        self.docket_entries = [
+            {
+                "date_filed": date(2014, 11, 16),
+                "description": "Entry %s" % i,
+                "document_number": str(i),
+                "pacer_doc_id": "0350423105%s" % i,
+                "pacer_seq_no": None,
+            }
+            for i in range(1, 4)
+        ]
+        self.docket_entries.append(
+            {
+                "date_filed": date(2014, 11, 16),
+                "description": "",
+                "document_number": "3",
+                "attachment_number": 1,
+                "pacer_doc_id": "03504231054",
+                "pacer_seq_no": None,
+            }
+        )
+
+    def tearDown(self):
+        Docket.objects.all().delete()
+        Tag.objects.all().delete()
+
+    def test_adding_and_updating_entries(self):
+        """Are entries and documents created once, updated after that, and
+        tagged?
+        """
+        rds_created, content_updated = add_docket_entries(
+            self.d, self.docket_entries, tags=[self.tag]
+        )
+        self.assertEqual(len(rds_created), 4)
+        self.assertTrue(content_updated)
+        self.assertEqual(self.d.docket_entries.count(), 3)
+        self.assertEqual(self.tag.docket_entries.count(), 3)
+        self.assertEqual(self.tag.recap_documents.count(), 4)
+        de = self.d.docket_entries.get(entry_number=3)
+        self.assertEqual(de.description, "Entry 3")
+        self.assertEqual(de.recap_documents.count(), 2)
+
+        # Doing it again changes nothing.
+        rds_created, content_updated = add_docket_entries(
+            self.d, self.docket_entries, tags=[self.tag]
+        )
+        self.assertEqual(rds_created, [])
+        self.assertFalse(content_updated)
+        self.assertEqual(RECAPDocument.objects.count(), 4)
+
+        # But new values are saved.
+        self.docket_entries[0]["description"] = "New description"
+        add_docket_entries(self.d, self.docket_entries)
+        de = self.d.docket_entries.get(entry_number=1)
+        self.assertEqual(de.description, "New description")
+
+    def test_duplicate_main_documents_are_resolved(self):
+        """If a main document made in bulk turns out to have a duplicate made
+        elsewhere, is the duplicate resolved like RECAPDocument.save does?
+        """
+        de = DocketEntry.objects.create(docket=self.d, entry_number=1)
+
+        def make_rds(pacer_doc_id):
+            rd = RECAPDocument(
+                docket_entry=de,
+                document_number="1",
+                document_type=RECAPDocument.PACER_DOCUMENT,
+                pacer_doc_id=pacer_doc_id,
+            )
+            RECAPDocument.objects.bulk_create([rd])
+            return [rd]
+
+        # One made elsewhere with the same pacer_doc_id is replaced.
+        other = make_rds("03504231051")[0]
+        rds = make_rds("03504231051")
+        self.assertEqual(resolve_duplicate_main_documents(rds), rds)
+        self.assertFalse(RECAPDocument.objects.filter(pk=other.pk).exists())
+
+        # One with a different pacer_doc_id can't be, so ours goes.
+        rds = make_rds("03504231052")
+        self.assertEqual(resolve_duplicate_main_documents(rds), [])
+        self.assertEqual(de.recap_documents.count(), 1)
+
+    def test_entries_are_created_in_bulk(self):
+        """Are the documents of new entries created in a few queries, and
+        not a few for each of them?
+        """
+        docket_entries = [
+            dict(self.docket_entries[0], document_number=str(i))
+            for i in range(1, 51)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            rds_created, _ = add_docket_entries(self.d, docket_entries)
+        self.assertEqual(len(rds_created), 50)
+        self.assertLess(len(queries), 20)
+
+
 class DescriptionCleanupTest(TestCase):
     def test_has_entered_date_at_end(self):
         desc = "test (Entered: 01/01/2000)"
@@ -1603,3 +1784,121 @@ class IdbImportTest(TestCase):
             self.assertEqual(
                 self.cmd.make_csv_row_dict(qa[0], ["1", "2", "3"]), qa[1]
             )
+
+
+class IdbBulkImportTest(TestCase):
+    """Does the bulk importer create and update rows like the row by row
+    importer does?"""
+
+    fields = [
+        "dataset_source",
+        "district",
+        "docket_number",
+        "origin",
+        "date_filed",
+        "defendant",
+        "plaintiff",
+    ]
+
+    @staticmethod
+    def make_values(docket_number, defendant, plaintiff=""):
+        return {
+            "dataset_source": CV_2017,
+            "district": None,
+            "docket_number": docket_number,
+            "origin": 1,
+            "date_filed": date(2017, 1, 1),
+            "defendant": defendant,
+            "plaintiff": plaintiff,
+        }
+
+    def get_rows(self, docket_number):
+        return list(
+            FjcIntegratedDatabase.objects.filter(docket_number=docket_number)
+            .order_by("defendant")
+            .values_list("defendant", "plaintiff")
+        )
+
+    def test_bulk_create_or_update(self):
+        for docket_number, defendant in [
+            ("1", "A"),
+            ("3", "X"),
+            ("3", "Y"),
+            ("4", "W"),
+            ("4", "W"),
+        ]:
+            FjcIntegratedDatabase.objects.create(
+                **self.make_values(docket_number, defendant)
+            )
+        rows = [
+            # A key with one match: the last row updates it.
+            self.make_values("1", "A", "first"),
+            self.make_values("1", "B", "last"),
+            # A key with no match: the last row is created.
+            self.make_values("2", "C", "first"),
+            self.make_values("2", "C", "last"),
+            # A key with many matches is matched on defendant too...
+            self.make_values("3", "X", "updated"),
+            self.make_values("3", "Z", "created"),
+            # ...and skipped if that has many matches too.
+            self.make_values("4", "W", "skipped"),
+        ]
+        result = bulk_create_or_update_rows(rows, self.fields)
+
+        self.assertEqual(result, {"created": 2, "updated": 2, "skipped": 1})
+        self.assertEqual(self.get_rows("1"), [("B", "last")])
+        self.assertEqual(self.get_rows("2"), [("C", "last")])
+        self.assertEqual(
+            self.get_rows("3"),
+            [("X", "updated"), ("Y", ""), ("Z", "created")],
+        )
+        self.assertEqual(self.get_rows("4"), [("W", ""), ("W", "")])
+
+
+class IdbMergeTest(TestCase):
+    """Are IDB rows merged into the right dockets?"""
+
+    fixtures = ["canb_court.json"]
+
+    def make_idb_row(self, docket_number, defendant):
+        return FjcIntegratedDatabase.objects.create(
+            dataset_source=CV_2017,
+            district_id="canb",
+            docket_number=docket_number,
+            plaintiff="Lorem",
+            defendant=defendant,
+        )
+
+    def test_merge_chunk(self):
+        d = Docket.objects.create(
+            source=Docket.RECAP,
+            court_id="canb",
+            pacer_case_id="12345",
+            docket_number="1:17-cv-00001",
+            docket_number_core="1700001",
+            case_name="Lorem v. Ipsum",
+        )
+        # Not a candidate, b/c it's sealed.
+        Docket.objects.create(
+            source=Docket.RECAP,
+            court_id="canb",
+            pacer_case_id="12346",
+            docket_number="1:17-cv-00002",
+            docket_number_core="1700002",
+            case_name="Sealed v. Sealed",
+        )
+        merged = self.make_idb_row("1700001", "Ipsum")
+        first = self.make_idb_row("1700002", "Dolor")
+        second = self.make_idb_row("1700002", "Sit")
+
+        create_or_merge_from_idb_chunk([merged.pk, first.pk, second.pk])
+
+        d.refresh_from_db()
+        self.assertEqual(d.idb_data_id, merged.pk)
+        self.assertEqual(d.source, Docket.RECAP + Docket.IDB)
+        # The first row makes a docket, and the second is merged into it.
+        new_dockets = Docket.objects.filter(source=Docket.IDB)
+        self.assertEqual(new_dockets.count(), 1)
+        self.assertEqual(new_dockets[0].idb_data_id, second.pk)
+        self.assertEqual(new_dockets[0].case_name, "Lorem v. Dolor")
+        self.assertTrue(new_dockets[0].slug)
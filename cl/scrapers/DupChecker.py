@@ -14,6 +14,9 @@ class DupChecker(dict):
         self.dup_count = 0
         self.last_found_date = None
         self.emulate_break = False
+        self.known_sha1s = set()
+        self.known_urls = set()
+        self.checked_urls = set()
         super(DupChecker, self).__init__(*args, **kwargs)
 
     def _increment(self, current_date):
@@ -68,6 +71,31 @@ class DupChecker(dict):
             # no matter what.
             return False
 
+    def prefetch(self, queryset, download_urls):
+        """Look up what we already have for a page of items, so that press_on
+        doesn't need a query for each item.
+
+        The sha1s of the objects in queryset are loaded, so duplicates among
+        them are found without a query. Items with other sha1s are still
+        looked up one at a time, since a duplicate can be anywhere. The
+        download URLs are all looked up at once, and the answer is used the
+        first time press_on sees each of them.
+
+        :param queryset: The objects in the court and date range of the page.
+        :param download_urls: The download URLs of the items on the page.
+        """
+        self.known_sha1s = set(queryset.values_list("sha1", flat=True))
+        self.checked_urls = set(url for url in download_urls if url)
+        self.known_urls = set(
+            queryset.model.objects.filter(
+                download_url__in=self.checked_urls
+            ).values_list("download_url", flat=True)
+        )
+
+    def is_known_url(self, download_url):
+        """Whether prefetch found that we have an item with this URL."""
+        return download_url in self.known_urls
+
     def press_on(
         self,
         object_type,
@@ -100,13 +128,23 @@ class DupChecker(dict):
         if self.emulate_break:
             return False
 
-        # check for a duplicate in the db.
+        # check for a duplicate in the db, unless prefetch already did.
         if lookup_by == "sha1":
-            exists = object_type.objects.filter(sha1=lookup_value).exists()
+            exists = (
+                lookup_value in self.known_sha1s
+                or object_type.objects.filter(sha1=lookup_value).exists()
+            )
         elif lookup_by == "download_url":
-            exists = object_type.objects.filter(
-                download_url=lookup_value
-            ).exists()
+            if lookup_value in self.checked_urls:
+                # Only trust prefetch the first time a URL comes up. After
+                # that, an earlier item on the page with it may have been
+                # saved.
+                self.checked_urls.discard(lookup_value)
+                exists = lookup_value in self.known_urls
+            else:
+                exists = object_type.objects.filter(
+                    download_url=lookup_value
+                ).exists()
         else:
             raise NotImplementedError("Unknown lookup_by parameter.")
 
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""Getting the text out of the files we download.
+
+Each file is extracted in one pass that gets its text and, for PDFs, its page
+count and where each page starts, so nothing needs to open the file a second
+time. Most of the work happens in subprocesses (pdftotext, antiword, etc.), so
+files are extracted by a pool of threads that lives as long as the worker,
+and a batch of files can be extracted at once.
+
+The backend is set by the EXTRACTION_BACKEND setting.
+"""
+import subprocess
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.utils import PdfReadError
+from django.conf import settings
+from django.utils.encoding import (
+    smart_text,
+    DjangoUnicodeDecodeError,
+    force_text,
+)
+from django.utils.module_loading import import_string
+from lxml.etree import XMLSyntaxError
+from lxml.html.clean import Cleaner
+
+from cl.lib.recap_utils import needs_ocr
+
+DEVNULL = open("/dev/null", "w")
+
+ExtractionResult = namedtuple(
+    "ExtractionResult", ["content", "err", "page_count", "page_offsets"]
+)
+
+
+def get_clean_body_content(content):
+    """Parse out the body from an html string, clean it up, and send it along."""
+    cleaner = Cleaner(
+        style=True, remove_tags=["a", "body", "font", "noscript", "img"]
+    )
+    try:
+        return cleaner.clean_html(content)
+    except XMLSyntaxError:
+        return (
+            "Unable to extract the content from this file. Please try "
+            "reading the original."
+        )
+
+
+def extract_from_doc(path):
+    """Extract text from docs.
+
+    We use antiword to pull the text out of MS Doc files.
+    """
+    process = subprocess.Popen(
+        ["antiword", path, "-i", "1"],
+        shell=False,
+        stdout=subprocess.PIPE,
+        stderr=DEVNULL,
+    )
+    content, err = process.communicate()
+    return content, err
+
+
+def extract_from_docx(path):
+    """Extract text from docx files
+
+    We use docx2txt to pull out the text. Pretty simple.
+    """
+    process = subprocess.Popen(
+        ["docx2txt", path, "-"],
+        shell=False,
+        stdout=subprocess.PIPE,
+        stderr=DEVNULL,
+    )
+    content, err = process.communicate()
+    return content, err
+
+
+def extract_from_html(path):
+    """Extract from html.
+
+    A simple wrapper to go get content, and send it along.
+    """
+    try:
+        content = open(path).read()
+        content = get_clean_body_content(content)
+        encodings = ["utf-8", "ISO8859", "cp1252"]
+        for encoding in encodings:
+            try:
+                content = force_text(content, encoding=encoding)
+            except DjangoUnicodeDecodeError:
+                continue
+            else:
+                return content, False
+
+        # Fell through, therefore unable to decode the string.
+        return "", True
+    except:
+        return "", True
+
+
+def make_pdftotext_process(path):
+    """Make a subprocess to hand to higher-level code."""
+    return subprocess.Popen(
+        ["pdftotext", "-layout", "-enc", "UTF-8", path, "-"],
+        shell=False,
+        stdout=subprocess.PIPE,
+        stderr=DEVNULL,
+    )
+
+
+def extract_from_txt(path):
+    """Extract text from plain text files: A fool's errand.
+
+    Unfortunately, plain text files lack encoding information, so we have to
+    guess. We could guess ascii, but we may as well use a superset of ascii,
+    cp1252, and failing that try utf-8, ignoring errors. Most txt files we
+    encounter were produced by converting wpd or doc files to txt on a
+    Microsoft box, so assuming cp1252 as our first guess makes sense.
+
+    May we hope for a better world.
+    """
+    try:
+        err = False
+        data = open(path).read()
+        try:
+            # Alas, cp1252 is probably still more popular than utf-8.
+            content = smart_text(data, encoding="cp1252")
+        except DjangoUnicodeDecodeError:
+            content = smart_text(data, encoding="utf-8", errors="ignore")
+    except:
+        err = True
+        content = ""
+    return content, err
+
+
+def extract_from_wpd(path):
+    """Extract text from a Word Perfect file
+
+    Yes, courts still use these, so we extract their text using wpd2html. Once
+    that's done, we pull out the body of the HTML, and do some minor cleanup
+    on it.
+    """
+    process = subprocess.Popen(
+        ["wpd2html", path], shell=False, stdout=subprocess.PIPE, stderr=DEVNULL
+    )
+    content, err = process.communicate()
+    return get_clean_body_content(content), err
+
+
+def get_page_count(path, extension):
+    """Get the number of pages, if appropriate mimetype.
+
+    :param path: A path to a binary (pdf, wpd, doc, txt, html, etc.)
+    :param extension: The extension of the binary.
+    :return: The number of pages if possible, else return None
+    """
+    if extension == "pdf":
+        try:
+            reader = PdfFileReader(path)
+            return int(reader.getNumPages())
+        except (
+            IOError,
+            ValueError,
+            TypeError,
+            KeyError,
+            AssertionError,
+            PdfReadError,
+        ):
+            # IOError: File doesn't exist. My bad.
+            # ValueError: Didn't get an int for the page count. Their bad.
+            # TypeError: NumberObject has no attribute '__getitem__'. Ugh.
+            # KeyError, AssertionError: assert xrefstream["/Type"] == "/XRef". WTF?
+            # PdfReadError: Something else. I have no words.
+            pass
+    elif extension == "wpd":
+        # Best solution appears to be to dig into the binary format
+        pass
+    elif extension == "doc":
+        # Best solution appears to be to dig into the XML of the file
+        # itself: http://stackoverflow.com/a/12972502/64911
+        pass
+    return None
+
+
+def get_page_offsets(content):
+    """Find where each page starts in the output of pdftotext.
+
+    pdftotext ends every page, even blank ones, with a form feed.
+
+    :param content: The output of pdftotext.
+    :return: A list with the offset of the start of each page.
+    """
+    offsets = []
+    start = 0
+    end = content.find("\f")
+    while end != -1:
+        offsets.append(start)
+        start = end + 1
+        end = content.find("\f", start)
+    return offsets
+
+
+def split_pages(content, page_offsets):
+    """Split the output of pdftotext into pages, without their form feeds.
+
+    :param content: The output of pdftotext.
+    :param page_offsets: The offsets from get_page_offsets.
+    :return: A list with the text of each page.
+    """
+    ends = [offset - 1 for offset in page_offsets[1:]]
+    ends.append(content.rfind("\f"))
+    return [content[start:end] for start, end in zip(page_offsets, ends)]
+
+
+def get_pages_needing_ocr(pages):
+    """Find the pages of a PACER PDF that need OCR.
+
+    Many PDFs are mostly text with a few scanned pages, like exhibits. This
+    lets us OCR only the scanned pages.
+
+    :param pages: The pages of the PDF, from split_pages.
+    :return: A list of the page numbers that need OCR, counting from one.
+    """
+    return [i for i, page in enumerate(pages, start=1) if needs_ocr(page)]
+
+
+class CommandLineBackend(object):
+    """Extract files with the usual command line tools, from a pool of
+    threads.
+    """
+
+    extensions = ("doc", "docx", "html", "pdf", "txt", "wpd")
+
+    def __init__(self, processes=None):
+        self.processes = processes or settings.EXTRACTION_PROCESSES
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Made on first use, so that it's made in each worker after celery
+        # forks, and not in the parent.
+        if self._pool is None:
+            self._pool = ThreadPool(self.processes)
+        return self._pool
+
+    def extract(self, path, extension):
+        """Extract a file.
+
+        :param path: The path to the file.
+        :param extension: The extension of the file, without the dot.
+        :return: An ExtractionResult. The page count is None if it isn't
+        known, and the page offsets are only found for PDFs.
+        """
+        if extension == "pdf":
+            return self.extract_pdf(path)
+
+        extract = {
+            "doc": extract_from_doc,
+            "docx": extract_from_docx,
+            "html": extract_from_html,
+            "txt": extract_from_txt,
+            "wpd": extract_from_wpd,
+        }[extension]
+        content, err = extract(path)
+        return ExtractionResult(content, err, None, None)
+
+    def extract_pdf(self, path):
+        process = make_pdftotext_process(path)
+        content, err = process.communicate()
+        page_offsets = get_page_offsets(content)
+        if process.returncode == 0:
+            page_count = len(page_offsets)
+        else:
+            # pdftotext gave up part way through. Count the pages another way.
+            page_count = get_page_count(path, "pdf")
+        return ExtractionResult(content, err, page_count, page_offsets)
+
+    def extract_many(self, files):
+        """Extract many files at once.
+
+        :param files: An iterable of (path, extension) tuples.
+        :return: An iterator of ExtractionResults, in the same order as the
+        files.
+        """
+        return self.pool.imap(lambda f: self.extract(*f), files)
+
+
+_backend = None
+
+
+def get_extraction_backend():
+    """Get the extraction backend set in the EXTRACTION_BACKEND setting.
+
+    The backend is made once per process, so its pool stays warm.
+    """
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.EXTRACTION_BACKEND)()
+    return _backend
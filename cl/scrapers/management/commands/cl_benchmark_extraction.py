@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from django.conf import settings
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.scrapers.extraction import CommandLineBackend, get_page_count
+
+
+def get_test_files():
+    """Get the (path, extension) of each extractable file in our test
+    assets.
+    """
+    path = os.path.join(settings.MEDIA_ROOT, "test", "search")
+    files = []
+    for name in sorted(os.listdir(path)):
+        extension = name.split(".")[-1]
+        if extension in CommandLineBackend.extensions:
+            files.append((os.path.join(path, name), extension))
+    return files
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time text extraction of the files in our test assets, one at a "
+        "time the way we used to do it, and with the extraction backend's "
+        "pool of workers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="How many times to extract each file.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=settings.EXTRACTION_PROCESSES,
+            help="How many files the backend extracts at once.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        files = get_test_files()
+        by_type = {}
+        for path, extension in files:
+            by_type.setdefault(extension, []).append(path)
+
+        logger.info("type  files  serial files/sec  pooled files/sec")
+        for extension, paths in sorted(by_type.items()):
+            jobs = [(p, extension) for p in paths] * options["repeat"]
+            serial, pooled = self.time_jobs(jobs, options["processes"])
+            logger.info(
+                "%4s  %5d  %16.1f  %16.1f",
+                extension,
+                len(jobs),
+                len(jobs) / serial,
+                len(jobs) / pooled,
+            )
+
+        jobs = files * options["repeat"]
+        serial, pooled = self.time_jobs(jobs, options["processes"])
+        logger.info(
+            "all   %5d  %16.1f  %16.1f (%.2fx)",
+            len(jobs),
+            len(jobs) / serial,
+            len(jobs) / pooled,
+            serial / pooled,
+        )
+
+    @staticmethod
+    def time_jobs(jobs, processes):
+        """Time extracting some files one at a time, then with a warm pool.
+
+        The one at a time version also gets the page count of PDFs by parsing
+        them a second time, like we used to.
+
+        :return: A tuple of the seconds each took.
+        """
+        backend = CommandLineBackend(processes=1)
+        t1 = time.time()
+        for path, extension in jobs:
+            backend.extract(path, extension)
+            get_page_count(path, extension)
+        serial = time.time() - t1
+
+        backend = CommandLineBackend(processes=processes)
+        # Warm up the pool before starting the clock.
+        list(backend.extract_many(jobs[:processes]))
+        t1 = time.time()
+        for _ in backend.extract_many(jobs):
+            pass
+        pooled = time.time() - t1
+        return serial, pooled
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+from tempfile import NamedTemporaryFile
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from django.conf import settings
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.scrapers.tasks import extract_by_ocr
+
+
+def make_scanned_pdf(page_count, destination):
+    """Make a scanned PDF with page_count pages by repeating the pages of the
+    image-based PDF in our test assets.
+    """
+    source_path = os.path.join(
+        settings.MEDIA_ROOT, "test", "search", "opinion_pdf_image_based.pdf"
+    )
+    with open(source_path, "rb") as source:
+        reader = PdfFileReader(source)
+        writer = PdfFileWriter()
+        for i in range(page_count):
+            writer.addPage(reader.getPage(i % reader.getNumPages()))
+        writer.write(destination)
+
+
+class Command(VerboseCommand):
+    help = (
+        "Time OCR of a synthetic scanned PDF with different numbers of "
+        "processes, to see how extract_by_ocr scales with cores."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pages",
+            type=int,
+            default=40,
+            help="How many pages the synthetic PDF should have.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=lambda s: [int(n) for n in s.split(",")],
+            default=sorted(set([1, 2, 4, multiprocessing.cpu_count()])),
+            help="A comma-separated list of process counts to try. Defaults "
+            "to 1, 2, 4 and the number of CPUs.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        with NamedTemporaryFile(prefix="ocr_benchmark_", suffix=".pdf") as f:
+            make_scanned_pdf(options["pages"], f)
+            f.flush()
+
+            baseline = None
+            logger.info("processes  seconds  pages/sec  speedup")
+            for processes in options["processes"]:
+                t1 = time.time()
+                success, _ = extract_by_ocr(f.name, processes=processes)
+                elapsed = time.time() - t1
+                if not success:
+                    logger.error("OCR failed with %s processes.", processes)
+                    continue
+                baseline = baseline or elapsed
+                logger.info(
+                    "%9d  %7.1f  %9.2f  %6.2fx",
+                    processes,
+                    elapsed,
+                    options["pages"] / elapsed,
+                    baseline / elapsed,
+                )
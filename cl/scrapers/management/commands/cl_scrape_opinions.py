@@ -1,12 +1,14 @@
 import signal
 import sys
+import threading
 import time
 import traceback
 from datetime import date
+from multiprocessing.pool import ThreadPool
 
 from django.core.files.base import ContentFile
 from django.core.management.base import CommandError
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils.encoding import force_bytes
 from juriscraper.lib.importer import build_module_list
 from juriscraper.lib.string_utils import CaseNameTweaker
@@ -20,7 +22,12 @@ from cl.lib.string_utils import trunc
 from cl.scrapers.DupChecker import DupChecker
 from cl.scrapers.models import ErrorLog
 from cl.scrapers.tasks import extract_doc_content
-from cl.scrapers.utils import get_extension, get_binary_content, signal_handler
+from cl.scrapers.utils import (
+    HostLimiter,
+    get_binary_contents,
+    get_extension,
+    signal_handler,
+)
 from cl.search.models import Citation, Court, SEARCH_TYPES
 from cl.search.models import Docket
 from cl.search.models import Opinion
@@ -156,6 +163,7 @@ class Command(VerboseCommand):
 
     def __init__(self, stdout=None, stderr=None, no_color=False):
         super(Command, self).__init__(stdout=None, stderr=None, no_color=False)
+        self.host_limiter = HostLimiter(2)
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -200,6 +208,26 @@ class Command(VerboseCommand):
             default=False,
             help="Disable duplicate aborting.",
         )
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            default=1,
+            help=(
+                "How many courts to scrape at once. Courts are still started "
+                "at the pace set by --rate, but a slow court no longer holds "
+                "up the ones after it."
+            ),
+        )
+        parser.add_argument(
+            "--requests-per-host",
+            type=int,
+            default=2,
+            help=(
+                "How many requests to make to any one host at once, across "
+                "all the courts being scraped. Each court also downloads up "
+                "to this many of its items at once."
+            ),
+        )
 
     def scrape_court(self, site, full_crawl=False):
         download_error = False
@@ -212,88 +240,109 @@ class Command(VerboseCommand):
         if dup_checker.abort_by_url_hash(site.url, site.hash):
             return
 
+        if site.case_dates:
+            dup_checker.prefetch(
+                Opinion.objects.filter(
+                    cluster__docket__court=court,
+                    cluster__date_filed__gte=min(site.case_dates),
+                    cluster__date_filed__lte=max(site.case_dates),
+                ),
+                site.download_urls,
+            )
+        # Full crawls don't stop at duplicates, so don't download the items
+        # we already have.
+        skip = dup_checker.is_known_url if full_crawl else None
+
         if site.cookies:
             logger.info("Using cookies: %s" % site.cookies)
-        for i, item in enumerate(site):
-            msg, r = get_binary_content(
-                item["download_urls"],
-                site.cookies,
-                site._get_adapter_instance(),
-                method=site.method,
-            )
-            if msg:
-                logger.warning(msg)
-                ErrorLog(log_level="WARNING", court=court, message=msg).save()
-                continue
+        downloads = get_binary_contents(site, self.host_limiter, skip=skip)
+        try:
+            for i, item in enumerate(site):
+                if skip is not None and skip(item["download_urls"]):
+                    logger.info(
+                        "Skipping known download URL: %s"
+                        % item["download_urls"].encode("utf-8")
+                    )
+                    continue
+                msg, r = next(downloads)
+                if msg:
+                    logger.warning(msg)
+                    ErrorLog(
+                        log_level="WARNING", court=court, message=msg
+                    ).save()
+                    continue
 
-            content = site.cleanup_content(r.content)
+                content = site.cleanup_content(r.content)
 
-            current_date = item["case_dates"]
-            try:
-                next_date = site[i + 1]["case_dates"]
-            except IndexError:
-                next_date = None
-
-            # request.content is sometimes a str, sometimes unicode, so
-            # force it all to be bytes, pleasing hashlib.
-            sha1_hash = sha1(force_bytes(content))
-            if (
-                court_str == "nev"
-                and item["precedential_statuses"] == "Unpublished"
-            ):
-                # Nevada's non-precedential cases have different SHA1 sums
-                # every time.
-                lookup_params = {
-                    "lookup_value": item["download_urls"],
-                    "lookup_by": "download_url",
-                }
-            else:
-                lookup_params = {
-                    "lookup_value": sha1_hash,
-                    "lookup_by": "sha1",
-                }
-
-            proceed = dup_checker.press_on(
-                Opinion, current_date, next_date, **lookup_params
-            )
-            if dup_checker.emulate_break:
-                break
-            if not proceed:
-                continue
+                current_date = item["case_dates"]
+                try:
+                    next_date = site[i + 1]["case_dates"]
+                except IndexError:
+                    next_date = None
+
+                # request.content is sometimes a str, sometimes unicode, so
+                # force it all to be bytes, pleasing hashlib.
+                sha1_hash = sha1(force_bytes(content))
+                if (
+                    court_str == "nev"
+                    and item["precedential_statuses"] == "Unpublished"
+                ):
+                    # Nevada's non-precedential cases have different SHA1 sums
+                    # every time.
+                    lookup_params = {
+                        "lookup_value": item["download_urls"],
+                        "lookup_by": "download_url",
+                    }
+                else:
+                    lookup_params = {
+                        "lookup_value": sha1_hash,
+                        "lookup_by": "sha1",
+                    }
 
-            # Not a duplicate, carry on
-            logger.info(
-                "Adding new document found at: %s"
-                % item["download_urls"].encode("utf-8")
-            )
-            dup_checker.reset()
+                proceed = dup_checker.press_on(
+                    Opinion, current_date, next_date, **lookup_params
+                )
+                if dup_checker.emulate_break:
+                    break
+                if not proceed:
+                    continue
+
+                # Not a duplicate, carry on
+                logger.info(
+                    "Adding new document found at: %s"
+                    % item["download_urls"].encode("utf-8")
+                )
+                dup_checker.reset()
 
-            docket, opinion, cluster, citations, error = make_objects(
-                item, court, sha1_hash, content
-            )
+                docket, opinion, cluster, citations, error = make_objects(
+                    item, court, sha1_hash, content
+                )
 
-            if error:
-                download_error = True
-                continue
-
-            save_everything(
-                items={
-                    "docket": docket,
-                    "opinion": opinion,
-                    "cluster": cluster,
-                    "citations": citations,
-                },
-                index=False,
-            )
-            extract_doc_content.delay(
-                opinion.pk, do_ocr=True, citation_jitter=True
-            )
+                if error:
+                    download_error = True
+                    continue
+
+                save_everything(
+                    items={
+                        "docket": docket,
+                        "opinion": opinion,
+                        "cluster": cluster,
+                        "citations": citations,
+                    },
+                    index=False,
+                )
+                extract_doc_content.delay(
+                    opinion.pk, do_ocr=True, citation_jitter=True
+                )
 
-            logger.info(
-                "Successfully added doc {pk}: {name}".format(
-                    pk=opinion.pk, name=item["case_names"].encode("utf-8")
+                logger.info(
+                    "Successfully added doc {pk}: {name}".format(
+                        pk=opinion.pk, name=item["case_names"].encode("utf-8")
+                    )
                 )
-            )
+        finally:
+            # Stop any downloads still running, even if this failed.
+            downloads.close()
 
         # Update the hash if everything finishes properly.
         logger.info("%s: Successfully crawled opinions." % site.court_id)
@@ -302,9 +351,45 @@ class Command(VerboseCommand):
             dup_checker.update_site_hash(site.hash)
 
     def parse_and_scrape_site(self, mod, full_crawl):
-        site = mod.Site().parse()
+        site = mod.Site()
+        with self.host_limiter(site.url):
+            site.parse()
         self.scrape_court(site, full_crawl)
 
+    def scrape_module(self, mod, full_crawl):
+        """Scrape the court of a juriscraper module, logging any failure."""
+        # noinspection PyBroadException
+        try:
+            self.parse_and_scrape_site(mod, full_crawl)
+        except Exception as e:
+            # noinspection PyBroadException
+            try:
+                msg = (
+                    "********!! CRAWLER DOWN !!***********\n"
+                    "*****scrape_court method failed!*****\n"
+                    "********!! ACTION NEEDED !!**********\n%s"
+                    % traceback.format_exc()
+                )
+                logger.critical(msg)
+
+                # opinions.united_states.federal.ca9_u --> ca9
+                court_str = mod.Site.__module__.split(".")[-1].split("_")[0]
+                court = Court.objects.get(pk=court_str)
+                ErrorLog(log_level="CRITICAL", court=court, message=msg).save()
+            except Exception as e:
+                # This is very important. Without this, an exception
+                # above will crash the caller.
+                pass
+
+    def scrape_module_in_thread(self, mod, full_crawl, slots, running):
+        try:
+            self.scrape_module(mod, full_crawl)
+        finally:
+            # Each thread gets its own DB connection. Don't leave it open.
+            connection.close()
+            running.discard(mod.__name__)
+            slots.release()
+
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
         global die_now
@@ -318,46 +403,41 @@ class Command(VerboseCommand):
             raise CommandError("Unable to import module or package. Aborting.")
 
         logger.info("Starting up the scraper.")
+        self.host_limiter = HostLimiter(options["requests_per_host"])
+        parallel = options["parallel"]
+        if parallel > 1:
+            # Courts are scraped by a pool of threads. The slots keep us from
+            # starting a court until one of the running ones is done.
+            pool = ThreadPool(parallel)
+            slots = threading.BoundedSemaphore(parallel)
+            running = set()
         num_courts = len(module_strings)
         wait = (options["rate"] * 60) / num_courts
         i = 0
         while i < num_courts:
             # this catches SIGTERM, so the code can be killed safely.
             if die_now:
-                logger.info("The scraper has stopped.")
-                sys.exit(1)
+                break
 
             package, module = module_strings[i].rsplit(".", 1)
 
             mod = __import__(
                 "%s.%s" % (package, module), globals(), locals(), [module]
             )
-            # noinspection PyBroadException
             try:
-                self.parse_and_scrape_site(mod, options["full_crawl"])
-            except Exception as e:
-                # noinspection PyBroadException
-                try:
-                    msg = (
-                        "********!! CRAWLER DOWN !!***********\n"
-                        "*****scrape_court method failed!*****\n"
-                        "********!! ACTION NEEDED !!**********\n%s"
-                        % traceback.format_exc()
+                if parallel <= 1:
+                    self.scrape_module(mod, options["full_crawl"])
+                elif mod.__name__ in running:
+                    # In daemon mode, we can loop back around to a court
+                    # that's still being scraped.
+                    logger.info("%s is still running. Skipping." % module)
+                else:
+                    slots.acquire()
+                    running.add(mod.__name__)
+                    pool.apply_async(
+                        self.scrape_module_in_thread,
+                        (mod, options["full_crawl"], slots, running),
                     )
-                    logger.critical(msg)
-
-                    # opinions.united_states.federal.ca9_u --> ca9
-                    court_str = mod.Site.__module__.split(".")[-1].split("_")[
-                        0
-                    ]
-                    court = Court.objects.get(pk=court_str)
-                    ErrorLog(
-                        log_level="CRITICAL", court=court, message=msg
-                    ).save()
-                except Exception as e:
-                    # This is very important. Without this, an exception
-                    # above will crash the caller.
-                    pass
             finally:
                 time.sleep(wait)
                 last_court_in_list = i == (num_courts - 1)
@@ -371,5 +451,10 @@ class Command(VerboseCommand):
                 else:
                     i += 1
 
+        if parallel > 1:
+            # The pool's threads are daemons, so let the courts that are
+            # running finish before exiting, or they'd be killed mid-item.
+            pool.close()
+            pool.join()
         logger.info("The scraper has stopped.")
-        sys.exit(0)
+        sys.exit(1 if die_now else 0)
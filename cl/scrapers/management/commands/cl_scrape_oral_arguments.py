@@ -17,7 +17,7 @@ from cl.scrapers.DupChecker import DupChecker
 from cl.scrapers.management.commands import cl_scrape_opinions
 from cl.scrapers.models import ErrorLog
 from cl.scrapers.tasks import process_audio_file
-from cl.scrapers.utils import get_extension, get_binary_content
+from cl.scrapers.utils import get_extension, get_binary_contents
 from cl.search.models import Court, Docket, SEARCH_TYPES
 
 cnt = CaseNameTweaker()
@@ -114,74 +114,93 @@ class Command(cl_scrape_opinions.Command):
         dup_checker = DupChecker(court, full_crawl=full_crawl)
         abort = dup_checker.abort_by_url_hash(site.url, site.hash)
         if not abort:
+            if site.case_dates:
+                dup_checker.prefetch(
+                    Audio.objects.filter(
+                        docket__court=court,
+                        docket__date_argued__gte=min(site.case_dates),
+                        docket__date_argued__lte=max(site.case_dates),
+                    ),
+                    site.download_urls,
+                )
+            # Full crawls don't stop at duplicates, so don't download the
+            # items we already have.
+            skip = dup_checker.is_known_url if full_crawl else None
+
             if site.cookies:
                 logger.info("Using cookies: %s" % site.cookies)
-            for i, item in enumerate(site):
-                msg, r = get_binary_content(
-                    item["download_urls"],
-                    site.cookies,
-                    site._get_adapter_instance(),
-                    method=site.method,
-                )
-                if msg:
-                    logger.warning(msg)
-                    ErrorLog(
-                        log_level="WARNING", court=court, message=msg
-                    ).save()
-                    continue
-
-                content = site.cleanup_content(r.content)
-
-                current_date = item["case_dates"]
-                try:
-                    next_date = site[i + 1]["case_dates"]
-                except IndexError:
-                    next_date = None
-
-                # request.content is sometimes a str, sometimes unicode, so
-                # force it all to be bytes, pleasing hashlib.
-                sha1_hash = sha1(force_bytes(content))
-                onwards = dup_checker.press_on(
-                    Audio,
-                    current_date,
-                    next_date,
-                    lookup_value=sha1_hash,
-                    lookup_by="sha1",
-                )
-                if dup_checker.emulate_break:
-                    break
-
-                if onwards:
-                    # Not a duplicate, carry on
-                    logger.info(
-                        "Adding new document found at: %s"
-                        % item["download_urls"].encode("utf-8")
-                    )
-                    dup_checker.reset()
+            downloads = get_binary_contents(site, self.host_limiter, skip=skip)
+            try:
+                for i, item in enumerate(site):
+                    if skip is not None and skip(item["download_urls"]):
+                        logger.info(
+                            "Skipping known download URL: %s"
+                            % item["download_urls"].encode("utf-8")
+                        )
+                        continue
+                    msg, r = next(downloads)
+                    if msg:
+                        logger.warning(msg)
+                        ErrorLog(
+                            log_level="WARNING", court=court, message=msg
+                        ).save()
+                        continue
 
-                    docket, audio_file, error = make_objects(
-                        item, court, sha1_hash, content
+                    content = site.cleanup_content(r.content)
+
+                    current_date = item["case_dates"]
+                    try:
+                        next_date = site[i + 1]["case_dates"]
+                    except IndexError:
+                        next_date = None
+
+                    # request.content is sometimes a str, sometimes unicode, so
+                    # force it all to be bytes, pleasing hashlib.
+                    sha1_hash = sha1(force_bytes(content))
+                    onwards = dup_checker.press_on(
+                        Audio,
+                        current_date,
+                        next_date,
+                        lookup_value=sha1_hash,
+                        lookup_by="sha1",
                     )
+                    if dup_checker.emulate_break:
+                        break
+
+                    if onwards:
+                        # Not a duplicate, carry on
+                        logger.info(
+                            "Adding new document found at: %s"
+                            % item["download_urls"].encode("utf-8")
+                        )
+                        dup_checker.reset()
 
-                    if error:
-                        download_error = True
-                        continue
+                        docket, audio_file, error = make_objects(
+                            item, court, sha1_hash, content
+                        )
 
-                    save_everything(
-                        items={"docket": docket, "audio_file": audio_file},
-                        index=False,
-                        backscrape=backscrape,
-                    )
-                    process_audio_file.apply_async(
-                        (audio_file.pk,), countdown=random.randint(0, 3600)
-                    )
+                        if error:
+                            download_error = True
+                            continue
 
-                    logger.info(
-                        "Successfully added audio file {pk}: {name}".format(
-                            pk=audio_file.pk,
-                            name=item["case_names"].encode("utf-8"),
+                        save_everything(
+                            items={"docket": docket, "audio_file": audio_file},
+                            index=False,
+                            backscrape=backscrape,
                         )
-                    )
+                        process_audio_file.apply_async(
+                            (audio_file.pk,), countdown=random.randint(0, 3600)
+                        )
+
+                        logger.info(
+                            "Successfully added audio file {pk}: {name}".format(
+                                pk=audio_file.pk,
+                                name=item["case_names"].encode("utf-8"),
+                            )
+                        )
+            finally:
+                # Stop any downloads still running, even if this failed.
+                downloads.close()
 
             # Update the hash if everything finishes properly.
             logger.info(
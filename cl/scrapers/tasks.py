@@ -4,28 +4,22 @@ from __future__ import print_function
 import os
 import logging
 import random
+import shutil
 import subprocess
 import traceback
 import uuid
-from tempfile import NamedTemporaryFile
+from multiprocessing.pool import ThreadPool
+from tempfile import NamedTemporaryFile, mkdtemp
 
 import eyed3
 import requests
-from PyPDF2 import PdfFileReader
-from PyPDF2.utils import PdfReadError
 from django.apps import apps
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import IntegrityError
-from django.utils.encoding import (
-    smart_text,
-    DjangoUnicodeDecodeError,
-    force_text,
-)
+from django.utils.encoding import force_text
 from django.utils.timezone import now
 from eyed3 import id3
-from lxml.etree import XMLSyntaxError
-from lxml.html.clean import Cleaner
 from seal_rookery import seals_data, seals_root
 
 from cl.audio.models import Audio
@@ -33,116 +27,52 @@ from cl.audio.utils import get_audio_binary
 from cl.celery import app
 from cl.citations.tasks import find_citations_for_opinion_by_pks
 from cl.custom_filters.templatetags.text_filters import best_case_name
+from cl.lib.crypto import sha1_of_file
 from cl.lib.juriscraper_utils import get_scraper_object_by_name
 from cl.lib.mojibake import fix_mojibake
 from cl.lib.pacer import map_cl_to_pacer_id
 from cl.lib.pacer_session import get_or_cache_pacer_cookies
 from cl.lib.recap_utils import needs_ocr
+from cl.lib.redis_utils import make_redis_interface
 from cl.lib.string_utils import anonymize, trunc
 from cl.lib.utils import is_iter
 from cl.recap.mergers import (
     update_docket_metadata,
     add_bankruptcy_data_to_docket,
 )
+from cl.scrapers.extraction import (
+    get_extraction_backend,
+    get_page_count,
+    get_pages_needing_ocr,
+    split_pages,
+)
 from cl.scrapers.models import ErrorLog
 from cl.search.models import Opinion, RECAPDocument, Docket
 from cl.search.tasks import add_items_to_solr
 from juriscraper.pacer import PacerSession, CaseQuery
 
-DEVNULL = open("/dev/null", "w")
+# How many pages to rasterize with each call to ghostscript when doing OCR
+OCR_PAGES_PER_CHUNK = 10
+# How long to keep the OCR text of each page of a PDF, so that retries and
+# re-extractions only redo the pages that failed.
+OCR_PAGE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
 
 logger = logging.getLogger(__name__)
 
 
-def get_clean_body_content(content):
-    """Parse out the body from an html string, clean it up, and send it along."""
-    cleaner = Cleaner(
-        style=True, remove_tags=["a", "body", "font", "noscript", "img"]
-    )
-    try:
-        return cleaner.clean_html(content)
-    except XMLSyntaxError:
-        return (
-            "Unable to extract the content from this file. Please try "
-            "reading the original."
-        )
-
-
-def extract_from_doc(path):
-    """Extract text from docs.
-
-    We use antiword to pull the text out of MS Doc files.
-    """
-    process = subprocess.Popen(
-        ["antiword", path, "-i", "1"],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=DEVNULL,
-    )
-    content, err = process.communicate()
-    return content, err
-
-
-def extract_from_docx(path):
-    """Extract text from docx files
-
-    We use docx2txt to pull out the text. Pretty simple.
-    """
-    process = subprocess.Popen(
-        ["docx2txt", path, "-"],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=DEVNULL,
-    )
-    content, err = process.communicate()
-    return content, err
-
-
-def extract_from_html(path):
-    """Extract from html.
-
-    A simple wrapper to go get content, and send it along.
-    """
-    try:
-        content = open(path).read()
-        content = get_clean_body_content(content)
-        encodings = ["utf-8", "ISO8859", "cp1252"]
-        for encoding in encodings:
-            try:
-                content = force_text(content, encoding=encoding)
-            except DjangoUnicodeDecodeError:
-                continue
-            else:
-                return content, False
-
-        # Fell through, therefore unable to decode the string.
-        return "", True
-    except:
-        return "", True
-
-
-def make_pdftotext_process(path):
-    """Make a subprocess to hand to higher-level code."""
-    return subprocess.Popen(
-        ["pdftotext", "-layout", "-enc", "UTF-8", path, "-"],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=DEVNULL,
-    )
+def clean_pdf_content(content, path, opinion, do_ocr=False, sha1=None):
+    """Clean up the text that pdftotext got from a PDF.
 
+    If pdftotext got nothing, try to use tesseract under the assumption it's
+    an image-based PDF. Once that is complete, we check for the letter e in
+    our content. If it's not there, we try to fix the mojibake that ca9
+    sometimes creates.
 
-def extract_from_pdf(path, opinion, do_ocr=False):
-    """Extract text from pdfs.
-
-    Here, we use pdftotext. If that fails, try to use tesseract under the
-    assumption it's an image-based PDF. Once that is complete, we check for the
-    letter e in our content. If it's not there, we try to fix the mojibake
-    that ca9 sometimes creates.
+    :param sha1: The sha1 of the PDF file, if its OCR'ed pages should be
+    cached.
     """
-    process = make_pdftotext_process(path)
-    content, err = process.communicate()
     if content.strip() == "" and do_ocr:
-        success, content = extract_by_ocr(path)
+        success, content = extract_by_ocr(path, sha1)
         if success:
             opinion.extracted_by_ocr = True
         elif content == "" or not success:
@@ -151,52 +81,7 @@ def extract_from_pdf(path, opinion, do_ocr=False):
         # It's a corrupt PDF from ca9. Fix it.
         content = fix_mojibake(unicode(content, "utf-8", errors="ignore"))
 
-    return content, err
-
-
-def extract_from_txt(path):
-    """Extract text from plain text files: A fool's errand.
-
-    Unfortunately, plain text files lack encoding information, so we have to
-    guess. We could guess ascii, but we may as well use a superset of ascii,
-    cp1252, and failing that try utf-8, ignoring errors. Most txt files we
-    encounter were produced by converting wpd or doc files to txt on a
-    Microsoft box, so assuming cp1252 as our first guess makes sense.
-
-    May we hope for a better world.
-    """
-    try:
-        err = False
-        data = open(path).read()
-        try:
-            # Alas, cp1252 is probably still more popular than utf-8.
-            content = smart_text(data, encoding="cp1252")
-        except DjangoUnicodeDecodeError:
-            content = smart_text(data, encoding="utf-8", errors="ignore")
-    except:
-        err = True
-        content = ""
-    return content, err
-
-
-def extract_from_wpd(path, opinion):
-    """Extract text from a Word Perfect file
-
-    Yes, courts still use these, so we extract their text using wpd2html. Once
-    that's done, we pull out the body of the HTML, and do some minor cleanup
-    on it.
-    """
-    process = subprocess.Popen(
-        ["wpd2html", path], shell=False, stdout=subprocess.PIPE, stderr=DEVNULL
-    )
-    content, err = process.communicate()
-
-    content = get_clean_body_content(content)
-
-    if "not for publication" in content.lower():
-        opinion.precedential_status = "Unpublished"
-
-    return content, err
+    return content
 
 
 def convert_file_to_txt(path):
@@ -207,41 +92,6 @@ def convert_file_to_txt(path):
     return p.communicate()[0].decode("utf-8")
 
 
-def get_page_count(path, extension):
-    """Get the number of pages, if appropriate mimetype.
-
-    :param path: A path to a binary (pdf, wpd, doc, txt, html, etc.)
-    :param extension: The extension of the binary.
-    :return: The number of pages if possible, else return None
-    """
-    if extension == "pdf":
-        try:
-            reader = PdfFileReader(path)
-            return int(reader.getNumPages())
-        except (
-            IOError,
-            ValueError,
-            TypeError,
-            KeyError,
-            AssertionError,
-            PdfReadError,
-        ):
-            # IOError: File doesn't exist. My bad.
-            # ValueError: Didn't get an int for the page count. Their bad.
-            # TypeError: NumberObject has no attribute '__getitem__'. Ugh.
-            # KeyError, AssertionError: assert xrefstream["/Type"] == "/XRef". WTF?
-            # PdfReadError: Something else. I have no words.
-            pass
-    elif extension == "wpd":
-        # Best solution appears to be to dig into the binary format
-        pass
-    elif extension == "doc":
-        # Best solution appears to be to dig into the XML of the file
-        # itself: http://stackoverflow.com/a/12972502/64911
-        pass
-    return None
-
-
 def update_document_from_text(opinion):
     """Extract additional metadata from document text
 
@@ -295,34 +145,46 @@ def extract_doc_content(pk, do_ocr=False, citation_jitter=False):
     path = opinion.local_path.path
 
     extension = path.split(".")[-1]
-    if extension == "doc":
-        content, err = extract_from_doc(path)
-    elif extension == "docx":
-        content, err = extract_from_docx(path)
-    elif extension == "html":
-        content, err = extract_from_html(path)
-    elif extension == "pdf":
-        content, err = extract_from_pdf(path, opinion, do_ocr)
-    elif extension == "txt":
-        content, err = extract_from_txt(path)
-    elif extension == "wpd":
-        content, err = extract_from_wpd(path, opinion)
-    else:
+    backend = get_extraction_backend()
+    if extension not in backend.extensions:
         print(
             "*****Unable to extract content due to unknown extension: %s "
             "on opinion: %s****" % (extension, opinion)
         )
         return
 
-    # Do page count, if possible
-    opinion.page_count = get_page_count(path, extension)
+    # Identical files only need to be extracted once.
+    field = "html" if extension in ["html", "wpd"] else "plain_text"
+    sha1 = get_file_sha1(path)
+    twin = get_extracted_opinion(opinion, sha1, field)
+    if twin is not None:
+        content, err = twin[field], False
+        opinion.page_count = twin["page_count"]
+        opinion.extracted_by_ocr = twin["extracted_by_ocr"]
+        # The twin's text has already been anonymized, so anonymize won't
+        # tell us whether this one should be blocked. Do what we did there.
+        twin_blocked = twin["cluster__blocked"]
+    else:
+        result = backend.extract(path, extension)
+        content, err = result.content, result.err
+        if extension == "pdf":
+            content = clean_pdf_content(
+                content, path, opinion, do_ocr, sha1=sha1
+            )
+        # Do page count, if possible
+        opinion.page_count = result.page_count
+        twin_blocked = False
+
+    if extension == "wpd":
+        if "not for publication" in content.lower():
+            opinion.precedential_status = "Unpublished"
 
     # Do blocked status
     if extension in ["html", "wpd"]:
         opinion.html, blocked = anonymize(content)
     else:
         opinion.plain_text, blocked = anonymize(content)
-    if blocked:
+    if blocked or twin_blocked:
         opinion.cluster.blocked = True
         opinion.cluster.date_blocked = now()
 
@@ -367,6 +229,7 @@ def extract_recap_pdf(pks, skip_ocr=False, check_if_needed=True):
         pks = [pks]
 
     processed = []
+    rds = []
     for pk in pks:
         rd = RECAPDocument.objects.get(pk=pk)
         if check_if_needed and not rd.needs_extraction:
@@ -374,14 +237,35 @@ def extract_recap_pdf(pks, skip_ocr=False, check_if_needed=True):
             # hasn't disabled early abortion.
             processed.append(pk)
             continue
+        rds.append(rd)
+
+    # Identical files only need to be extracted once. Get the text of any
+    # that already have been, and only extract the first of any duplicates
+    # in this batch.
+    hashes = {rd.pk: get_file_sha1(rd.filepath_local.path) for rd in rds}
+    texts = get_extracted_recap_texts(set(hashes.values()), exclude=hashes)
+    to_extract = []
+    for rd in rds:
+        sha1 = hashes[rd.pk]
+        if sha1 is None or sha1 not in texts:
+            texts[sha1] = None
+            to_extract.append(rd)
+
+    # Run pdftotext on all the PDFs at once.
+    results = get_extraction_backend().extract_many(
+        (rd.filepath_local.path, "pdf") for rd in to_extract
+    )
+    for rd, result in zip(to_extract, results):
+        sha1 = hashes[rd.pk]
         path = rd.filepath_local.path
-        process = make_pdftotext_process(path)
-        content, err = process.communicate()
+        content = result.content
+        if rd.page_count is None:
+            rd.page_count = result.page_count
 
         if needs_ocr(content):
             if not skip_ocr:
                 # probably an image PDF. Send it to OCR.
-                success, content = extract_by_ocr(path)
+                success, content = extract_by_ocr(path, sha1)
                 if success:
                     rd.ocr_status = RECAPDocument.OCR_COMPLETE
                 elif content == u"" or not success:
@@ -391,23 +275,123 @@ def extract_recap_pdf(pks, skip_ocr=False, check_if_needed=True):
                 content = u""
                 rd.ocr_status = RECAPDocument.OCR_NEEDED
         else:
-            rd.ocr_status = RECAPDocument.OCR_UNNECESSARY
+            # Find the pages the same way they're counted and put back
+            # together, so the page numbers always agree.
+            pages = split_pages(content, result.page_offsets)
+            ocr_page_numbers = get_pages_needing_ocr(pages)
+            if not ocr_page_numbers:
+                rd.ocr_status = RECAPDocument.OCR_UNNECESSARY
+            elif not skip_ocr:
+                # A text PDF with some scanned pages. OCR only those pages
+                # and put their text in place of what pdftotext found.
+                pages = [force_text(page) for page in pages]
+                ocr_pages = ocr_pdf_pages(path, ocr_page_numbers, sha1)
+                for page, txt in ocr_pages.items():
+                    pages[page - 1] = cleanup_ocr_text(txt).rstrip(u"\f")
+                content = u"\f".join(pages) + u"\f"
+                if len(ocr_pages) == len(ocr_page_numbers):
+                    rd.ocr_status = RECAPDocument.OCR_COMPLETE
+                else:
+                    rd.ocr_status = RECAPDocument.OCR_FAILED
+            else:
+                # Keep the text we have, but come back for the scanned pages.
+                rd.ocr_status = RECAPDocument.OCR_NEEDED
 
         rd.plain_text, _ = anonymize(content)
         # Do not do indexing here. Creates race condition in celery.
         rd.save(index=False, do_extraction=False)
-        processed.append(pk)
+        processed.append(rd.pk)
+        if sha1 is not None:
+            texts[sha1] = (rd.plain_text, rd.ocr_status, rd.page_count)
+
+    extracted = set(rd.pk for rd in to_extract)
+    for rd in rds:
+        if rd.pk in extracted:
+            continue
+        rd.plain_text, rd.ocr_status, page_count = texts[hashes[rd.pk]]
+        if rd.page_count is None:
+            rd.page_count = page_count
+        rd.save(index=False, do_extraction=False)
+        processed.append(rd.pk)
 
     return processed
 
 
-def rasterize_pdf(path, destination):
+def get_file_sha1(path):
+    """Get the sha1 of a file, or None if it can't be read."""
+    try:
+        return sha1_of_file(path)
+    except IOError:
+        return None
+
+
+def get_extracted_opinion(opinion, sha1, field):
+    """Find another opinion with the same file that has already been
+    extracted.
+
+    :param opinion: The opinion being extracted.
+    :param sha1: The sha1 of its file.
+    :param field: The field its text goes in, html or plain_text.
+    :return: A dict with the text, page_count, extracted_by_ocr and
+    cluster__blocked of the other opinion, or None if there isn't one.
+    """
+    if sha1 is None:
+        return None
+    return (
+        Opinion.objects.filter(sha1=sha1)
+        .exclude(pk=opinion.pk)
+        .exclude(**{field: ""})
+        .exclude(**{field: "Unable to extract document content."})
+        .values(field, "page_count", "extracted_by_ocr", "cluster__blocked")
+        .first()
+    )
+
+
+def get_extracted_recap_texts(hashes, exclude=()):
+    """Find RECAP documents with the same files as others that have already
+    been extracted.
+
+    Documents whose OCR failed or hasn't been done yet are ignored, so that
+    their duplicates get another try.
+
+    :param hashes: The sha1s of the files.
+    :param exclude: The pks of the documents being extracted.
+    :return: A dict mapping sha1s to tuples of the plain_text, ocr_status and
+    page_count of an extracted document with that file.
+    """
+    texts = {}
+    rds = (
+        RECAPDocument.objects.filter(
+            sha1__in=[sha1 for sha1 in hashes if sha1 is not None],
+            ocr_status__in=[
+                RECAPDocument.OCR_COMPLETE,
+                RECAPDocument.OCR_UNNECESSARY,
+            ],
+        )
+        .exclude(pk__in=list(exclude))
+        .order_by("sha1")
+        .distinct("sha1")
+        .values_list("sha1", "plain_text", "ocr_status", "page_count")
+    )
+    for sha1, plain_text, ocr_status, page_count in rds:
+        texts[sha1] = (plain_text, ocr_status, page_count)
+    return texts
+
+
+def rasterize_pdf(path, destination, first_page=None, last_page=None):
     """Convert the PDF into a multipage Tiff file.
 
     This function uses ghostscript for processing and borrows heavily from:
 
         https://github.com/jbarlow83/OCRmyPDF/blob/636d1903b35fed6b07a01af53769fea81f388b82/ocrmypdf/ghostscript.py#L11
 
+    :param path: The path to the PDF.
+    :param destination: Where to put the Tiff. If it contains a format
+    specifier like "%04d", a file is made for each page, numbered from one.
+    :param first_page: The first page to rasterize, if not the first page of
+    the PDF.
+    :param last_page: The last page to rasterize, if not the last page of the
+    PDF.
     """
     # gs docs, see: http://ghostscript.com/doc/7.07/Use.htm
     # gs devices, see: http://ghostscript.com/doc/current/Devices.htm
@@ -425,10 +409,12 @@ def rasterize_pdf(path, destination):
         "-sDEVICE=tiffgray",
         "-sCompression=lzw",
         "-r300x300",  # Set the resolution to 300 DPI.
-        "-o",
-        destination,
-        path,
     ]
+    if first_page is not None:
+        gs.append("-dFirstPage=%s" % first_page)
+    if last_page is not None:
+        gs.append("-dLastPage=%s" % last_page)
+    gs.extend(["-o", destination, path])
     p = subprocess.Popen(
         gs,
         close_fds=True,
@@ -457,22 +443,167 @@ def cleanup_ocr_text(txt):
     return txt
 
 
+def ocr_image(path):
+    """OCR a single image with tesseract.
+
+    Tesseract is limited to one thread, since we run one per page instead.
+
+    :param path: The path to the image.
+    :return: A tuple of whether it worked and the text.
+    """
+    env = dict(os.environ, OMP_THREAD_LIMIT="1")
+    p = subprocess.Popen(
+        ["tesseract", path, "stdout", "-l", "eng"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    stdout, _ = p.communicate()
+    return p.returncode == 0, stdout.decode("utf-8")
+
+
+def ocr_page_range(args):
+    """Rasterize and OCR a range of pages of a PDF.
+
+    :param args: A tuple of the path to the PDF and the numbers of the first
+    and last pages to do. (It's a tuple so this can be used with Pool.map.)
+    :return: A dict mapping page numbers to their text. Pages that failed are
+    left out.
+    """
+    path, first_page, last_page = args
+    tmp_dir = mkdtemp(prefix="ocr_")
+    try:
+        image_path = os.path.join(tmp_dir, "page-%04d.tiff")
+        _, _, returncode = rasterize_pdf(
+            path, image_path, first_page, last_page
+        )
+        if returncode != 0:
+            return {}
+        pages = {}
+        for i, page in enumerate(range(first_page, last_page + 1), start=1):
+            if not os.path.exists(image_path % i):
+                continue
+            success, txt = ocr_image(image_path % i)
+            if success:
+                pages[page] = txt
+        return pages
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def make_page_ranges(pages, max_length):
+    """Group sorted page numbers into ranges of consecutive pages.
+
+    :param pages: A sorted list of page numbers.
+    :param max_length: The most pages to put in a range.
+    :return: A list of (first_page, last_page) tuples.
+    """
+    ranges = []
+    for page in pages:
+        if (
+            ranges
+            and ranges[-1][1] == page - 1
+            and page - ranges[-1][0] < max_length
+        ):
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+
+def get_ocr_page_key(sha1, page):
+    return "ocr-page:%s:%s" % (sha1, page)
+
+
 @app.task
-def extract_by_ocr(path):
-    """Extract the contents of a PDF using OCR."""
+def extract_by_ocr(path, sha1=None, processes=None):
+    """Extract the contents of a PDF using OCR.
+
+    The pages of the PDF are OCR'ed in parallel by ocr_pdf_pages. If the sha1
+    of the PDF is given, the text of each page is cached so that if some pages
+    fail, trying again only redoes those pages.
+
+    :param path: The path to the PDF.
+    :param sha1: The sha1 of the PDF, if pages should be cached.
+    :param processes: How many pages to OCR at once. Defaults to the
+    OCR_PROCESSES setting.
+    :return: A tuple of whether the OCR worked and the text, or a failure
+    message if it didn't.
+    """
     fail_msg = (
         u"Unable to extract the content from this file. Please try "
         u"reading the original."
     )
-    with NamedTemporaryFile(prefix="ocr_", suffix=".tiff") as tmp:
-        out, err, returncode = rasterize_pdf(path, tmp.name)
-        if returncode != 0:
-            return False, fail_msg
-
-        txt = convert_file_to_txt(tmp.name)
-        txt = cleanup_ocr_text(txt)
-
-    return True, txt
+    page_count = get_page_count(path, "pdf")
+    if not page_count:
+        # Can't split it up. Do it all at once.
+        with NamedTemporaryFile(prefix="ocr_", suffix=".tiff") as tmp:
+            out, err, returncode = rasterize_pdf(path, tmp.name)
+            if returncode != 0:
+                return False, fail_msg
+
+            txt = convert_file_to_txt(tmp.name)
+            txt = cleanup_ocr_text(txt)
+
+        return True, txt
+
+    page_numbers = range(1, page_count + 1)
+    pages = ocr_pdf_pages(path, page_numbers, sha1, processes)
+    if len(pages) < page_count:
+        return False, fail_msg
+    txt = u"".join(pages[page] for page in page_numbers)
+    return True, cleanup_ocr_text(txt)
+
+
+def ocr_pdf_pages(path, page_numbers, sha1=None, processes=None):
+    """OCR some pages of a PDF, in parallel.
+
+    The pages are grouped into ranges of consecutive pages, which are
+    rasterized and OCR'ed by a pool of threads. If the sha1 of the PDF is
+    given, the text of each page is cached, and cached pages aren't redone.
+
+    :param path: The path to the PDF.
+    :param page_numbers: A sorted list of the pages to do, counting from one.
+    :param sha1: The sha1 of the PDF, if pages should be cached.
+    :param processes: How many pages to OCR at once. Defaults to the
+    OCR_PROCESSES setting.
+    :return: A dict mapping page numbers to their text. Pages that failed are
+    left out.
+    """
+    pages = {}
+    r = make_redis_interface("CACHE")
+    if sha1:
+        cached = r.mget([get_ocr_page_key(sha1, p) for p in page_numbers])
+        for page, txt in zip(page_numbers, cached):
+            if txt is not None:
+                pages[page] = txt.decode("utf-8")
+
+    missing = [page for page in page_numbers if page not in pages]
+    ranges = make_page_ranges(missing, OCR_PAGES_PER_CHUNK)
+    if ranges:
+        processes = processes or settings.OCR_PROCESSES
+        pool = ThreadPool(min(processes, len(ranges)))
+        try:
+            results = pool.map(
+                ocr_page_range,
+                [(path, first, last) for first, last in ranges],
+                chunksize=1,
+            )
+        finally:
+            pool.close()
+            pool.join()
+        pipe = r.pipeline()
+        for result in results:
+            pages.update(result)
+            if sha1:
+                for page, txt in result.items():
+                    pipe.set(
+                        get_ocr_page_key(sha1, page),
+                        txt.encode("utf-8"),
+                        ex=OCR_PAGE_CACHE_TIMEOUT,
+                    )
+        pipe.execute()
+    return pages
 
 
 def set_mp3_meta_data(audio_obj, mp3_path):
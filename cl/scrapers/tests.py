@@ -1,12 +1,17 @@
 # coding=utf-8
 import os
+import time
+import uuid
 from datetime import timedelta
 
+import mock
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.test import TestCase, override_settings
 from django.utils.timezone import now
 
 from cl.audio.models import Audio
+from cl.lib.crypto import sha1, sha1_of_file
 from cl.lib.test_helpers import IndexedSolrTestCase
 from cl.scrapers.DupChecker import DupChecker
 from cl.scrapers.management.commands import (
@@ -14,15 +19,37 @@ from cl.scrapers.management.commands import (
     cl_scrape_opinions,
     cl_scrape_oral_arguments,
 )
+from cl.scrapers.extraction import (
+    CommandLineBackend,
+    ExtractionResult,
+    extract_from_txt,
+    get_page_count,
+    get_page_offsets,
+    get_pages_needing_ocr,
+    split_pages,
+)
 from cl.scrapers.models import UrlHash, ErrorLog
 from cl.scrapers.tasks import (
-    extract_from_txt,
+    extract_by_ocr,
     extract_doc_content,
+    extract_recap_pdf,
+    make_page_ranges,
+    ocr_pdf_pages,
     process_audio_file,
 )
 from cl.scrapers.test_assets import test_opinion_scraper, test_oral_arg_scraper
-from cl.scrapers.utils import get_extension
-from cl.search.models import Court, Opinion
+from cl.scrapers.utils import (
+    HostLimiter,
+    get_binary_contents,
+    get_extension,
+)
+from cl.search.models import (
+    Court,
+    Docket,
+    DocketEntry,
+    Opinion,
+    RECAPDocument,
+)
 
 
 class IngestionTest(IndexedSolrTestCase):
@@ -109,6 +136,32 @@ class ExtractionTest(TestCase):
             "Issue extracting/encoding text from file at: %s" % path,
         )
 
+    def test_split_pdftotext_pages(self):
+        """Can we find the pages in the output of pdftotext?"""
+        content = "one\ftwo\f\fthree\f"
+        offsets = get_page_offsets(content)
+        self.assertEqual(offsets, [0, 4, 8, 9])
+        self.assertEqual(
+            split_pages(content, offsets), ["one", "two", "", "three"]
+        )
+
+    def test_extract_many(self):
+        """Do we get the text and page count of many files at once, in
+        order?"""
+        path = os.path.join(settings.MEDIA_ROOT, "test", "search")
+        pdf_path = os.path.join(path, "opinion_pdf_text_based.pdf")
+        files = [
+            (pdf_path, "pdf"),
+            (os.path.join(path, "opinion_text.txt"), "txt"),
+        ]
+        backend = CommandLineBackend(processes=2)
+        pdf, txt = list(backend.extract_many(files))
+        self.assertEqual(pdf.page_count, get_page_count(pdf_path, "pdf"))
+        self.assertEqual(len(pdf.page_offsets), pdf.page_count)
+        self.assertIn("supreme", pdf.content.lower())
+        self.assertEqual(txt, backend.extract(*files[1]))
+        self.assertIsNone(txt.page_count)
+
     def test_juriscraper_object_creation(self):
         """Can we extract text from tax court pdf and add to db?"""
 
@@ -139,6 +192,203 @@ class ExtractionTest(TestCase):
             "19031-13, 27735-13, 11905-14", o.cluster.docket.docket_number
         )
 
+    def test_ocr_pages_are_cached_by_file_hash(self):
+        """Are the OCR'ed pages of an opinion cached under the hash of its
+        PDF, and not under its sha1 field, which needn't be the PDF's?
+        """
+        o = Opinion.objects.get(pk=76)
+        o.sha1 = "asdfasdfasdfasdfasdfasddf"
+        o.save(index=False)
+        empty = ExtractionResult("", None, 1, [0])
+        with mock.patch(
+            "cl.scrapers.extraction.CommandLineBackend.extract",
+            return_value=empty,
+        ), mock.patch(
+            "cl.scrapers.tasks.extract_by_ocr",
+            return_value=(True, u"Some text"),
+        ) as mock_ocr:
+            extract_doc_content(pk=o.pk, do_ocr=True)
+        path = o.local_path.path
+        mock_ocr.assert_called_once_with(path, sha1_of_file(path))
+
+
+class OcrTest(TestCase):
+    def test_make_page_ranges(self):
+        """Are pages grouped into short runs of consecutive pages?"""
+        self.assertEqual(
+            make_page_ranges([1, 2, 3, 5, 6, 9], 2),
+            [(1, 2), (3, 3), (5, 6), (9, 9)],
+        )
+
+    @mock.patch("cl.scrapers.tasks.get_page_count", return_value=3)
+    def test_ocr_retries_only_failed_pages(self, mock_page_count):
+        """If a page fails, does trying again only redo that page?"""
+        sha1 = uuid.uuid4().hex
+
+        def fail_page_two(args):
+            _, first_page, last_page = args
+            return {
+                page: u"Page %s\f" % page
+                for page in range(first_page, last_page + 1)
+                if page != 2
+            }
+
+        with mock.patch(
+            "cl.scrapers.tasks.ocr_page_range", side_effect=fail_page_two
+        ):
+            success, _ = extract_by_ocr("fake.pdf", sha1=sha1)
+        self.assertFalse(success)
+
+        with mock.patch(
+            "cl.scrapers.tasks.ocr_page_range",
+            return_value={2: u"Page 2\f"},
+        ) as mock_ocr:
+            success, txt = extract_by_ocr("fake.pdf", sha1=sha1)
+        self.assertTrue(success)
+        self.assertEqual(txt, u"Page 1\fPage 2\fPage 3\f")
+        mock_ocr.assert_called_once_with(("fake.pdf", 2, 2))
+
+    def test_pages_needing_ocr(self):
+        """Are only the pages without a text layer sent to OCR?"""
+        content = (
+            "Case 1:17-cv-01234 Document 5 Filed 01/01/17 Page 1 of 3\n"
+            "ORDER granting the motion.\f"
+            "Case 1:17-cv-01234 Document 5 Filed 01/01/17 Page 2 of 3\n\f"
+            "  \n\f"
+        )
+        pages = split_pages(content, get_page_offsets(content))
+        self.assertEqual(get_pages_needing_ocr(pages), [2, 3])
+        self.assertEqual(get_pages_needing_ocr([]), [])
+
+    def test_text_after_last_page_is_not_a_page(self):
+        """Is text after the last form feed left out of the pages, so that it
+        can't be sent to OCR as a page that doesn't exist?
+        """
+        content = "ORDER granting the motion.\f\n"
+        pages = split_pages(content, get_page_offsets(content))
+        self.assertEqual(pages, ["ORDER granting the motion."])
+        self.assertEqual(get_pages_needing_ocr(pages), [])
+
+    def test_ocr_some_pages(self):
+        """Can we OCR just a few pages of a PDF?"""
+        with mock.patch(
+            "cl.scrapers.tasks.ocr_page_range",
+            side_effect=lambda args: {
+                page: u"Page %s\f" % page
+                for page in range(args[1], args[2] + 1)
+            },
+        ) as mock_ocr:
+            pages = ocr_pdf_pages("fake.pdf", [2, 3, 7])
+        self.assertEqual(
+            pages, {2: u"Page 2\f", 3: u"Page 3\f", 7: u"Page 7\f"}
+        )
+        self.assertEqual(
+            sorted(call[0][0] for call in mock_ocr.call_args_list),
+            [("fake.pdf", 2, 3), ("fake.pdf", 7, 7)],
+        )
+
+
+class DuplicateExtractionTest(TestCase):
+    """Are documents with the same file only extracted once?"""
+
+    fixtures = ["test_court.json"]
+    file_content = "%PDF-1.4 A fake PDF"
+
+    def setUp(self):
+        self.docket = Docket.objects.create(
+            source=Docket.RECAP, court_id="test", pacer_case_id="asdf"
+        )
+        self.de = DocketEntry.objects.create(
+            docket=self.docket, entry_number=1
+        )
+        self.rds = [self.make_rd(n) for n in range(1, 4)]
+
+    def tearDown(self):
+        for rd in self.rds:
+            rd.filepath_local.delete()
+        self.docket.delete()
+
+    def make_rd(self, attachment_number):
+        rd = RECAPDocument.objects.create(
+            docket_entry=self.de,
+            document_type=RECAPDocument.ATTACHMENT,
+            document_number=1,
+            attachment_number=attachment_number,
+            sha1=sha1(self.file_content),
+            is_available=True,
+        )
+        rd.filepath_local.save("att.pdf", ContentFile(self.file_content))
+        return rd
+
+    @mock.patch("cl.scrapers.tasks.get_extraction_backend")
+    def test_reuse_extracted_text(self, mock_backend):
+        """If we've already extracted the file, do we use that text?"""
+        extracted = self.rds[0]
+        extracted.plain_text = u"The text of the document"
+        extracted.ocr_status = RECAPDocument.OCR_UNNECESSARY
+        extracted.page_count = 3
+        extracted.save()
+
+        extract_recap_pdf([rd.pk for rd in self.rds[1:]])
+
+        files = mock_backend.return_value.extract_many.call_args[0][0]
+        self.assertEqual(list(files), [])
+        for rd in self.rds[1:]:
+            rd.refresh_from_db()
+            self.assertEqual(rd.plain_text, u"The text of the document")
+            self.assertEqual(rd.ocr_status, RECAPDocument.OCR_UNNECESSARY)
+            self.assertEqual(rd.page_count, 3)
+
+    @mock.patch("cl.scrapers.tasks.get_extraction_backend")
+    def test_extract_duplicates_once(self, mock_backend):
+        """Do duplicates in one batch only get extracted once?"""
+        files = []
+
+        def extract_many(jobs):
+            files.extend(jobs)
+            return [
+                ExtractionResult("Some text\f", None, 1, [0]) for _ in files
+            ]
+
+        mock_backend.return_value.extract_many.side_effect = extract_many
+
+        processed = extract_recap_pdf([rd.pk for rd in self.rds])
+
+        self.assertEqual(sorted(processed), sorted(rd.pk for rd in self.rds))
+        self.assertEqual(len(files), 1)
+        for rd in self.rds:
+            rd.refresh_from_db()
+            self.assertEqual(rd.plain_text, u"Some text\f")
+            self.assertEqual(rd.ocr_status, RECAPDocument.OCR_UNNECESSARY)
+
+
+class FakeSite(list):
+    cookies = None
+    method = "GET"
+
+    def _get_adapter_instance(self):
+        return None
+
+
+class ConcurrentDownloadTest(TestCase):
+    @mock.patch("cl.scrapers.utils.get_binary_content")
+    def test_downloads_come_back_in_order(self, mock_download):
+        """If later items download faster, do we still get the items in
+        order?"""
+
+        def download(url, *args, **kwargs):
+            time.sleep(0.05 * (5 - int(url[-1])))
+            return "", url
+
+        mock_download.side_effect = download
+        site = FakeSite(
+            {"download_urls": "https://example.com/%s" % i} for i in range(5)
+        )
+        downloads = get_binary_contents(site, HostLimiter(3))
+        self.assertEqual(
+            [r for _, r in downloads], [d["download_urls"] for d in site]
+        )
+
 
 class ExtensionIdentificationTest(TestCase):
     def setUp(self):
@@ -406,6 +656,46 @@ class DupcheckerWithFixturesTest(TestCase):
                     "We should have hit a break but didn't.",
                 )
 
+    def test_press_on_after_prefetch(self):
+        """Once a page of items is prefetched, can we check them for
+        duplicates without more queries?"""
+        dup_checker = DupChecker(self.court, full_crawl=True)
+        new_url = "https://example.com/new.pdf"
+        dup_checker.prefetch(
+            Opinion.objects.filter(sha1=self.content_hash), [new_url]
+        )
+        self.assertFalse(dup_checker.is_known_url(new_url))
+        with self.assertNumQueries(0):
+            self.assertFalse(
+                dup_checker.press_on(
+                    Opinion, now(), now(), lookup_value=self.content_hash
+                )
+            )
+            self.assertTrue(
+                dup_checker.press_on(
+                    Opinion,
+                    now(),
+                    now(),
+                    lookup_value=new_url,
+                    lookup_by="download_url",
+                )
+            )
+
+        # If the item is saved and the URL comes up again on the page, it's a
+        # duplicate.
+        Opinion.objects.filter(sha1=self.content_hash).update(
+            download_url=new_url
+        )
+        self.assertFalse(
+            dup_checker.press_on(
+                Opinion,
+                now(),
+                now(),
+                lookup_value=new_url,
+                lookup_by="download_url",
+            )
+        )
+
 
 class AudioFileTaskTest(TestCase):
 
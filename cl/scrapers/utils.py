@@ -1,7 +1,10 @@
 import mimetypes
 import os
+import threading
 import traceback
-from urlparse import urljoin
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlparse
 
 import requests
 import sys
@@ -151,6 +154,74 @@ def get_binary_content(download_url, cookies, adapter, method="GET"):
     return "", r
 
 
+class HostLimiter(object):
+    """Limit how many requests we make to each host at once, so scraping
+    many courts and items in parallel stays polite.
+
+    Use it as a context manager around each request:
+
+        with host_limiter(url):
+            requests.get(url)
+    """
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, url):
+        host = urlparse(url or "").netloc.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                    self.max_per_host
+                )
+            return self._semaphores[host]
+
+
+def get_binary_contents(site, host_limiter, skip=None):
+    """Download the binaries of the items in a site, several at a time.
+
+    Downloads run ahead of the caller by up to the host limit, but the results
+    come back in the same order as the items, so the caller can still check
+    for duplicates one item at a time and stop early.
+
+    :param site: A parsed juriscraper Site.
+    :param host_limiter: A HostLimiter for the downloads.
+    :param skip: A function that takes a download URL and returns whether to
+    skip that item.
+    :return: An iterator of the (msg, response) tuples that
+    get_binary_content returns, one per item that isn't skipped.
+    """
+
+    def download(url):
+        with host_limiter(url):
+            return get_binary_content(
+                url,
+                site.cookies,
+                site._get_adapter_instance(),
+                method=site.method,
+            )
+
+    window = host_limiter.max_per_host
+    pool = ThreadPool(window)
+    pending = deque()
+    try:
+        for item in site:
+            if skip is not None and skip(item["download_urls"]):
+                continue
+            pending.append(
+                pool.apply_async(download, (item["download_urls"],))
+            )
+            if len(pending) > window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # If the caller stopped early, abandon any downloads that are ahead.
+        pool.terminate()
+
+
 def signal_handler(signal, frame):
     # Trigger this with CTRL+4
     logger.info("**************")
@@ -1,12 +1,20 @@
 import os
+import resource
+import time
+from itertools import chain, islice
 
 import igraph
+import numpy as np
 from django.conf import settings
+from django.db.models import Max
 
-from cl.lib.command_utils import VerboseCommand
+from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.solr_core_admin import get_data_dir
 from cl.search.models import Opinion, OpinionsCited
 
+# How many edges to pull from the DB at a time when streaming them.
+EDGE_CHUNK_SIZE = 1000000
+
 
 def make_and_populate_nx_graph():
     """Create a new igraph object and populate it.
@@ -25,6 +33,197 @@ def make_and_populate_nx_graph():
     return g
 
 
+def load_edge_arrays(
+    chunk_size=EDGE_CHUNK_SIZE, after_pk=None, through_pk=None
+):
+    """Stream the citation graph from the DB into two compact int arrays.
+
+    Rows are read with a server-side cursor and packed straight into NumPy
+    arrays a chunk at a time, so we never hold a Python tuple per edge.
+
+    :param chunk_size: The number of edges to read at a time.
+    :param after_pk: If set, only load OpinionsCited rows with a higher pk.
+    :param through_pk: If set, only load OpinionsCited rows up to this pk.
+    :return: A tuple of two int32 arrays, (citing, cited), where the ith edge
+    goes from citing[i] to cited[i].
+    """
+    qs = OpinionsCited.objects.order_by()
+    if after_pk is not None:
+        qs = qs.filter(pk__gt=after_pk)
+    if through_pk is not None:
+        qs = qs.filter(pk__lte=through_pk)
+    rows = qs.values_list("citing_opinion_id", "cited_opinion_id").iterator()
+    chunks = []
+    while True:
+        chunk = np.fromiter(
+            chain.from_iterable(islice(rows, chunk_size)), dtype=np.int32
+        )
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+    if not chunks:
+        empty = np.zeros(0, dtype=np.int32)
+        return empty, empty
+    edges = np.concatenate(chunks).reshape(-1, 2)
+    del chunks
+    return edges[:, 0].copy(), edges[:, 1].copy()
+
+
+def pagerank_power_iteration(
+    citing,
+    cited,
+    damping=0.85,
+    tolerance=1e-10,
+    max_iterations=1000,
+    start=None,
+):
+    """Compute pagerank for a directed graph with vectorized power iteration.
+
+    Like igraph, every integer from zero to the highest ID in the graph is a
+    node, and dangling nodes (those that cite nothing) spread their score
+    evenly over every node.
+
+    :param citing: An int array of the source node of each edge.
+    :param cited: An int array of the target node of each edge.
+    :param damping: The damping factor.
+    :param tolerance: Stop once the scores change by less than this, as
+    measured by the sum of the absolute changes.
+    :param max_iterations: Stop after this many iterations regardless.
+    :param start: An optional array of scores to start from, such as those
+    from a previous run. Missing nodes start with the average score.
+    :return: A tuple of the float64 array of scores, indexed by node ID, and
+    the number of iterations it took.
+    """
+    node_count = int(max(citing.max(), cited.max())) + 1 if len(citing) else 1
+    out_degree = np.bincount(citing, minlength=node_count).astype(np.float64)
+    dangling = out_degree == 0
+    # Avoid dividing by zero. Dangling nodes have no edges to spread over.
+    out_degree[dangling] = 1
+
+    scores = np.full(node_count, 1.0 / node_count)
+    if start is not None:
+        overlap = min(len(start), node_count)
+        scores[:overlap] = start[:overlap]
+        scores /= scores.sum()
+
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        spread = scores / out_degree
+        new_scores = np.bincount(
+            cited, weights=spread[citing], minlength=node_count
+        )
+        dangling_share = scores[dangling].sum() / node_count
+        new_scores = (
+            damping * (new_scores + dangling_share)
+            + (1 - damping) / node_count
+        )
+        change = np.abs(new_scores - scores).sum()
+        scores = new_scores
+        if change < tolerance:
+            break
+    return scores, iterations
+
+
+def save_pagerank_state(path, citing, cited, scores, last_edge_pk):
+    """Save the citation graph and its scores for the next incremental run.
+
+    The state is written to a temporary file and then moved into place, so a
+    crash can't leave a half-written state behind.
+
+    :param path: Where to save the state.
+    :param citing: The int array of citing opinion IDs.
+    :param cited: The int array of cited opinion IDs.
+    :param scores: The pagerank scores for the graph.
+    :param last_edge_pk: The highest OpinionsCited pk in the graph.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(
+            f,
+            citing=citing,
+            cited=cited,
+            scores=scores,
+            last_edge_pk=np.array(last_edge_pk),
+        )
+    os.rename(temp_path, path)
+
+
+def load_pagerank_state(path):
+    """Load the state saved by save_pagerank_state.
+
+    :return: A dict with the citing, cited, scores and last_edge_pk values, or
+    None if there's no saved state.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {
+            "citing": data["citing"],
+            "cited": data["cited"],
+            "scores": data["scores"],
+            "last_edge_pk": int(data["last_edge_pk"]),
+        }
+
+
+def do_incremental_pagerank(state_path, tolerance=1e-10, max_iterations=1000):
+    """Compute pagerank, picking up from where the last run left off.
+
+    The last run's graph is loaded from disk and only the citations added
+    since then are read from the DB. Iteration then starts from the last
+    run's scores, which are close to the new ones when only a small part of
+    the graph has changed, so it converges in far fewer iterations than
+    starting from scratch.
+
+    New citations are found by their pk, so deleted ones can't be spotted
+    that way. Instead, we count the citations in the DB. If the count doesn't
+    match the graph we'd build, the whole graph is reloaded, but the last
+    run's scores are still used as the starting point.
+
+    :param state_path: Where the state from the last run is kept. It is
+    updated with the results of this run.
+    :param tolerance: See pagerank_power_iteration.
+    :param max_iterations: See pagerank_power_iteration.
+    :return: A tuple of the scores and the number of iterations it took.
+    """
+    last_edge_pk = OpinionsCited.objects.aggregate(Max("pk"))["pk__max"] or 0
+    state = load_pagerank_state(state_path)
+    start = None
+    citing = cited = None
+    if state is None:
+        logger.info("No saved pagerank state. Doing a full run.")
+    else:
+        start = state["scores"]
+        new_citing, new_cited = load_edge_arrays(
+            after_pk=state["last_edge_pk"], through_pk=last_edge_pk
+        )
+        edge_count = OpinionsCited.objects.filter(pk__lte=last_edge_pk).count()
+        if edge_count == len(state["citing"]) + len(new_citing):
+            logger.info(
+                "Adding %s new citations to the saved graph.", len(new_citing)
+            )
+            citing = np.concatenate((state["citing"], new_citing))
+            cited = np.concatenate((state["cited"], new_cited))
+        else:
+            logger.info(
+                "Citations were removed since the last run. Reloading the "
+                "graph, but starting from the last run's scores."
+            )
+        del state
+
+    if citing is None:
+        citing, cited = load_edge_arrays(through_pk=last_edge_pk)
+
+    scores, iterations = pagerank_power_iteration(
+        citing,
+        cited,
+        tolerance=tolerance,
+        max_iterations=max_iterations,
+        start=start,
+    )
+    save_pagerank_state(state_path, citing, cited, scores, last_edge_pk)
+    return scores, iterations
+
+
 def make_sorted_pr_file(pr_results, result_file_path):
     """Convert the pagerank results list into something Solr can use.
 
@@ -62,21 +261,124 @@ def make_sorted_pr_file(pr_results, result_file_path):
     os.remove(result_file_path + temp_extension)
 
 
+def write_pr_file(pr_results, result_file_path):
+    """Write pagerank results to a file Solr can use, as in
+    make_sorted_pr_file, but without an external sort.
+
+    Opinion IDs are streamed from the DB in order, so the file comes out
+    sorted, and it's written to a temporary file that's then moved into place
+    so Solr never sees a partial file.
+    """
+    temp_extension = ".tmp"
+    min_value = pr_results.min()
+    result_count = len(pr_results)
+    pks = (
+        Opinion.objects.order_by("pk").values_list("pk", flat=True).iterator()
+    )
+    with open(result_file_path + temp_extension, "w") as f:
+        for pk in pks:
+            if pk < result_count:
+                score = pr_results[pk]
+            else:
+                # Items without citations aren't in the network.
+                score = min_value
+            f.write("{}={}\n".format(pk, float(score)))
+    os.rename(result_file_path + temp_extension, result_file_path)
+
+
+def get_peak_memory_mb():
+    """Get the peak resident memory of this process in MB."""
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
 class Command(VerboseCommand):
     args = "<args>"
     help = "Calculate pagerank value for every case"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--method",
+            choices=("igraph", "numpy"),
+            default="igraph",
+            help="How to compute pagerank. 'igraph' loads every citation "
+            "into memory and hands them to igraph. 'numpy' streams the "
+            "citations into compact arrays and runs a vectorized power "
+            "iteration, using much less memory. Wall time and peak memory "
+            "are logged either way, so the two can be compared.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=1e-10,
+            help="With --method numpy, stop iterating once the total change "
+            "in scores is below this.",
+        )
+        parser.add_argument(
+            "--max-iterations",
+            type=int,
+            default=1000,
+            help="With --method numpy, the most iterations to do.",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            default=False,
+            help="Use the NumPy method, starting from the graph and scores "
+            "saved by the last incremental run, and save them again for "
+            "the next one. Much faster than a full run when only a few "
+            "citations have changed.",
+        )
+        parser.add_argument(
+            "--state-file",
+            default=settings.PAGERANK_STATE_FILE,
+            help="Where to keep the state for --incremental runs.",
+        )
+
     @staticmethod
-    def do_pagerank():
+    def do_pagerank(method="igraph", tolerance=1e-10, max_iterations=1000):
+        if method == "numpy":
+            citing, cited = load_edge_arrays()
+            pr_results, iterations = pagerank_power_iteration(
+                citing,
+                cited,
+                tolerance=tolerance,
+                max_iterations=max_iterations,
+            )
+            logger.info("Pagerank converged in %s iterations.", iterations)
+            return pr_results
         g = make_and_populate_nx_graph()
         pr_results = g.pagerank()
         return pr_results
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
-        pr_results = self.do_pagerank()
+        t1 = time.time()
+        if options["incremental"]:
+            options["method"] = "numpy"
+            pr_results, iterations = do_incremental_pagerank(
+                options["state_file"],
+                options["tolerance"],
+                options["max_iterations"],
+            )
+            logger.info("Pagerank converged in %s iterations.", iterations)
+        else:
+            pr_results = self.do_pagerank(
+                options["method"],
+                options["tolerance"],
+                options["max_iterations"],
+            )
         pr_dest_dir = settings.SOLR_PAGERANK_DEST_DIR
-        make_sorted_pr_file(pr_results, pr_dest_dir)
+        if options["method"] == "numpy":
+            write_pr_file(pr_results, pr_dest_dir)
+        else:
+            make_sorted_pr_file(pr_results, pr_dest_dir)
+        logger.info(
+            "Pagerank done with %s in %0.1f seconds. Peak memory: %0.1f MB.",
+            options["method"],
+            time.time() - t1,
+            get_peak_memory_mb(),
+        )
         normal_dest_dir = get_data_dir("collection1") + "external_pagerank"
         print(
             "Pagerank file created at %s. Because of distributed servers, "
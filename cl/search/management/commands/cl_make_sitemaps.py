@@ -0,0 +1,183 @@
+import gzip
+import json
+import os
+from datetime import datetime
+
+from django.conf import settings
+from django.urls import reverse
+
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.sitemap import (
+    get_court_counts,
+    get_sitemap_index_path,
+    get_sitemap_path,
+    iter_sitemap_pages,
+    make_sitemap_urls,
+    render_sitemap,
+    render_sitemap_index,
+    solr_sitemaps,
+)
+
+
+def get_state_path():
+    return os.path.join(settings.SITEMAPS_DIR, "state.json")
+
+
+def load_state():
+    """Load what the last run made.
+
+    :return: A dict with the Solr date of the last run (or None if there
+    hasn't been one), and, for each section, the count of items and the
+    number of pages made for each court.
+    """
+    try:
+        with open(get_state_path()) as f:
+            return json.load(f)
+    except IOError:
+        return {"last_run": None, "sections": {}}
+
+
+def write_file(path, data, compress=False):
+    """Write a file all at once, so that it's never served half written."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = "%s.tmp" % path
+    if compress:
+        f = gzip.open(tmp_path, "wb")
+    else:
+        f = open(tmp_path, "wb")
+    with f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def delete_pages(section, court, first_page, last_page):
+    for page in range(first_page, last_page + 1):
+        try:
+            os.remove(get_sitemap_path(section, court, page))
+        except OSError:
+            pass
+
+
+def make_court_sitemaps(section, court):
+    """Write the sitemaps of a court, paging through Solr with a cursor.
+
+    :return: The number of pages written.
+    """
+    sitemap = solr_sitemaps[section]
+    page = 0
+    for page, results in enumerate(iter_sitemap_pages(section, court), 1):
+        urls = make_sitemap_urls(
+            results,
+            sitemap["changefreq"],
+            sitemap["low_priority_pages"],
+            sitemap["url_field"],
+        )
+        write_file(
+            get_sitemap_path(section, court, page),
+            render_sitemap(urls),
+            compress=True,
+        )
+    return page
+
+
+def get_changed_courts(section, counts, old_courts, last_run):
+    """Find the courts that need their sitemaps made again.
+
+    Items that were added or updated since the last run have newer
+    timestamps. Items that were deleted don't, but they change the count of
+    their court.
+    """
+    if last_run is None:
+        return set(counts)
+    changed = set(get_court_counts(section, since=last_run))
+    for court, count in counts.items():
+        if old_courts.get(court, {}).get("count") != count:
+            changed.add(court)
+    return changed
+
+
+def make_index(state):
+    sites = []
+    for section, sitemap in solr_sitemaps.items():
+        path = reverse(sitemap["url_name"])
+        courts = state["sections"][section]
+        for court, court_state in sorted(courts.items()):
+            for page in range(1, court_state["pages"] + 1):
+                sites.append(
+                    "https://www.courtlistener.com%s?p=%s&court=%s"
+                    % (path, page, court)
+                )
+    write_file(
+        get_sitemap_index_path(), render_sitemap_index(sites), compress=True
+    )
+
+
+class Command(VerboseCommand):
+    help = (
+        "Make the sitemaps ahead of time, as gzipped files that the sitemap "
+        "views serve. Only the courts that changed since the last run are "
+        "made again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sections",
+            nargs="+",
+            choices=list(solr_sitemaps),
+            default=list(solr_sitemaps),
+            help="The sections of the sitemap to make.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            default=False,
+            help="Make the sitemaps of every court, changed or not.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        state = load_state()
+        last_run = None if options["all"] else state["last_run"]
+        # Take the time before we start, so that anything indexed while we
+        # run is made again next time.
+        this_run = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        for section in options["sections"]:
+            old_courts = state["sections"].get(section, {})
+            counts = get_court_counts(section)
+            changed = get_changed_courts(section, counts, old_courts, last_run)
+            logger.info(
+                "%s: %s of %s courts changed.",
+                section,
+                len(changed),
+                len(counts),
+            )
+
+            new_courts = {}
+            for court, count in counts.items():
+                old_pages = old_courts.get(court, {}).get("pages", 0)
+                if court in changed:
+                    pages = make_court_sitemaps(section, court)
+                    delete_pages(section, court, pages + 1, old_pages)
+                    logger.info(
+                        "  %s: Made %s pages for %s items.",
+                        court,
+                        pages,
+                        count,
+                    )
+                else:
+                    pages = old_pages
+                new_courts[court] = {"count": count, "pages": pages}
+
+            for court in set(old_courts) - set(counts):
+                delete_pages(section, court, 1, old_courts[court]["pages"])
+            state["sections"][section] = new_courts
+
+        if len(options["sections"]) == len(solr_sitemaps):
+            state["last_run"] = this_run
+        write_file(get_state_path(), json.dumps(state, indent=2))
+        if all(section in state["sections"] for section in solr_sitemaps):
+            # Until then, the index is made live, with every section.
+            make_index(state)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2020-08-04 17:21
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('search', '0096_add_court_fields_and_noops'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+            CREATE INDEX CONCURRENTLY "search_recapdocument_sha1_498d296b_idx" ON "search_recapdocument" ("sha1");
+            """,
+            reverse_sql="""
+            DROP INDEX "search_recapdocument_sha1_498d296b_idx";
+            """,
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='recapdocument',
+                    index_together=set([('document_type', 'document_number', 'attachment_number'), ('sha1',)]),
+                ),
+            ],
+        ),
+    ]
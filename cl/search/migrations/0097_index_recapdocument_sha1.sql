@@ -0,0 +1,6 @@
+--
+-- Alter index_together for recapdocument (2 constraint(s))
+--
+
+-- Add the index, but do it concurrently. Note that concurrent ones can't be in a transaction.
+CREATE INDEX CONCURRENTLY "search_recapdocument_sha1_498d296b_idx" ON "search_recapdocument" ("sha1");
@@ -6,7 +6,7 @@ from celery.canvas import chain
 from django.contrib.contenttypes.fields import GenericRelation
 from django.core.exceptions import ValidationError
 from django.urls import reverse, NoReverseMatch
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Prefetch, Q
 from django.template import loader
 from django.utils.encoding import smart_unicode
@@ -713,21 +713,31 @@ class Docket(models.Model):
             ),
         )
 
-    def as_search_list(self):
-        """Create list of search dicts from a single docket. This should be
-        faster than creating a search dict per document on the docket.
-        """
-        search_list = []
+    def get_search_metadata(self):
+        """The search fields that every RECAPDocument on the docket shares.
 
-        # Docket
+        Since these are the same for every document, they can be made once
+        and passed to RECAPDocument.as_search_dict for each document.
+        """
+        # IDs
         out = {
-            "docketNumber": self.docket_number,
-            "caseName": best_case_name(self),
-            "suitNature": self.nature_of_suit,
-            "cause": self.cause,
-            "juryDemand": self.jury_demand,
-            "jurisdictionType": self.jurisdiction_type,
+            "docket_id": self.pk,
+            "court_id": self.court.pk,
+            "assigned_to_id": getattr(self.assigned_to, "pk", None),
+            "referred_to_id": getattr(self.referred_to, "pk", None),
         }
+
+        # Docket
+        out.update(
+            {
+                "docketNumber": self.docket_number,
+                "caseName": best_case_name(self),
+                "suitNature": self.nature_of_suit,
+                "cause": self.cause,
+                "juryDemand": self.jury_demand,
+                "jurisdictionType": self.jurisdiction_type,
+            }
+        )
         if self.date_argued is not None:
             out["dateArgued"] = midnight_pst(self.date_argued)
         if self.date_filed is not None:
@@ -782,38 +792,60 @@ class Docket(models.Model):
                     out["firm_id"].add(f.pk)
                     out["firm"].add(f.name)
 
-        # Do RECAPDocument and Docket Entries in a nested loop
-        for de in self.docket_entries.all().iterator():
-            # Docket Entry
-            de_out = {
-                "description": de.description,
-            }
-            if de.entry_number is not None:
-                de_out["entry_number"] = de.entry_number
-            if de.date_filed is not None:
-                de_out["entry_date_filed"] = midnight_pst(de.date_filed)
-            rds = de.recap_documents.all()
-
-            if len(rds) == 0:
-                # Minute entry or other entry that lacks docs.
-                # For now, we punt.
-                # https://github.com/freelawproject/courtlistener/issues/784
-                continue
+        return out
 
-            for rd in rds:
-                # IDs
-                rd_out = {
-                    "id": rd.pk,
-                    "docket_entry_id": de.pk,
-                    "docket_id": self.pk,
-                    "court_id": self.court.pk,
-                    "assigned_to_id": getattr(self.assigned_to, "pk", None),
-                    "referred_to_id": getattr(self.referred_to, "pk", None),
-                }
+    def as_search_list(self):
+        """Create list of search dicts from a single docket. This should be
+        faster than creating a search dict per document on the docket.
+        """
+        search_list = []
+        for batch in self.as_search_batches():
+            search_list.extend(batch)
+        return search_list
+
+    def as_search_batches(self, batch_size=500):
+        """Generate the search dicts for every document on the docket, in
+        lists of up to batch_size dicts.
+
+        Unlike as_search_list, this never holds more than one batch of dicts
+        (and one batch of docket entries) in memory, so it's the way to go for
+        big dockets.
+        """
+        # Docket, court, judges, parties, attorneys and firms. These are the
+        # same for every document, so only normalize them once.
+        out = normalize_search_dicts(self.get_search_metadata())
+        text_template = loader.get_template("indexes/dockets_text.txt")
 
-                # RECAPDocument
-                rd_out.update(
-                    {
+        batch = []
+        last_pk = 0
+        while True:
+            des = list(
+                self.docket_entries.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .prefetch_related("recap_documents")[:batch_size]
+            )
+            if not des:
+                break
+            last_pk = des[-1].pk
+
+            # Do RECAPDocument and Docket Entries in a nested loop
+            for de in des:
+                rds = de.recap_documents.all()
+                if len(rds) == 0:
+                    # Minute entry or other entry that lacks docs.
+                    # For now, we punt.
+                    # https://github.com/freelawproject/courtlistener/issues/784
+                    continue
+
+                for rd in rds:
+                    rd_out = {
+                        # IDs
+                        "id": rd.pk,
+                        "docket_entry_id": de.pk,
+                        # Docket Entry
+                        "description": de.description,
+                        "entry_number": de.entry_number,
+                        # RECAPDocument
                         "short_description": rd.description,
                         "document_type": rd.get_document_type_display(),
                         "document_number": rd.document_number or None,
@@ -821,30 +853,32 @@ class Docket(models.Model):
                         "is_available": rd.is_available,
                         "page_count": rd.page_count,
                     }
-                )
-                if hasattr(rd.filepath_local, "path"):
-                    rd_out["filepath_local"] = rd.filepath_local.path
-                try:
-                    rd_out["absolute_url"] = rd.get_absolute_url()
-                except NoReverseMatch:
-                    raise InvalidDocumentError(
-                        "Unable to save to index due to missing absolute_url: "
-                        "%s" % self.pk
-                    )
-
-                text_template = loader.get_template("indexes/dockets_text.txt")
-                rd_out["text"] = text_template.render({"item": rd}).translate(
-                    null_map
-                )
-
-                # Ensure that loops to bleed into each other
-                out_copy = out.copy()
-                out_copy.update(rd_out)
-                out_copy.update(de_out)
-
-                search_list.append(normalize_search_dicts(out_copy))
-
-        return search_list
+                    if de.date_filed is not None:
+                        rd_out["entry_date_filed"] = midnight_pst(
+                            de.date_filed
+                        )
+                    if hasattr(rd.filepath_local, "path"):
+                        rd_out["filepath_local"] = rd.filepath_local.path
+                    try:
+                        rd_out["absolute_url"] = rd.get_absolute_url()
+                    except NoReverseMatch:
+                        raise InvalidDocumentError(
+                            "Unable to save to index due to missing "
+                            "absolute_url: %s" % self.pk
+                        )
+                    rd_out["text"] = text_template.render(
+                        {"item": rd}
+                    ).translate(null_map)
+
+                    # Ensure that loops to bleed into each other
+                    search_dict = out.copy()
+                    search_dict.update(normalize_search_dicts(rd_out))
+                    batch.append(search_dict)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
 
     def reprocess_recap_content(self, do_original_xml=False):
         """Go over any associated RECAP files and reprocess them.
@@ -1073,6 +1107,7 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
         ordering = ("document_type", "document_number", "attachment_number")
         index_together = [
             ["document_type", "document_number", "attachment_number"],
+            ["sha1"],
         ]
         permissions = (("has_recap_api_access", "Can work with RECAP API"),)
 
@@ -1246,81 +1281,7 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
 
     def get_docket_metadata(self):
         """The metadata for the item that comes from the Docket."""
-        docket = self.docket_entry.docket
-        # IDs
-        out = {
-            "docket_id": docket.pk,
-            "court_id": docket.court.pk,
-            "assigned_to_id": getattr(docket.assigned_to, "pk", None),
-            "referred_to_id": getattr(docket.referred_to, "pk", None),
-        }
-
-        # Docket
-        out.update(
-            {
-                "docketNumber": docket.docket_number,
-                "caseName": best_case_name(docket),
-                "suitNature": docket.nature_of_suit,
-                "cause": docket.cause,
-                "juryDemand": docket.jury_demand,
-                "jurisdictionType": docket.jurisdiction_type,
-            }
-        )
-        if docket.date_argued is not None:
-            out["dateArgued"] = midnight_pst(docket.date_argued)
-        if docket.date_filed is not None:
-            out["dateFiled"] = midnight_pst(docket.date_filed)
-        if docket.date_terminated is not None:
-            out["dateTerminated"] = midnight_pst(docket.date_terminated)
-        try:
-            out["docket_absolute_url"] = docket.get_absolute_url()
-        except NoReverseMatch:
-            raise InvalidDocumentError(
-                "Unable to save to index due to missing absolute_url: %s"
-                % self.pk
-            )
-
-        # Judges
-        if docket.assigned_to is not None:
-            out["assignedTo"] = docket.assigned_to.name_full
-        elif docket.assigned_to_str:
-            out["assignedTo"] = docket.assigned_to_str
-        if docket.referred_to is not None:
-            out["referredTo"] = docket.referred_to.name_full
-        elif docket.referred_to_str:
-            out["referredTo"] = docket.referred_to_str
-
-        # Court
-        out.update(
-            {
-                "court": docket.court.full_name,
-                "court_exact": docket.court_id,  # For faceting
-                "court_citation_string": docket.court.citation_string,
-            }
-        )
-
-        # Parties, Attorneys, Firms
-        out.update(
-            {
-                "party_id": set(),
-                "party": set(),
-                "attorney_id": set(),
-                "attorney": set(),
-                "firm_id": set(),
-                "firm": set(),
-            }
-        )
-        for p in docket.prefetched_parties:
-            out["party_id"].add(p.pk)
-            out["party"].add(p.name)
-            for a in p.attys_in_docket:
-                out["attorney_id"].add(a.pk)
-                out["attorney"].add(a.name)
-                for f in a.firms_in_docket:
-                    out["firm_id"].add(f.pk)
-                    out["firm"].add(f.name)
-
-        return out
+        return self.docket_entry.docket.get_search_metadata()
 
     def as_search_dict(self, docket_metadata=None):
         """Create a dict that can be ingested by Solr.
@@ -1335,7 +1296,10 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
         every RECAPDocument on the docket. This can provide big performance
         boosts.
         """
-        out = docket_metadata or self.get_docket_metadata()
+        if docket_metadata is None:
+            docket_metadata = self.get_docket_metadata()
+        # Copy it, so that it can be shared by every document on a docket.
+        out = docket_metadata.copy()
 
         # IDs
         out.update({"id": self.pk, "docket_entry_id": self.docket_entry.pk})
@@ -2909,6 +2873,48 @@ class Tag(models.Model):
         else:
             raise NotImplementedError("Object type not supported for tagging.")
 
+    def tag_objects(self, things):
+        """Add a tag to many items at once.
+
+        This makes one query to find which items already have the tag and one
+        to tag the rest. If another process tags some of the same items at
+        the same time, it falls back to tag_object for each item.
+
+        :param things: A list of Dockets, DocketEntries, RECAPDocuments or
+        Claims to tag. They can be a mix of types.
+        """
+        through_fields = (
+            (Docket, self.dockets.through, "docket_id"),
+            (DocketEntry, self.docket_entries.through, "docketentry_id"),
+            (RECAPDocument, self.recap_documents.through, "recapdocument_id"),
+            (Claim, self.claims.through, "claim_id"),
+        )
+        supported_models = [model for model, _, _ in through_fields]
+        if any(type(thing) not in supported_models for thing in things):
+            raise NotImplementedError("Object type not supported for tagging.")
+
+        for model, through, field in through_fields:
+            pks = set(thing.pk for thing in things if type(thing) == model)
+            if not pks:
+                continue
+            already_tagged = set(
+                through.objects.filter(
+                    tag_id=self.pk, **{"%s__in" % field: pks}
+                ).values_list(field, flat=True)
+            )
+            try:
+                with transaction.atomic():
+                    through.objects.bulk_create(
+                        [
+                            through(tag_id=self.pk, **{field: pk})
+                            for pk in pks - already_tagged
+                        ]
+                    )
+            except IntegrityError:
+                for thing in things:
+                    if type(thing) == model:
+                        self.tag_object(thing)
+
 
 # class AppellateReview(models.Model):
 #     REVIEW_STANDARDS = (
@@ -1,17 +1,36 @@
 from __future__ import print_function
 
+import hashlib
+import json
+import logging
 import socket
 from datetime import timedelta
 
 import scorched
 from django.apps import apps
 from django.conf import settings
+from django.db.models import Q
 from django.utils.timezone import now
+from scorched.dates import solr_date
 
 from cl.celery import app
-from cl.lib.search_index_utils import InvalidDocumentError
+from cl.lib.redis_utils import make_redis_interface
+from cl.lib.search_index_utils import (
+    InvalidDocumentError,
+    normalize_search_dicts,
+)
 from cl.lib.sunburnt import SolrError
-from cl.search.models import OpinionCluster, RECAPDocument, Docket
+from cl.search.models import (
+    BankruptcyInformation,
+    OpinionCluster,
+    RECAPDocument,
+    Docket,
+)
+
+logger = logging.getLogger(__name__)
+
+# How many atomic updates to send to Solr at a time
+ATOMIC_UPDATE_CHUNK_SIZE = 500
 
 
 @app.task
@@ -53,6 +72,233 @@ def add_items_to_solr(item_pks, app_label, force_commit=False):
             items.update(date_modified=now(), date_last_index=now())
 
 
+def hash_value(value):
+    """Make a stable hash of a JSON-serializable value."""
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, default=str)
+    ).hexdigest()
+
+
+def get_docket_text_values(d):
+    """Get the docket-level values that go into the text field of every
+    RECAPDocument on a docket, as rendered by indexes/dockets_text.txt.
+    """
+    values = [
+        d.case_name_full,
+        d.case_name,
+        d.case_name_short,
+        d.date_argued,
+        d.date_filed,
+        d.date_terminated,
+        d.docket_number,
+        d.nature_of_suit,
+        d.jury_demand,
+        d.court_id,
+        d.court.full_name,
+        d.court.citation_string,
+        getattr(d.assigned_to, "name_full", None),
+        getattr(d.referred_to, "name_full", None),
+    ]
+    try:
+        bankr_info = d.bankruptcy_information
+    except BankruptcyInformation.DoesNotExist:
+        pass
+    else:
+        values.extend([bankr_info.chapter, bankr_info.trustee_str])
+    return values
+
+
+def make_docket_fingerprint(d, metadata):
+    """Make a fingerprint of what a docket contributes to its documents in
+    Solr.
+
+    :param d: The docket.
+    :param metadata: The normalized search metadata for the docket, from
+    Docket.get_search_metadata.
+    :return: A dict mapping each search field to a hash of its value, plus a
+    "text" key with a hash of the docket values that go into the text field.
+    """
+    fingerprint = {}
+    for field, value in metadata.items():
+        if isinstance(value, list):
+            value = sorted(value)
+        fingerprint[field] = hash_value(value)
+    fingerprint["text"] = hash_value(get_docket_text_values(d))
+    return fingerprint
+
+
+def get_docket_fingerprint_key(docket_pk):
+    return "recap-docket-fingerprint:%s:%s" % (
+        settings.DATABASES["default"]["NAME"],
+        docket_pk,
+    )
+
+
+def get_docket_fingerprint(docket_pk):
+    """Get the fingerprint of a docket as it was when it was last indexed,
+    or None if we don't have it.
+    """
+    r = make_redis_interface("CACHE")
+    fingerprint = r.get(get_docket_fingerprint_key(docket_pk))
+    if fingerprint is None:
+        return None
+    return json.loads(fingerprint)
+
+
+def save_docket_fingerprint(docket_pk, fingerprint):
+    r = make_redis_interface("CACHE")
+    r.set(get_docket_fingerprint_key(docket_pk), json.dumps(fingerprint))
+
+
+def make_atomic_update(pk, fields):
+    """Make a Solr atomic update that sets fields on a document.
+
+    Fields with a value of None are removed from the document.
+    """
+    update = {"id": pk}
+    for field, value in fields.items():
+        if hasattr(value, "strftime"):
+            # We're bypassing scorched, so do its date conversion ourselves.
+            value = str(solr_date(value))
+        update[field] = {"set": value}
+    return update
+
+
+# The results of schema checks for atomic updates, by Solr URL.
+atomic_update_checks = {}
+
+
+def can_send_atomic_updates(si):
+    """Check whether Solr can safely do atomic updates to a core.
+
+    Solr rebuilds an atomically updated document from its stored fields, so a
+    field that's indexed but not stored is emptied. Atomic updates are only
+    used if they're turned on in the settings and every field in the schema
+    is stored, has stored doc values, or is the destination of a copyField.
+
+    :param si: A scorched SolrInterface.
+    :return: True if atomic updates are safe, else False.
+    """
+    if not settings.SOLR_RECAP_ATOMIC_UPDATES:
+        return False
+    url = si.conn.url
+    if url not in atomic_update_checks:
+        schema = si.schema
+        copy_destinations = set(
+            c["dest"] for c in schema.get("copyFields", [])
+        )
+        unstored = [
+            field["name"]
+            for field in schema["fields"]
+            if not field.get("stored", True)
+            and not (
+                field.get("docValues")
+                and field.get("useDocValuesAsStored", True)
+            )
+            and field["name"] not in copy_destinations
+        ]
+        if unstored:
+            logger.warning(
+                "Not using atomic updates for %s, because these fields "
+                "aren't stored: %s",
+                url,
+                ", ".join(unstored),
+            )
+        atomic_update_checks[url] = not unstored
+    return atomic_update_checks[url]
+
+
+def send_atomic_updates(si, pks, fields):
+    """Set fields on many documents in Solr, without reindexing them.
+
+    :param si: A scorched SolrInterface.
+    :param pks: An iterable of the PKs of the documents to update.
+    :param fields: A dict of fields to set on every document.
+    """
+    updates = []
+    for pk in pks:
+        updates.append(make_atomic_update(pk, fields))
+        if len(updates) >= ATOMIC_UPDATE_CHUNK_SIZE:
+            si.conn.update(json.dumps(updates))
+            updates = []
+    if updates:
+        si.conn.update(json.dumps(updates))
+
+
+def index_recap_docket_delta(si, d, since):
+    """Bring the Solr documents for a RECAP docket up to date, touching as
+    little as possible.
+
+    Rather than regenerating every document on the docket:
+
+     - Documents and docket entries that were modified since the docket was
+       last indexed are added to Solr in full.
+
+     - If docket-level fields changed, the rest of the documents get a Solr
+       atomic update setting just those fields.
+
+    If the docket-level values in the text field changed, if we don't know
+    what the docket looked like the last time it was indexed, or if docket
+    fields changed but atomic updates can't be used (see
+    can_send_atomic_updates), every document has to be regenerated, so the
+    whole docket is added as usual.
+
+    :param si: A scorched SolrInterface for the RECAP index.
+    :param d: The docket to index.
+    :param since: When the docket was last indexed, or None if it never was.
+    :return: The fingerprint of the docket, to save once the changes are
+    known to have been made.
+    """
+    metadata = normalize_search_dicts(d.get_search_metadata())
+    fingerprint = make_docket_fingerprint(d, metadata)
+    old_fingerprint = get_docket_fingerprint(d.pk)
+    changed_fields = {}
+    if old_fingerprint is not None:
+        changed_fields = {
+            field: metadata.get(field)
+            for field in set(fingerprint) | set(old_fingerprint)
+            if field != "text"
+            and fingerprint.get(field) != old_fingerprint.get(field)
+        }
+    if (
+        since is None
+        or old_fingerprint is None
+        or old_fingerprint.get("text") != fingerprint["text"]
+        or (changed_fields and not can_send_atomic_updates(si))
+    ):
+        for batch in d.as_search_batches():
+            si.add(batch)
+        return fingerprint
+
+    rds = (
+        RECAPDocument.objects.filter(docket_entry__docket=d)
+        .filter(
+            Q(date_modified__gte=since)
+            | Q(docket_entry__date_modified__gte=since)
+        )
+        .select_related(
+            "docket_entry__docket__court",
+            "docket_entry__docket__assigned_to",
+            "docket_entry__docket__referred_to",
+        )
+        .order_by()
+    )
+    search_dicts = [rd.as_search_dict(docket_metadata=metadata) for rd in rds]
+    if search_dicts:
+        si.add(search_dicts)
+
+    if changed_fields:
+        unchanged_pks = (
+            RECAPDocument.objects.filter(docket_entry__docket=d)
+            .exclude(pk__in=[s["id"] for s in search_dicts])
+            .order_by()
+            .values_list("pk", flat=True)
+            .iterator()
+        )
+        send_atomic_updates(si, unchanged_pks, changed_fields)
+    return fingerprint
+
+
 @app.task(ignore_resutls=True)
 def add_or_update_recap_docket(
     data, force_commit=False, update_threshold=60 * 60
@@ -71,6 +317,9 @@ def add_or_update_recap_docket(
     updated it in Solr. If that date is after a threshold, we just don't do the
     update unless we know the docket has something new.
 
+    And when we do update it, we only send what changed since then. See
+    index_recap_docket_delta for details.
+
     :param data: A dictionary containing the a key for 'docket_pk' and
     'content_updated'. 'docket_pk' will be used to find the docket to modify.
     'content_updated' is a boolean indicating whether the docket must be
@@ -93,14 +342,17 @@ def add_or_update_recap_docket(
     if all([too_fresh, update_not_required]):
         return
     else:
+        # Anything modified after this will be picked up next time.
+        index_start = now()
         try:
-            si.add(d.as_search_list())
+            fingerprint = index_recap_docket_delta(si, d, d.date_last_index)
             if force_commit:
                 si.commit()
         except SolrError as exc:
             add_or_update_recap_docket.retry(exc=exc, countdown=30)
         else:
-            d.date_last_index = now()
+            save_docket_fingerprint(d.pk, fingerprint)
+            d.date_last_index = index_start
             d.save()
 
 
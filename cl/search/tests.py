@@ -1,9 +1,13 @@
 # coding=utf-8
 import StringIO
 import os
+import shutil
+import tempfile
 import time
 from datetime import date
 
+import mock
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
@@ -25,12 +29,16 @@ from cl.lib.test_helpers import (
     EmptySolrTestCase,
 )
 from cl.search.feeds import JurisdictionFeed
-from cl.search.management.commands.cl_calculate_pagerank import Command
+from cl.search.management.commands.cl_calculate_pagerank import (
+    Command,
+    do_incremental_pagerank,
+)
 from cl.search.models import (
     Court,
     Docket,
     Opinion,
     OpinionCluster,
+    OpinionsCited,
     RECAPDocument,
     DocketEntry,
     Citation,
@@ -38,7 +46,10 @@ from cl.search.models import (
     SEARCH_TYPES,
     DOCUMENT_STATUSES,
 )
-from cl.search.tasks import add_docket_to_solr_by_rds
+from cl.search.tasks import (
+    add_docket_to_solr_by_rds,
+    add_or_update_recap_docket,
+)
 from cl.search.views import do_search
 from cl.tests.base import BaseSeleniumTest, SELENIUM_TIMEOUT
 
@@ -319,6 +330,120 @@ class IndexingTest(EmptySolrTestCase):
             r2.result.docs[0]["absolute_url"],
         )
 
+    def test_docket_search_batches(self):
+        """Does a docket make the same search dicts in batches as its
+        documents do one at a time?
+        """
+        d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="asdf",
+            pacer_case_id="asdf",
+            court_id="test",
+        )
+        rds = []
+        for i in range(1, 4):
+            de = DocketEntry.objects.create(
+                docket=d, entry_number=i, description="Entry %s" % i
+            )
+            rds.append(
+                RECAPDocument.objects.create(
+                    docket_entry=de,
+                    document_type=RECAPDocument.PACER_DOCUMENT,
+                    document_number=str(i),
+                    pacer_doc_id=str(i),
+                )
+            )
+        # A minute entry, which isn't indexed
+        DocketEntry.objects.create(docket=d, entry_number=4)
+
+        batches = list(d.as_search_batches(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        search_dicts = [s for batch in batches for s in batch]
+        self.assertEqual(search_dicts, [rd.as_search_dict() for rd in rds])
+
+    @override_settings(SOLR_RECAP_ATOMIC_UPDATES=True)
+    def test_recap_docket_delta_indexing(self):
+        """Are only the changes to a docket sent to Solr once it has been
+        indexed?
+        """
+        d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="asdf",
+            pacer_case_id="asdf",
+            court_id="test",
+            cause="Old cause",
+        )
+        de1 = DocketEntry.objects.create(docket=d, entry_number=1)
+        rd1 = RECAPDocument.objects.create(
+            docket_entry=de1,
+            document_type=RECAPDocument.PACER_DOCUMENT,
+            document_number="1",
+            pacer_doc_id="1",
+            plain_text="Some document text",
+        )
+        data = {"docket_pk": d.pk, "content_updated": True}
+        add_or_update_recap_docket(data, force_commit=True)
+
+        # Change a field that's not part of the text, and add a document.
+        d.refresh_from_db()
+        d.cause = "New cause"
+        d.save()
+        de2 = DocketEntry.objects.create(
+            docket=d, entry_number=2, description="New entry"
+        )
+        rd2 = RECAPDocument.objects.create(
+            docket_entry=de2,
+            document_type=RECAPDocument.PACER_DOCUMENT,
+            document_number="2",
+            pacer_doc_id="2",
+        )
+        with mock.patch.object(
+            Docket, "as_search_batches", side_effect=AssertionError
+        ):
+            add_or_update_recap_docket(data, force_commit=True)
+
+        r1 = self.si_recap.get(rd1.pk).result.docs[0]
+        r2 = self.si_recap.get(rd2.pk).result.docs[0]
+        self.assertEqual(r1["cause"], "New cause")
+        self.assertEqual(r2["cause"], "New cause")
+        self.assertEqual(r2["description"], "New entry")
+        # The atomic update didn't lose the fields it didn't set.
+        self.assertEqual(r1["plain_text"], "Some document text")
+
+    def test_recap_docket_without_atomic_updates(self):
+        """If atomic updates are off, is the whole docket added again when
+        its fields change?
+        """
+        d = Docket.objects.create(
+            source=Docket.RECAP,
+            docket_number="asdf",
+            pacer_case_id="asdf",
+            court_id="test",
+            cause="Old cause",
+        )
+        de = DocketEntry.objects.create(docket=d, entry_number=1)
+        rd = RECAPDocument.objects.create(
+            docket_entry=de,
+            document_type=RECAPDocument.PACER_DOCUMENT,
+            document_number="1",
+            pacer_doc_id="1",
+            plain_text="Some document text",
+        )
+        data = {"docket_pk": d.pk, "content_updated": True}
+        add_or_update_recap_docket(data, force_commit=True)
+
+        d.refresh_from_db()
+        d.cause = "New cause"
+        d.save()
+        with mock.patch(
+            "cl.search.tasks.send_atomic_updates", side_effect=AssertionError
+        ):
+            add_or_update_recap_docket(data, force_commit=True)
+
+        r = self.si_recap.get(rd.pk).result.docs[0]
+        self.assertEqual(r["cause"], "New cause")
+        self.assertEqual(r["plain_text"], "Some document text")
+
 
 class SearchTest(IndexedSolrTestCase):
     @staticmethod
@@ -1079,6 +1204,40 @@ class PagerankTest(TestCase):
                 "%s" % (key, pr_results[key], answers[key]),
             )
 
+    def test_numpy_pagerank_matches_igraph(self):
+        """Does the streaming NumPy pagerank agree with igraph?"""
+        igraph_results = Command.do_pagerank()
+        numpy_results = Command.do_pagerank(method="numpy")
+        self.assertEqual(len(igraph_results), len(numpy_results))
+        for pk, value in enumerate(igraph_results):
+            self.assertAlmostEqual(value, numpy_results[pk], places=6)
+
+    def test_incremental_pagerank(self):
+        """Does an incremental run pick up new citations and agree with a
+        full run?
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        state_path = os.path.join(temp_dir, "pagerank-state.npz")
+
+        do_incremental_pagerank(state_path)
+        self.assertTrue(os.path.exists(state_path))
+
+        OpinionsCited.objects.create(citing_opinion_id=2, cited_opinion_id=1)
+        pr_results, _ = do_incremental_pagerank(state_path)
+        full_results = Command.do_pagerank()
+        for pk, value in enumerate(full_results):
+            self.assertAlmostEqual(value, pr_results[pk], places=6)
+
+        # Removing a citation forces the graph to be reloaded.
+        OpinionsCited.objects.filter(
+            citing_opinion_id=2, cited_opinion_id=1
+        ).delete()
+        pr_results, _ = do_incremental_pagerank(state_path)
+        full_results = Command.do_pagerank()
+        for pk, value in enumerate(full_results):
+            self.assertAlmostEqual(value, pr_results[pk], places=6)
+
 
 class OpinionSearchFunctionalTest(BaseSeleniumTest):
     """
@@ -150,6 +150,13 @@ SOLR_URLS = {
     "search.OpinionCluster": SOLR_OPINION_URL,
 }
 
+# Whether RECAP dockets can be updated in Solr with atomic updates, which
+# only set the docket fields that changed on each document. Solr rebuilds
+# atomically updated documents from their stored fields, so this is only safe
+# if every field in the RECAP core is stored, or is the destination of a
+# copyField. It's checked against the schema before it's used.
+SOLR_RECAP_ATOMIC_UPDATES = False
+
 SOLR_OPINION_TEST_CORE_NAME = "opinion_test"
 SOLR_AUDIO_TEST_CORE_NAME = "audio_test"
 SOLR_PEOPLE_TEST_CORE_NAME = "person_test"
@@ -228,6 +235,16 @@ CELERY_RESULT_SERIALIZER = "pickle"
 CELERY_TASK_SERIALIZER = "pickle"
 CELERY_ACCEPT_CONTENT = {"json", "pickle"}
 
+# How many pages of a PDF a task OCRs at once. Each page gets its own
+# ghostscript and tesseract processes, so this multiplies with the worker
+# concurrency above.
+OCR_PROCESSES = 4
+
+# How text is extracted from the files we download, and how many files each
+# process can extract at once.
+EXTRACTION_BACKEND = "cl.scrapers.extraction.CommandLineBackend"
+EXTRACTION_PROCESSES = 4
+
 
 ####################
 # Cache & Sessions #
@@ -277,6 +294,15 @@ STATIC_ROOT = os.path.join(INSTALL_ROOT, "cl/assets/static/")
 # Where should the bulk data be stored?
 BULK_DATA_DIR = os.path.join(INSTALL_ROOT, "cl/assets/media/bulk-data/")
 
+# Where should cl_make_sitemaps put the sitemaps it makes ahead of time?
+SITEMAPS_DIR = os.path.join(INSTALL_ROOT, "cl/assets/media/sitemaps/")
+
+# Where should the citation graph and scores from the last pagerank run be
+# kept, for incremental runs?
+PAGERANK_STATE_FILE = os.path.join(
+    INSTALL_ROOT, "cl/assets/media/pagerank-state.npz"
+)
+
 
 #####################
 # Payments & Prices #
@@ -1,3 +1,9 @@
+import gzip
+import os
+import re
+from collections import OrderedDict
+from io import BytesIO
+
 from django.conf import settings
 from django.urls import reverse
 from django.http import HttpResponse
@@ -10,6 +16,50 @@ from cl.lib.search_utils import build_court_count_query
 
 items_per_sitemap = 10000
 
+# The sitemaps we make from Solr, by section. Each is made ahead of time by
+# cl_make_sitemaps, and made live by its view if that hasn't happened yet.
+solr_sitemaps = OrderedDict()
+solr_sitemaps["opinions"] = {
+    "solr_url": "SOLR_OPINION_URL",
+    "url_name": "opinion_sitemap",
+    "sort": "dateFiled asc",
+    "caller": "o_sitemap",
+    "changefreq": "monthly",
+    "low_priority_pages": ["pdf", "doc", "wpd"],
+    "url_field": "absolute_url",
+    "group": False,
+}
+solr_sitemaps["recap"] = {
+    "solr_url": "SOLR_RECAP_URL",
+    "url_name": "recap_sitemap",
+    "sort": "docket_id asc",
+    "caller": "r_sitemap",
+    "changefreq": "weekly",
+    "low_priority_pages": [],
+    "url_field": "docket_absolute_url",
+    "group": True,
+}
+solr_sitemaps["oral-arguments"] = {
+    "solr_url": "SOLR_AUDIO_URL",
+    "url_name": "oral_argument_sitemap",
+    "sort": "dateArgued asc",
+    "caller": "oa_sitemap",
+    "changefreq": "monthly",
+    "low_priority_pages": ["mp3"],
+    "url_field": "absolute_url",
+    "group": False,
+}
+solr_sitemaps["people"] = {
+    "solr_url": "SOLR_PEOPLE_URL",
+    "url_name": "people_sitemap",
+    "sort": "dob asc,name_reverse asc",
+    "caller": "p_sitemap",
+    "changefreq": "monthly",
+    "low_priority_pages": [],
+    "url_field": "absolute_url",
+    "group": False,
+}
+
 
 def make_sitemap_solr_params(sort, caller):
     params = {
@@ -55,16 +105,8 @@ def normalize_grouping(result):
         return result
 
 
-def make_solr_sitemap(
-    request, solr_url, params, changefreq, low_priority_pages, url_field
-):
-    solr = ExtraSolrInterface(solr_url)
-    page = int(request.GET.get("p", 1))
-    court = request.GET["court"]
-    params["start"] = (page - 1) * items_per_sitemap
-    params["fq"] = ["court_exact:%s" % court]
-    results = solr.query().add_extra(**params).execute()
-
+def make_sitemap_urls(results, changefreq, low_priority_pages, url_field):
+    """Make the items of a sitemap from a page of Solr results."""
     urls = []
     cl = "https://www.courtlistener.com"
     for result in results:
@@ -85,33 +127,178 @@ def make_solr_sitemap(
             else:
                 item["priority"] = "0.5"
             urls.append(item.copy())
+    return urls
+
+
+def render_sitemap(urls):
+    return smart_str(loader.render_to_string("sitemap.xml", {"urlset": urls}))
+
 
-    xml = smart_str(loader.render_to_string("sitemap.xml", {"urlset": urls}))
+def render_sitemap_index(sites):
+    # Random additional sitemaps.
+    sites = sites + [
+        "https://www.courtlistener.com%s" % reverse("simple_pages_sitemap"),
+        "https://www.courtlistener.com/sitemap-visualizations.xml",
+    ]
+    return smart_str(
+        loader.render_to_string("sitemap_index.xml", {"sitemaps": sites})
+    )
+
+
+def make_sitemap_response(xml):
+    # These links contain case names, so they should get crawled but not
+    # indexed
     response = HttpResponse(xml, content_type="application/xml")
     response["X-Robots-Tag"] = "noindex, noodp, noarchive, noimageindex"
     return response
 
 
-@cache_page(60 * 60 * 24 * 7, cache="db_cache")  # One week
-def index_sitemap_maker(request):
-    """Generate a sitemap index page
+def make_solr_sitemap(
+    request, solr_url, params, changefreq, low_priority_pages, url_field
+):
+    solr = ExtraSolrInterface(solr_url)
+    page = int(request.GET.get("p", 1))
+    court = request.GET["court"]
+    params["start"] = (page - 1) * items_per_sitemap
+    params["fq"] = ["court_exact:%s" % court]
+    results = solr.query().add_extra(**params).execute()
+    urls = make_sitemap_urls(
+        results, changefreq, low_priority_pages, url_field
+    )
+    return make_sitemap_response(render_sitemap(urls))
 
-    Counts the number of cases in the site, divides by `items_per_sitemap` and
-    provides links items.
+
+def iter_sitemap_pages(section, court):
+    """Page through the items of a court in Solr, one sitemap at a time.
+
+    Paging with start gets slower the deeper it goes, because Solr has to
+    sort every item before the page to find it, and grouped queries are the
+    worst of all. Cursors don't, but they can't be grouped, so RECAP
+    documents are collapsed to one per docket instead.
+
+    :param section: A key of solr_sitemaps.
+    :param court: The ID of a court.
+    :return: An iterator of lists of Solr results, items_per_sitemap long
+    except the last.
     """
-    connection_string_sitemap_path_pairs = (
-        (settings.SOLR_OPINION_URL, reverse("opinion_sitemap"), False),
-        (settings.SOLR_RECAP_URL, reverse("recap_sitemap"), True),
-        (settings.SOLR_AUDIO_URL, reverse("oral_argument_sitemap"), False),
-        (settings.SOLR_PEOPLE_URL, reverse("people_sitemap"), False),
+    sitemap = solr_sitemaps[section]
+    params = make_sitemap_solr_params(sitemap["sort"], sitemap["caller"])
+    # Cursors can't be used with start or with groups.
+    del params["start"]
+    params = {k: v for k, v in params.items() if not k.startswith("group")}
+    # Cursors need the sort to end with the unique key to break ties.
+    params["sort"] = "%s,id asc" % params["sort"]
+    params["fq"] = ["court_exact:%s" % court]
+    if sitemap["group"]:
+        params["fq"].append("{!collapse field=docket_id}")
+
+    solr = ExtraSolrInterface(getattr(settings, sitemap["solr_url"]))
+    cursor_mark = "*"
+    while True:
+        params["cursorMark"] = cursor_mark
+        results = solr.query().add_extra(**params).execute()
+        if len(results):
+            yield list(results)
+        if (
+            len(results) < items_per_sitemap
+            or results.next_cursor_mark == cursor_mark
+        ):
+            break
+        cursor_mark = results.next_cursor_mark
+
+
+def get_court_counts(section, since=None):
+    """Count the items of each court in a section of the sitemap.
+
+    :param section: A key of solr_sitemaps.
+    :param since: If given, a Solr date string, and only items indexed since
+    then are counted.
+    :return: A dict of court IDs to counts. Courts with no items are left out.
+    """
+    sitemap = solr_sitemaps[section]
+    params = build_court_count_query()
+    params["fq"] = []
+    if sitemap["group"]:
+        # Much faster than grouped facets, and counts the same thing.
+        params["fq"].append("{!collapse field=docket_id}")
+    if since is not None:
+        params["fq"].append("timestamp:[%s TO *]" % since)
+    solr = ExtraSolrInterface(getattr(settings, sitemap["solr_url"]))
+    response = solr.query().add_extra(**params).execute()
+    court_count_tuples = response.facet_counts.facet_fields["court_exact"]
+    return {court: count for court, count in court_count_tuples if count}
+
+
+def get_sitemap_path(section, court, page):
+    return os.path.join(
+        settings.SITEMAPS_DIR, section, "%s-%s.xml.gz" % (court, page)
+    )
+
+
+def get_sitemap_index_path():
+    return os.path.join(settings.SITEMAPS_DIR, "index.xml.gz")
+
+
+def serve_sitemap_file(request, path):
+    """Serve a sitemap made ahead of time, gzipped if the client can take it.
+
+    :return: The response, or None if the file doesn't exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+    if "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+        response = make_sitemap_response(data)
+        response["Content-Encoding"] = "gzip"
+    else:
+        xml = gzip.GzipFile(fileobj=BytesIO(data)).read()
+        response = make_sitemap_response(xml)
+    response["Vary"] = "Accept-Encoding"
+    return response
+
+
+@cache_page(60 * 60 * 24 * 14, cache="db_cache")  # two weeks
+def live_solr_sitemap(request, section):
+    sitemap = solr_sitemaps[section]
+    return make_solr_sitemap(
+        request,
+        getattr(settings, sitemap["solr_url"]),
+        make_sitemap_solr_params(sitemap["sort"], sitemap["caller"]),
+        sitemap["changefreq"],
+        sitemap["low_priority_pages"],
+        sitemap["url_field"],
     )
+
+
+def solr_sitemap_maker(request, section):
+    """Serve a page of a section of the sitemap, from the file made by
+    cl_make_sitemaps if there is one, else live from Solr.
+    """
+    court = request.GET["court"]
+    page = request.GET.get("p", "1")
+    if re.match(r"^[\w-]+$", court) and page.isdigit():
+        response = serve_sitemap_file(
+            request, get_sitemap_path(section, court, int(page))
+        )
+        if response is not None:
+            return response
+    return live_solr_sitemap(request, section)
+
+
+@cache_page(60 * 60 * 24 * 7, cache="db_cache")  # One week
+def live_index_sitemap(request):
     sites = []
-    for connection_string, path, group in connection_string_sitemap_path_pairs:
-        conn = ExtraSolrInterface(connection_string)
+    for section, sitemap in solr_sitemaps.items():
+        conn = ExtraSolrInterface(getattr(settings, sitemap["solr_url"]))
         response = (
-            conn.query().add_extra(**build_court_count_query(group)).execute()
+            conn.query()
+            .add_extra(**build_court_count_query(sitemap["group"]))
+            .execute()
         )
         court_count_tuples = response.facet_counts.facet_fields["court_exact"]
+        path = reverse(sitemap["url_name"])
         for court, count in court_count_tuples:
             num_pages = count / items_per_sitemap + 1
             for page in range(1, num_pages + 1):
@@ -119,20 +306,17 @@ def index_sitemap_maker(request):
                     "https://www.courtlistener.com%s?p=%s&court=%s"
                     % (path, page, court)
                 )
+    return make_sitemap_response(render_sitemap_index(sites))
 
-    # Random additional sitemaps.
-    sites.extend(
-        [
-            "https://www.courtlistener.com%s"
-            % reverse("simple_pages_sitemap"),
-            "https://www.courtlistener.com/sitemap-visualizations.xml",
-        ]
-    )
 
-    xml = loader.render_to_string("sitemap_index.xml", {"sitemaps": sites})
+def index_sitemap_maker(request):
+    """Generate a sitemap index page
 
-    # These links contain case names, so they should get crawled but not
-    # indexed
-    response = HttpResponse(xml, content_type="application/xml")
-    response["X-Robots-Tag"] = "noindex, noodp, noarchive, noimageindex"
-    return response
+    Counts the number of cases in the site, divides by `items_per_sitemap` and
+    provides links items. If cl_make_sitemaps has made the index, that's
+    served instead.
+    """
+    response = serve_sitemap_file(request, get_sitemap_index_path())
+    if response is not None:
+        return response
+    return live_index_sitemap(request)